@@ -1,13 +1,40 @@
 import json
 import sqlite3
+import sys
+import argparse
+import email
+import email.generator
+import email.message
+import email.parser
+import email.policy
+import email.utils
 import heapq
+import collections
 import datetime
 import os
 import threading
+import zlib
+import lzma
+import time
+import random
+import tempfile
+import hashlib
+import mmap
+import mimetypes
+import io
+import contextlib
+import array
+import struct
+import math
+import re
+import concurrent.futures
 import asyncio
 import queue
+import uuid
+import copy
+import shutil
 import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
+from tkinter import ttk, messagebox, simpledialog, filedialog
 
 # Intenta importar el websockets
 try:
@@ -16,7 +43,118 @@ try:
 except Exception:
     WEBSOCKETS_AVAILABLE = False
 
+# NumPy es opcional: el clasificador de spam tiene una versión en Python puro
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except Exception:
+    NUMPY_AVAILABLE = False
+
+# msgpack es opcional: el chat binario tiene un codificador propio del mismo formato
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except Exception:
+    MSGPACK_AVAILABLE = False
+
 DB_FILE = "correo.db"
+DIA_MS = 86400000
+# cada cuánto limpiar_papelera purga también las claves de idempotencia vencidas
+INTERVALO_LIMPIEZA_CLAVES_MS = 3600000
+COLUMNAS_MENSAJE = "id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_ms, prioridad, eliminado_ms, procesado_prioridad, cuerpo_formato, leido, contenido_id, en_respuesta_a, hilo_id, carpeta"
+
+
+def _vista_mensajes(tabla):
+    """
+    Subconsulta con las columnas de COLUMNAS_MENSAJE para una tabla de entregas
+    (`main.mensajes` o la de un archivo): las entregas de un envío a varios
+    destinatarios no guardan el cuerpo, lo toman de `contenidos` (y éste de
+    `cuerpos` si el cuerpo está compartido). El asunto está en cada fila, así
+    ordenar por asunto usa el índice (destinatario_id, asunto).
+    SQLite aplana la subconsulta, así los WHERE siguen usando los índices de mensajes.
+    """
+    return f"""(SELECT m.id AS id, m.remitente_id AS remitente_id, m.destinatario_id AS destinatario_id,
+                m.asunto AS asunto, COALESCE(m.cuerpo_json, co.cuerpo_json, cu.cuerpo_json) AS cuerpo_json,
+                m.fecha_ms AS fecha_ms, m.prioridad AS prioridad, m.eliminado_ms AS eliminado_ms,
+                m.procesado_prioridad AS procesado_prioridad,
+                CASE WHEN m.contenido_id IS NULL THEN m.cuerpo_formato
+                     WHEN co.cuerpo_id IS NULL THEN co.cuerpo_formato ELSE cu.cuerpo_formato END AS cuerpo_formato,
+                m.leido AS leido, m.contenido_id AS contenido_id,
+                m.en_respuesta_a AS en_respuesta_a, m.hilo_id AS hilo_id, m.carpeta AS carpeta
+            FROM {tabla} m LEFT JOIN main.contenidos co ON co.id = m.contenido_id
+                LEFT JOIN main.cuerpos cu ON cu.id = co.cuerpo_id)"""
+
+
+# Columnas por las que se puede ordenar un listado de mensajes (ver _orden_sql)
+ORDENES_MENSAJES = {"id": "id", "asunto": "asunto", "remitente": "remitente_id", "destinatario": "destinatario_id",
+                    "fecha": "fecha_ms", "prioridad": "prioridad"}
+
+
+def _ordenar_filas(filas, orden):
+    """
+    Ordena filas de COLUMNAS_MENSAJE según el ORDER BY `orden` (de _orden_sql o
+    uno por defecto) como SQLite: NULL antes que cualquier valor. Ordenamientos
+    estables de la última clave a la primera.
+    """
+    columnas = COLUMNAS_MENSAJE.split(", ")
+    for termino in reversed(orden.split(",")):
+        partes = termino.split()
+        i = columnas.index(partes[0])
+        filas.sort(key=lambda f: (f[i] is not None, f[i] if f[i] is not None else 0),
+                   reverse=len(partes) > 1 and partes[1].upper() == "DESC")
+    return filas
+
+
+def _orden_sql(orden, defecto):
+    """
+    ORDER BY para `orden` = (clave de ORDENES_MENSAJES, descendente), o `defecto`
+    si es None. El id desempata en el mismo sentido: los índices (usuario, columna)
+    ya lo tienen como última clave, así SQLite no necesita ordenar aparte.
+    """
+    if orden is None:
+        return defecto
+    clave, descendente = orden
+    if clave not in ORDENES_MENSAJES:
+        raise ValueError(f"No se puede ordenar por: {clave}")
+    sentido = "DESC" if descendente else "ASC"
+    if clave == "id":
+        return f"id {sentido}"
+    return f"{ORDENES_MENSAJES[clave]} {sentido}, id {sentido}"
+
+
+# Fechas: en la base son enteros (milisegundos desde 1970 en UTC); hacia afuera
+# (Mensaje.fecha_envio, exportaciones, interfaz) texto ISO en hora local.
+def _a_ms(valor):
+    """Acepta ms, datetime/date o texto ISO (sin zona = hora local); None queda None."""
+    if valor is None or valor == "":
+        return None
+    if isinstance(valor, (int, float)):
+        return int(valor)
+    if isinstance(valor, str):
+        valor = datetime.datetime.fromisoformat(valor)
+    if not isinstance(valor, datetime.datetime):
+        valor = datetime.datetime.combine(valor, datetime.time())
+    return round(valor.timestamp() * 1000)
+
+
+def _ms_a_iso(ms):
+    if ms is None:
+        return None
+    return datetime.datetime.fromtimestamp(ms / 1000).isoformat(timespec="milliseconds")
+
+
+def _ahora_ms():
+    return time.time_ns() // 1_000_000
+
+
+# Qué cuenta cada contador para una fila `{r}` de mensajes (ver tabla contadores).
+# Deben coincidir con los WHERE de las vistas de bandeja, prioritarios y papelera.
+_CONTADORES_DESTINATARIO = {
+    "bandeja": "({r}.eliminado_ms IS NULL AND COALESCE({r}.procesado_prioridad, 0) = 0 AND {r}.carpeta IS NULL)",
+    "no_leidos": "({r}.eliminado_ms IS NULL AND COALESCE({r}.leido, 0) = 0)",
+    "prioritarios": "(COALESCE({r}.procesado_prioridad, 0) = 1)",
+    "papelera": "({r}.eliminado_ms IS NOT NULL)",
+}
 DEFAULT_WS_HOST = "localhost"
 DEFAULT_WS_PORT = 8765
 
@@ -35,15 +173,73 @@ class Usuario:
 
 
 class Mensaje:
-    def __init__(self, id_mensaje, asunto, cuerpo, remitente_id, destinatario_id, fecha_envio=None, metadata=None, prioridad=5):
+    def __init__(self, id_mensaje, asunto, cuerpo, remitente_id, destinatario_id, fecha_envio=None, metadata=None, prioridad=5, adjuntos=None, en_respuesta_a=None, clave_idempotencia=None):
         self.id_mensaje = id_mensaje
         self.asunto = asunto
         self.cuerpo = cuerpo
         self.remitente_id = remitente_id
         self.destinatario_id = destinatario_id
-        self.fecha_envio = fecha_envio or datetime.datetime.now().isoformat()
+        # fecha_envio acepta texto ISO, datetime o ms; se guarda en ms (ver la propiedad)
+        self.fecha_ms = _a_ms(fecha_envio) if fecha_envio is not None else _ahora_ms()
         self.metadata = metadata or {}
         self.prioridad = prioridad
+        # referencias a blobs del AlmacenAdjuntos: [{"sha256", "nombre", "tamaño", "tipo"}]
+        self.adjuntos = adjuntos or []
+        self.leido = False
+        # conversación: id del mensaje respondido y del hilo (id del primer mensaje)
+        self.en_respuesta_a = en_respuesta_a
+        self.hilo_id = None
+        # carpeta a la que la movió una regla (None = bandeja de entrada)
+        self.carpeta = None
+        # clave que elige el cliente para que un reintento no duplique el envío
+        self.clave_idempotencia = clave_idempotencia
+
+    @property
+    def fecha_envio(self):
+        return _ms_a_iso(self.fecha_ms)
+
+    @fecha_envio.setter
+    def fecha_envio(self, valor):
+        self.fecha_ms = _a_ms(valor)
+
+    # cuerpo y metadata se decodifican (y descomprimen) recién cuando se leen
+    @property
+    def cuerpo(self):
+        if self._crudo is not None:
+            self._decodificar()
+        return self._cuerpo
+
+    @cuerpo.setter
+    def cuerpo(self, valor):
+        if getattr(self, "_crudo", None) is not None:
+            self._decodificar()
+        self._crudo = None
+        self._cuerpo = valor
+
+    @property
+    def metadata(self):
+        if self._crudo is not None:
+            self._decodificar()
+        return self._metadata
+
+    @metadata.setter
+    def metadata(self, valor):
+        if getattr(self, "_crudo", None) is not None:
+            self._decodificar()
+        self._crudo = None
+        self._metadata = valor
+
+    def _decodificar(self):
+        crudo, formato = self._crudo
+        self._crudo = None
+        cuerpo_json = descomprimir_cuerpo(crudo, formato)
+        try:
+            parsed = json.loads(cuerpo_json)
+            self._cuerpo = parsed.get("cuerpo") if isinstance(parsed, dict) else cuerpo_json
+            self._metadata = parsed.get("metadata", {}) if isinstance(parsed, dict) else {}
+        except Exception:
+            self._cuerpo = cuerpo_json
+            self._metadata = {}
 
     def to_json(self):
         return json.dumps({
@@ -54,7 +250,10 @@ class Mensaje:
             "destinatario_id": self.destinatario_id,
             "fecha_envio": self.fecha_envio,
             "metadata": self.metadata,
-            "prioridad": self.prioridad
+            "prioridad": self.prioridad,
+            "adjuntos": self.adjuntos,
+            "en_respuesta_a": self.en_respuesta_a,
+            "hilo_id": self.hilo_id
         }, ensure_ascii=False)
 
     def from_row(row):
@@ -65,28 +264,271 @@ class Mensaje:
         cuerpo_json = row[4]
         fecha = row[5]
         prioridad = row[6] if len(row) > 6 and row[6] is not None else 5
-        try:
-            parsed = json.loads(cuerpo_json)
-            cuerpo = parsed.get("cuerpo") if isinstance(parsed, dict) else cuerpo_json
-            metadata = parsed.get("metadata", {}) if isinstance(parsed, dict) else {}
-        except Exception:
-            cuerpo = cuerpo_json
-            metadata = {}
-        return Mensaje(id_db, asunto, cuerpo, remitente_id, destinatario_id, fecha, metadata, prioridad)
+        formato = row[9] if len(row) > 9 else None
+        m = Mensaje(id_db, asunto, None, remitente_id, destinatario_id, fecha, None, prioridad)
+        m._crudo = (cuerpo_json, formato)
+        m.leido = bool(row[10]) if len(row) > 10 else False
+        if len(row) > 13:
+            m.en_respuesta_a, m.hilo_id = row[12], row[13]
+        m.carpeta = row[14] if len(row) > 14 else None
+        return m
 
     def __str__(self):
         return f"[{self.asunto}] De: {self.remitente_id} → {self.destinatario_id} ({self.fecha_envio})"
 
 
+# ==========================
+# Compresión de cuerpos
+# ==========================
+# formato -> (comprimir(bytes) -> bytes, descomprimir(bytes) -> bytes).
+# Un formato NULL en la tabla significa texto JSON sin comprimir.
+CODECS_CUERPO = {
+    "zlib": (lambda datos: zlib.compress(datos, 6), zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+
+def registrar_codec(nombre, comprimir, descomprimir):
+    CODECS_CUERPO[nombre] = (comprimir, descomprimir)
+
+
+def comprimir_cuerpo(cuerpo_json, codec="zlib", umbral=4096):
+    """
+    Devuelve (valor, formato) para guardar en cuerpo_json / cuerpo_formato.
+    Sólo comprime si el texto supera `umbral` bytes y si realmente achica.
+    """
+    if codec is None or cuerpo_json is None:
+        return cuerpo_json, None
+    datos = cuerpo_json.encode("utf-8")
+    if len(datos) < umbral:
+        return cuerpo_json, None
+    comprimido = CODECS_CUERPO[codec][0](datos)
+    if len(comprimido) >= len(datos):
+        return cuerpo_json, None
+    return comprimido, codec
+
+
+def descomprimir_cuerpo(valor, formato):
+    if formato is None:
+        return valor
+    return CODECS_CUERPO[formato][1](valor).decode("utf-8")
+
+
+# ==========================
+# Almacén de adjuntos (direccionado por contenido)
+# ==========================
+class AlmacenAdjuntos:
+    """
+    Guarda cada archivo una sola vez, nombrado por su SHA-256, en un directorio
+    repartido en dos niveles (raiz/ab/cd/abcd...). Archivos idénticos adjuntados
+    a distintos mensajes o destinatarios comparten el mismo blob; el contador de
+    referencias vive en la tabla `adjuntos` de BaseDatos.
+    """
+    TAM_BLOQUE = 1024 * 1024
+
+    def __init__(self, raiz):
+        self.raiz = raiz
+
+    def ruta(self, sha):
+        return os.path.join(self.raiz, sha[:2], sha[2:4], sha)
+
+    def guardar_archivo(self, ruta_origen, tipo=None):
+        """Copia un archivo al almacén en streaming. Devuelve la referencia para Mensaje.adjuntos."""
+        with open(ruta_origen, "rb") as f:
+            ref = self.guardar_stream(f)
+        ref["nombre"] = os.path.basename(ruta_origen)
+        ref["tipo"] = tipo or mimetypes.guess_type(ruta_origen)[0]
+        return ref
+
+    def guardar_bytes(self, datos, nombre, tipo=None):
+        ref = self.guardar_stream(io.BytesIO(datos))
+        ref["nombre"] = nombre
+        ref["tipo"] = tipo or mimetypes.guess_type(nombre)[0]
+        return ref
+
+    def guardar_stream(self, f):
+        # Se escribe a un temporal mientras se calcula el hash; si el blob ya existe se descarta
+        tmp_dir = os.path.join(self.raiz, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        h = hashlib.sha256()
+        tamaño = 0
+        fd, tmp = tempfile.mkstemp(dir=tmp_dir)
+        try:
+            with os.fdopen(fd, "wb") as out:
+                while True:
+                    bloque = f.read(self.TAM_BLOQUE)
+                    if not bloque:
+                        break
+                    h.update(bloque)
+                    out.write(bloque)
+                    tamaño += len(bloque)
+            sha = h.hexdigest()
+            destino = self.ruta(sha)
+            if os.path.exists(destino):
+                os.remove(tmp)
+            else:
+                os.makedirs(os.path.dirname(destino), exist_ok=True)
+                os.replace(tmp, destino)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        return {"sha256": sha, "tamaño": tamaño}
+
+    @contextlib.contextmanager
+    def abrir(self, sha):
+        """Mapea el blob en memoria (sólo lectura); los archivos vacíos dan b''."""
+        with open(self.ruta(sha), "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield b""
+                return
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield m
+            finally:
+                m.close()
+
+    def leer_en_bloques(self, sha, tam_bloque=TAM_BLOQUE):
+        with self.abrir(sha) as datos:
+            for i in range(0, len(datos), tam_bloque):
+                yield datos[i:i + tam_bloque]
+
+    def copiar_a(self, sha, ruta_destino):
+        with open(ruta_destino, "wb") as out:
+            for bloque in self.leer_en_bloques(sha):
+                out.write(bloque)
+
+    def borrar(self, sha):
+        try:
+            os.remove(self.ruta(sha))
+        except FileNotFoundError:
+            pass
+
+    def copiar_de(self, otro, sha):
+        # Trae el blob de otro almacén si no lo tiene (cada fragmento de la base tiene el suyo)
+        if os.path.abspath(otro.raiz) == os.path.abspath(self.raiz) or os.path.exists(self.ruta(sha)):
+            return
+        with open(otro.ruta(sha), "rb") as f:
+            self.guardar_stream(f)
+
+
+# ==========================
+# Caché de la primera página de bandeja / prioritarios / papelera
+# ==========================
+VISTAS_CACHE = ("bandeja", "prioritarios", "papelera")
+# tamaño de las listas IN de las operaciones en bloque (debajo del límite de variables de SQLite)
+LOTE_IN = 500
+
+
+class CacheBandejas:
+    """
+    Caché LRU por (vista, usuario, limite) acotada por cantidad de entradas y
+    por total de mensajes guardados. Las escrituras de BaseDatos invalidan sólo
+    las vistas de los usuarios afectados; cada invalidación sube una
+    "generación" para que una lectura que empezó antes no guarde datos viejos.
+    """
+    def __init__(self, max_entradas=256, max_mensajes=20000):
+        self.max_entradas = max_entradas
+        self.max_mensajes = max_mensajes
+        self._entradas = collections.OrderedDict()
+        self._generaciones = {}
+        self._epoca = 0
+        self._total_mensajes = 0
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+        self.invalidaciones = 0
+        self.desalojos = 0
+
+    def generacion(self, vista, uid):
+        with self._lock:
+            return (self._epoca, self._generaciones.get((vista, uid), 0))
+
+    def obtener(self, clave):
+        with self._lock:
+            valor = self._entradas.get(clave)
+            if valor is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(clave)
+            self.aciertos += 1
+            return valor
+
+    def guardar(self, clave, mensajes, generacion):
+        vista, uid, _limite = clave
+        with self._lock:
+            if (self._epoca, self._generaciones.get((vista, uid), 0)) != generacion or len(mensajes) > self.max_mensajes:
+                return
+            anterior = self._entradas.pop(clave, None)
+            if anterior is not None:
+                self._total_mensajes -= len(anterior)
+            self._entradas[clave] = mensajes
+            self._total_mensajes += len(mensajes)
+            while len(self._entradas) > self.max_entradas or self._total_mensajes > self.max_mensajes:
+                _clave, viejo = self._entradas.popitem(last=False)
+                self._total_mensajes -= len(viejo)
+                self.desalojos += 1
+
+    def invalidar(self, uids, vistas=VISTAS_CACHE):
+        with self._lock:
+            for vista in vistas:
+                # la vista global de prioritarios (uid=None) depende de todos los usuarios
+                for uid in set(uids) | ({None} if vista == "prioritarios" else set()):
+                    self._generaciones[(vista, uid)] = self._generaciones.get((vista, uid), 0) + 1
+            for clave in [k for k in self._entradas if k[0] in vistas and (k[1] in uids or k[1] is None)]:
+                self._total_mensajes -= len(self._entradas.pop(clave))
+                self.invalidaciones += 1
+
+    def limpiar(self):
+        with self._lock:
+            self._epoca += 1
+            self.invalidaciones += len(self._entradas)
+            self._entradas.clear()
+            self._total_mensajes = 0
+
+    def estadisticas(self):
+        with self._lock:
+            total = self.aciertos + self.fallos
+            return {
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "tasa_aciertos": self.aciertos / total if total else 0.0,
+                "invalidaciones": self.invalidaciones,
+                "desalojos": self.desalojos,
+                "entradas": len(self._entradas),
+                "mensajes": self._total_mensajes,
+            }
+
+
 # ==========================
 # Base de datos (SQLite)
 # ==========================
 class BaseDatos:
-    def __init__(self, db_file=DB_FILE):
+    def __init__(self, db_file=DB_FILE, codec_compresion="zlib", umbral_compresion=4096, dir_adjuntos=None,
+                 umbral_dedup=512, ttl_idempotencia_ms=DIA_MS):
         self.db_file = db_file
         first_time = not os.path.exists(self.db_file)
         self.conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        # cuerpos de más de `umbral_compresion` bytes se guardan comprimidos (None desactiva)
+        self.codec_compresion = codec_compresion
+        self.umbral_compresion = umbral_compresion
+        # cuerpos de `umbral_dedup` bytes o más de envíos a varios se guardan una vez por contenido;
+        # los de una sola entrega sólo lo comparten si ya estaba guardado (None desactiva)
+        self.umbral_dedup = umbral_dedup
+        # una clave de idempotencia vale por `ttl_idempotencia_ms`; después se puede volver a usar
+        self.ttl_idempotencia_ms = ttl_idempotencia_ms
+        self._proxima_limpieza_claves = 0
+        self._archivos_preparados = set()
+        self.cache = CacheBandejas()
+        # dentro de agrupar(): invalidaciones de caché pendientes del commit del grupo
+        self._grupo = None
+        self._rango_grupo = None
+        self._hilos_resueltos = {}
+        self.adjuntos = AlmacenAdjuntos(dir_adjuntos or os.path.splitext(os.path.abspath(self.db_file))[0] + "_adjuntos")
         self._crear_tablas()
+        # los fragmentos numeran sus mensajes con su propio contador (ver usar_secuencia_propia)
+        self._secuencia_propia = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'secuencia_mensajes'").fetchone() is not None
 
     def _crear_tablas(self):
         c = self.conn.cursor()
@@ -106,25 +548,279 @@ class BaseDatos:
                 destinatario_id INTEGER NOT NULL,
                 asunto TEXT,
                 cuerpo_json TEXT,
-                fecha_envio TEXT,
+                fecha_ms INTEGER,
                 prioridad INTEGER DEFAULT 5,
-                eliminado_en TEXT,
+                eliminado_ms INTEGER,
                 procesado_prioridad INTEGER DEFAULT 0,
                 FOREIGN KEY(remitente_id) REFERENCES usuarios(id),
                 FOREIGN KEY(destinatario_id) REFERENCES usuarios(id)
             )
         """)
+        # registro de archivos mensuales (ver Archivador)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS archivos_mensajes (
+                mes TEXT PRIMARY KEY,
+                ruta TEXT NOT NULL
+            )
+        """)
+        # adjuntos: un blob por sha256 con contador de referencias, y la relación mensaje -> blob
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS adjuntos (
+                sha256 TEXT PRIMARY KEY,
+                tamaño INTEGER NOT NULL,
+                referencias INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS mensaje_adjuntos (
+                mensaje_id INTEGER NOT NULL,
+                sha256 TEXT NOT NULL,
+                nombre TEXT NOT NULL,
+                tipo TEXT,
+                PRIMARY KEY (mensaje_id, nombre),
+                FOREIGN KEY(sha256) REFERENCES adjuntos(sha256)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensaje_adjuntos_sha ON mensaje_adjuntos(sha256)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_adjuntos_sin_ref ON adjuntos(referencias) WHERE referencias <= 0")
         # salvaguardias para bases de datos 
+        self._migrar_fechas("main")
+        # (usuario, fecha): bandeja, búsqueda y papelera recorren sólo el rango de fechas pedido
+        c.execute("DROP INDEX IF EXISTS idx_mensajes_remitente")
+        c.execute("DROP INDEX IF EXISTS idx_mensajes_destinatario")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_remitente_fecha ON mensajes(remitente_id, fecha_ms)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_destinatario_fecha ON mensajes(destinatario_id, fecha_ms)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_eliminado ON mensajes(eliminado_ms) WHERE eliminado_ms IS NOT NULL")
+        # ordenar la bandeja por prioridad o remitente (ListaVirtual) sin ordenar en memoria
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_destinatario_prioridad ON mensajes(destinatario_id, prioridad)")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_destinatario_remitente ON mensajes(destinatario_id, remitente_id)")
         try:
-            c.execute("ALTER TABLE mensajes ADD COLUMN eliminado_en TEXT")
+            c.execute("ALTER TABLE mensajes ADD COLUMN procesado_prioridad INTEGER DEFAULT 0")
         except sqlite3.OperationalError:
             pass
         try:
-            c.execute("ALTER TABLE mensajes ADD COLUMN procesado_prioridad INTEGER DEFAULT 0")
+            c.execute("ALTER TABLE mensajes ADD COLUMN cuerpo_formato TEXT")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            c.execute("ALTER TABLE mensajes ADD COLUMN leido INTEGER DEFAULT 0")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            c.execute("ALTER TABLE mensajes ADD COLUMN contenido_id INTEGER REFERENCES contenidos(id)")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            c.execute("ALTER TABLE mensajes ADD COLUMN en_respuesta_a INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        try:
+            c.execute("ALTER TABLE mensajes ADD COLUMN hilo_id INTEGER")
+        except sqlite3.OperationalError:
+            pass
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_hilo ON mensajes(hilo_id)")
+        try:
+            c.execute("ALTER TABLE mensajes ADD COLUMN carpeta TEXT")
+        except sqlite3.OperationalError:
+            pass
+        c.execute("CREATE INDEX IF NOT EXISTS idx_mensajes_carpeta ON mensajes(destinatario_id, carpeta) WHERE carpeta IS NOT NULL")
+
+        # reglas de cada usuario sobre su correo entrante (ver Regla y Refiltrador)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS reglas (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                usuario_id INTEGER NOT NULL,
+                campo TEXT NOT NULL,
+                patron TEXT NOT NULL,
+                es_regex INTEGER NOT NULL DEFAULT 0,
+                accion TEXT NOT NULL,
+                destino TEXT,
+                orden INTEGER NOT NULL DEFAULT 0,
+                activa INTEGER NOT NULL DEFAULT 1
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_reglas_usuario ON reglas(usuario_id, orden, id)")
+
+        # resúmenes de conversaciones, actualizados al insertar (ver _actualizar_hilos):
+        # hilos tiene el total y hilo_participantes la vista de cada usuario, indexada
+        # para listar sus conversaciones sin agrupar el buzón en cada consulta
+        c.execute("SELECT type FROM pragma_table_info('hilos') WHERE name = 'ultima_fecha'")
+        tipo = c.fetchone()
+        if tipo is not None and tipo[0] != "INTEGER":
+            # resúmenes de antes de las fechas en ms: se rehacen desde los mensajes
+            c.execute("DROP TABLE hilos")
+            c.execute("DROP TABLE IF EXISTS hilo_participantes")
+        hilos_nuevos = tipo is None or tipo[0] != "INTEGER"
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS hilos (
+                id INTEGER PRIMARY KEY,
+                asunto TEXT,
+                ultimo_mensaje_id INTEGER,
+                ultima_fecha INTEGER,
+                cantidad INTEGER NOT NULL DEFAULT 0,
+                participantes INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS hilo_participantes (
+                hilo_id INTEGER NOT NULL,
+                usuario_id INTEGER NOT NULL,
+                ultimo_mensaje_id INTEGER,
+                ultima_fecha INTEGER,
+                cantidad INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (hilo_id, usuario_id)
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_hilo_participantes_usuario ON hilo_participantes(usuario_id, ultima_fecha DESC, hilo_id DESC)")
+
+        # envíos a varios destinatarios: el asunto y el cuerpo se guardan una sola vez
+        # y cada destinatario tiene su fila liviana en mensajes (papelera, prioridad, leído)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS contenidos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                asunto TEXT,
+                cuerpo_json TEXT,
+                cuerpo_formato TEXT,
+                entregas INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_contenidos_sin_entregas ON contenidos(entregas) WHERE entregas <= 0")
+        # cuerpos repetidos (mismo SHA-256) se guardan una sola vez y los contenidos los referencian
+        # (ver _guardar_cuerpo); el contenido sigue siendo uno por envío, con su asunto y sus entregas.
+        # Un envío de una sola entrega lleva el cuerpo en su fila salvo que ya esté acá
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS cuerpos (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                hash BLOB NOT NULL UNIQUE,
+                cuerpo_json TEXT,
+                cuerpo_formato TEXT,
+                referencias INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_cuerpos_sin_referencias ON cuerpos(referencias) WHERE referencias <= 0")
+        try:
+            c.execute("ALTER TABLE contenidos ADD COLUMN cuerpo_id INTEGER REFERENCES cuerpos(id)")
         except sqlite3.OperationalError:
             pass
+        self._indexar_asuntos("main", "idx_mensajes_destinatario_asunto")
+        # claves de idempotencia de los envíos: un reintento con la misma clave devuelve los ids del original
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS claves_idempotencia (
+                remitente_id INTEGER NOT NULL,
+                clave TEXT NOT NULL,
+                ids TEXT,
+                creada_ms INTEGER NOT NULL,
+                PRIMARY KEY (remitente_id, clave)
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_claves_idempotencia_creada ON claves_idempotencia(creada_ms)")
+        # huellas de los mensajes importados: no vencen, así reimportar el mismo archivo nunca duplica.
+        # Van con el destinatario para que refragmentar las lleve junto con su buzón
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS huellas_importacion (
+                huella BLOB PRIMARY KEY,
+                destinatario_id INTEGER NOT NULL
+            ) WITHOUT ROWID
+        """)
+        c.execute("CREATE INDEX IF NOT EXISTS idx_huellas_importacion_destinatario ON huellas_importacion(destinatario_id)")
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS listas_distribucion (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                propietario_id INTEGER NOT NULL,
+                nombre TEXT NOT NULL,
+                UNIQUE (propietario_id, nombre)
+            )
+        """)
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS lista_miembros (
+                lista_id INTEGER NOT NULL,
+                usuario_id INTEGER NOT NULL,
+                PRIMARY KEY (lista_id, usuario_id)
+            )
+        """)
+
+        # contadores por usuario, mantenidos por triggers (lectura O(1) con contadores(uid))
+        c.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'contadores'")
+        contadores_nuevos = c.fetchone() is None
+        c.execute("""
+            CREATE TABLE IF NOT EXISTS contadores (
+                usuario_id INTEGER PRIMARY KEY,
+                bandeja INTEGER NOT NULL DEFAULT 0,
+                no_leidos INTEGER NOT NULL DEFAULT 0,
+                prioritarios INTEGER NOT NULL DEFAULT 0,
+                papelera INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        for evento, filas in (("INSERT", (("NEW", "+"),)),
+                              ("DELETE", (("OLD", "-"),)),
+                              ("UPDATE OF remitente_id, destinatario_id, eliminado_ms, procesado_prioridad, leido, carpeta", (("OLD", "-"), ("NEW", "+")))):
+            cuerpo = ""
+            for r, signo in filas:
+                asignaciones = ", ".join(f"{k} = {k} {signo} {expr.format(r=r)}" for k, expr in _CONTADORES_DESTINATARIO.items())
+                cuerpo += f"""
+                INSERT OR IGNORE INTO contadores (usuario_id) VALUES ({r}.destinatario_id);
+                INSERT OR IGNORE INTO contadores (usuario_id) VALUES ({r}.remitente_id);
+                UPDATE contadores SET {asignaciones} WHERE usuario_id = {r}.destinatario_id;
+                UPDATE contadores SET papelera = papelera {signo} ({r}.eliminado_ms IS NOT NULL)
+                    WHERE usuario_id = {r}.remitente_id AND {r}.remitente_id != {r}.destinatario_id;
+                """
+            nombre = "trg_contadores_" + evento.split()[0].lower()
+            sql = f"CREATE TRIGGER {nombre} AFTER {evento} ON mensajes BEGIN {cuerpo} END"
+            c.execute("SELECT sql FROM sqlite_master WHERE type = 'trigger' AND name = ?", (nombre,))
+            actual = c.fetchone()
+            if actual is None or actual[0] != sql:
+                # definición nueva o cambiada (_CONTADORES_DESTINATARIO): se recrea y se recalcula
+                c.execute(f"DROP TRIGGER IF EXISTS {nombre}")
+                c.execute(sql)
+                contadores_nuevos = contadores_nuevos or actual is not None
+
+        # para código viejo que lee las fechas como texto ISO (hora local)
+        c.execute("""
+            CREATE VIEW IF NOT EXISTS mensajes_iso AS
+            SELECT m.*, strftime('%Y-%m-%dT%H:%M:%f', m.fecha_ms / 1000.0, 'unixepoch', 'localtime') AS fecha_envio,
+                   strftime('%Y-%m-%dT%H:%M:%f', m.eliminado_ms / 1000.0, 'unixepoch', 'localtime') AS eliminado_en
+            FROM mensajes m
+        """)
 
         self.conn.commit()
+        if contadores_nuevos:
+            self.recalcular_contadores()
+        if hilos_nuevos:
+            self.recalcular_hilos()
+
+    def _migrar_fechas(self, esquema):
+        """
+        Pasa fecha_envio/eliminado_en (texto ISO en hora local) de `esquema`.mensajes
+        a fecha_ms/eliminado_ms (enteros, ms desde 1970 en UTC) y borra las columnas
+        de texto. No hace nada si la tabla ya está migrada.
+        """
+        c = self.conn.cursor()
+        c.execute(f"PRAGMA {esquema}.table_info(mensajes)")
+        columnas = {r[1] for r in c.fetchall()}
+        viejas = [(texto, ms) for texto, ms in (("fecha_envio", "fecha_ms"), ("eliminado_en", "eliminado_ms")) if texto in columnas]
+        for _texto, ms in (("fecha_envio", "fecha_ms"), ("eliminado_en", "eliminado_ms")):
+            if ms not in columnas:
+                c.execute(f"ALTER TABLE {esquema}.mensajes ADD COLUMN {ms} INTEGER")
+        if not viejas:
+            return
+        for texto, ms in viejas:
+            c.execute(f"UPDATE {esquema}.mensajes SET {ms} = CAST(ROUND((julianday({texto}, 'utc') - 2440587.5) * 86400000) AS INTEGER) "
+                      f"WHERE {texto} IS NOT NULL AND {ms} IS NULL")
+            # lo que julianday no entiende (por ejemplo con zona horaria) se convierte en Python
+            c.execute(f"SELECT id, {texto} FROM {esquema}.mensajes WHERE {texto} IS NOT NULL AND {ms} IS NULL")
+            for mid, valor in c.fetchall():
+                try:
+                    c.execute(f"UPDATE {esquema}.mensajes SET {ms} = ? WHERE id = ?", (_a_ms(valor), mid))
+                except ValueError:
+                    pass
+        # DROP COLUMN no se permite mientras algún índice o trigger use la columna; los triggers se recrean después
+        c.execute(f"SELECT type, name FROM {esquema}.sqlite_master WHERE type IN ('index', 'trigger', 'view') "
+                  "AND (sql LIKE '%fecha_envio%' OR sql LIKE '%eliminado_en%')")
+        for tipo, nombre in c.fetchall():
+            c.execute(f"DROP {tipo.upper()} {esquema}.{nombre}")
+        for texto, _ms in viejas:
+            c.execute(f"ALTER TABLE {esquema}.mensajes DROP COLUMN {texto}")
+        self.conn.commit()
 
     # Usuarios
     def crear_usuario(self, nombre, correo, contraseña):
@@ -159,203 +855,3625 @@ class BaseDatos:
 
     # Mensajes
     def guardar_mensaje(self, mensaje: Mensaje, prioridad:int=5):
+        """
+        Guarda el mensaje y devuelve su id. Con mensaje.clave_idempotencia, si la
+        clave ya se usó (y no venció) no guarda nada y devuelve los ids de entonces.
+        """
+        # el hilo primero: buscar un original archivado hace commit (ATTACH), y la clave
+        # tiene que quedar en la misma transacción que el mensaje
+        hilo_id = self._hilo_de_respuesta(mensaje)
+        with self._deshacer_si_falla():
+            nueva, previo = self._reservar_clave(mensaje.remitente_id, mensaje.clave_idempotencia)
+            if not nueva:
+                if self._grupo is None:
+                    # el INSERT sin efecto igual abrió la transacción: se cierra para no retener el lock
+                    self.conn.commit()
+                return previo
+            c = self.conn.cursor()
+            cuerpo_json = json.dumps({"cuerpo": mensaje.cuerpo, "metadata": mensaje.metadata}, ensure_ascii=False)
+            contenido_id, cuerpo, formato = self._contenido_si_cuerpo_guardado(mensaje.asunto, cuerpo_json), None, None
+            if contenido_id is None:
+                cuerpo, formato = self._codificar_cuerpo(cuerpo_json)
+            c.execute(
+                "INSERT INTO mensajes (id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_ms, prioridad, cuerpo_formato, contenido_id, en_respuesta_a, hilo_id, carpeta) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self._nuevo_id(), mensaje.remitente_id, mensaje.destinatario_id, mensaje.asunto, cuerpo, mensaje.fecha_ms, prioridad, formato, contenido_id, mensaje.en_respuesta_a, hilo_id, mensaje.carpeta)
+            )
+            mid = c.lastrowid
+            if mensaje.adjuntos:
+                self._vincular_adjuntos(mid, mensaje.adjuntos)
+            self._completar_clave(mensaje.remitente_id, mensaje.clave_idempotencia, mid)
+            self._confirmar({mensaje.destinatario_id}, ("bandeja",), (mid, mid))
+        mensaje.hilo_id = hilo_id or mid
+        return mid
+
+    def guardar_mensaje_multiple(self, mensaje: Mensaje, destinatarios, prioridad:int=5):
+        """
+        Guarda un envío a varios destinatarios en una sola transacción: una fila en
+        `contenidos` con asunto y cuerpo, y una fila de entrega por destinatario.
+        Devuelve los ids de mensaje (uno por destinatario, en el mismo orden); con
+        una clave de idempotencia ya usada, los del envío original.
+        """
+        destinatarios = list(dict.fromkeys(destinatarios))
+        # antes de reservar la clave, como en guardar_mensaje
+        hilo_id = self._hilo_de_respuesta(mensaje)
+        with self._deshacer_si_falla():
+            nueva, previo = self._reservar_clave(mensaje.remitente_id, mensaje.clave_idempotencia)
+            if not nueva:
+                if self._grupo is None:
+                    # el INSERT sin efecto igual abrió la transacción: se cierra para no retener el lock
+                    self.conn.commit()
+                return previo
+            c = self.conn.cursor()
+            cuerpo_json = json.dumps({"cuerpo": mensaje.cuerpo, "metadata": mensaje.metadata}, ensure_ascii=False)
+            contenido_id = self._guardar_contenido(mensaje.asunto, cuerpo_json, len(destinatarios))
+            ids = []
+            for dest in destinatarios:
+                c.execute(
+                    "INSERT INTO mensajes (id, remitente_id, destinatario_id, asunto, fecha_ms, prioridad, contenido_id, en_respuesta_a, hilo_id, carpeta) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (self._nuevo_id(), mensaje.remitente_id, dest, mensaje.asunto, mensaje.fecha_ms, prioridad, contenido_id, mensaje.en_respuesta_a, hilo_id, mensaje.carpeta))
+                ids.append(c.lastrowid)
+                # todas las entregas de un envío nuevo abren el mismo hilo
+                hilo_id = hilo_id or c.lastrowid
+                if mensaje.adjuntos:
+                    self._vincular_adjuntos(c.lastrowid, mensaje.adjuntos)
+            self._completar_clave(mensaje.remitente_id, mensaje.clave_idempotencia, ids)
+            self._confirmar(set(destinatarios), ("bandeja",), (ids[0], ids[-1]))
+        return ids
+
+    @contextlib.contextmanager
+    def _deshacer_si_falla(self):
+        # Fuera de agrupar(), un guardado que falla a medias no deja filas ni la clave pendientes en la conexión
+        try:
+            yield
+        except BaseException:
+            if self._grupo is None:
+                self.conn.rollback()
+            raise
+
+    def usar_secuencia_propia(self, inicio, fin):
+        """
+        Numera los mensajes nuevos con un contador propio desde `inicio` en lugar
+        de AUTOINCREMENT: en un fragmento pueden quedar mensajes movidos desde otro,
+        que conservan su id, y con AUTOINCREMENT el próximo id seguiría al mayor de
+        ellos, dentro del rango de otro fragmento. No hace commit.
+        """
         c = self.conn.cursor()
-        cuerpo = json.dumps({"cuerpo": mensaje.cuerpo, "metadata": mensaje.metadata}, ensure_ascii=False)
-        c.execute(
-            "INSERT INTO mensajes (remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad) VALUES (?, ?, ?, ?, ?, ?)",
-            (mensaje.remitente_id, mensaje.destinatario_id, mensaje.asunto, cuerpo, mensaje.fecha_envio, prioridad)
-        )
-        self.conn.commit()
+        c.execute("CREATE TABLE IF NOT EXISTS secuencia_mensajes (seq INTEGER NOT NULL)")
+        # al convertir una base existente se sigue desde el mayor id que ya usó dentro del rango
+        c.execute("""
+            INSERT INTO secuencia_mensajes (seq)
+            SELECT MAX(?, COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'mensajes' AND seq < ?), 0),
+                       COALESCE((SELECT MAX(id) FROM mensajes WHERE id < ?), 0))
+            WHERE NOT EXISTS (SELECT 1 FROM secuencia_mensajes)
+        """, (inicio, fin, fin))
+        self._secuencia_propia = True
+
+    def _nuevo_id(self):
+        # None: lo numera AUTOINCREMENT
+        if not self._secuencia_propia:
+            return None
+        return self.conn.execute("UPDATE secuencia_mensajes SET seq = seq + 1 RETURNING seq").fetchone()[0]
+
+    def _ultimo_id(self):
+        # los ids nuevos son mayores que éste (con contador propio, dentro del rango del fragmento)
+        if self._secuencia_propia:
+            return self.conn.execute("SELECT seq FROM secuencia_mensajes").fetchone()[0]
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM mensajes").fetchone()[0]
+
+    def _guardar_contenido(self, asunto, cuerpo_json, entregas, cuerpo_id=None):
+        """
+        Inserta el contenido de un envío y devuelve su id. Cuerpos de `umbral_dedup`
+        bytes o más se guardan en `cuerpos` (compartidos), los demás en la fila; con
+        `cuerpo_id` usa ese cuerpo ya guardado. No hace commit.
+        """
+        cuerpo, formato = None, None
+        if cuerpo_id is None:
+            if self.umbral_dedup is not None and len(cuerpo_json) >= self.umbral_dedup:
+                cuerpo_id = self._guardar_cuerpo(cuerpo_json)
+            else:
+                cuerpo, formato = self._codificar_cuerpo(cuerpo_json)
+        c = self.conn.cursor()
+        c.execute("INSERT INTO contenidos (asunto, cuerpo_json, cuerpo_formato, entregas, cuerpo_id) VALUES (?, ?, ?, ?, ?)",
+                  (asunto, cuerpo, formato, entregas, cuerpo_id))
         return c.lastrowid
 
-    def obtener_mensajes_para_usuario(self, uid):
-        try:
-            self.limpiar_papelera()
-        except Exception:
-            pass
+    def _guardar_cuerpo(self, cuerpo_json, crear=True):
+        """
+        Id en `cuerpos` del cuerpo, buscado por su SHA-256 (índice único): si ya
+        estaba suma una referencia, si no lo inserta comprimido según el umbral
+        (con crear=False no lo inserta y devuelve None).
+        """
+        digest = hashlib.sha256(cuerpo_json.encode("utf-8")).digest()
+        c = self.conn.cursor()
+        c.execute("UPDATE cuerpos SET referencias = referencias + 1 WHERE hash = ? RETURNING id", (digest,))
+        row = c.fetchone()
+        if row:
+            return row[0]
+        if not crear:
+            return None
+        cuerpo, formato = self._codificar_cuerpo(cuerpo_json)
+        c.execute("INSERT INTO cuerpos (hash, cuerpo_json, cuerpo_formato, referencias) VALUES (?, ?, ?, 1)",
+                  (digest, cuerpo, formato))
+        return c.lastrowid
+
+    def _contenido_si_cuerpo_guardado(self, asunto, cuerpo_json):
+        # Una sola entrega: contenido propio sólo si el cuerpo ya está en `cuerpos`, si no va en la fila
+        if self.umbral_dedup is None or len(cuerpo_json) < self.umbral_dedup:
+            return None
+        cuerpo_id = self._guardar_cuerpo(cuerpo_json, crear=False)
+        return None if cuerpo_id is None else self._guardar_contenido(asunto, None, 1, cuerpo_id)
 
+    # Claves de idempotencia
+    def buscar_clave_idempotencia(self, remitente_id, clave, destinatarios=None):
+        """
+        Ids (uno o lista) guardados con esa clave del remitente, o None si no hay o
+        venció. `destinatarios` (los del envío) lo usa la base fragmentada para
+        buscar sólo en sus fragmentos.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT ids FROM claves_idempotencia WHERE remitente_id = ? AND clave = ? AND creada_ms >= ?",
+                  (remitente_id, clave, _ahora_ms() - self.ttl_idempotencia_ms))
+        row = c.fetchone()
+        return json.loads(row[0]) if row and row[0] is not None else None
+
+    def _reservar_clave(self, remitente_id, clave):
+        # Toma la clave del envío en la misma transacción que lo guarda (una clave vencida se reutiliza).
+        # Devuelve (True, None) si la tomó (o no hay clave) y (False, ids) si ya la tiene un envío
+        # vigente: no hay que guardar nada (ids es None si ese envío todavía no completó la clave).
+        if clave is None:
+            return True, None
+        ahora = _ahora_ms()
         c = self.conn.cursor()
         c.execute("""
-            SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad
-            FROM mensajes
-            WHERE destinatario_id = ? AND eliminado_en IS NULL AND (procesado_prioridad IS NULL OR procesado_prioridad = 0)
-            ORDER BY fecha_envio DESC
-        """, (uid,))
-        rows = c.fetchall()
-        resultado = []
-        for r in rows:
-            resultado.append(Mensaje.from_row(r))
-        return resultado
+            INSERT INTO claves_idempotencia (remitente_id, clave, ids, creada_ms) VALUES (?, ?, NULL, ?)
+            ON CONFLICT (remitente_id, clave) DO UPDATE SET ids = NULL, creada_ms = excluded.creada_ms
+            WHERE claves_idempotencia.creada_ms < ?
+        """, (remitente_id, clave, ahora, ahora - self.ttl_idempotencia_ms))
+        if c.rowcount:
+            return True, None
+        return False, self.buscar_clave_idempotencia(remitente_id, clave)
+
+    def _completar_clave(self, remitente_id, clave, ids):
+        if clave is not None:
+            self.conn.execute("UPDATE claves_idempotencia SET ids = ? WHERE remitente_id = ? AND clave = ?",
+                              (json.dumps(ids), remitente_id, clave))
+
+    def limpiar_claves_idempotencia(self):
+        # por idx_claves_idempotencia_creada: sólo recorre las vencidas
+        c = self.conn.cursor()
+        ahora = _ahora_ms()
+        c.execute("DELETE FROM claves_idempotencia WHERE creada_ms < ?", (ahora - self.ttl_idempotencia_ms,))
+        self.conn.commit()
+        self._proxima_limpieza_claves = ahora + INTERVALO_LIMPIEZA_CLAVES_MS
+        return c.rowcount
+
+    def _confirmar(self, uids, vistas, ids):
+        """
+        Cierra un guardado: resume en hilos las filas nuevas (ids = (primero, último)),
+        hace commit e invalida la caché. Dentro de agrupar() todo eso queda para el
+        final del grupo, con un único _actualizar_hilos sobre el rango de ids del grupo.
+        """
+        if self._grupo is not None:
+            self._grupo.append((uids, vistas))
+            desde, hasta = self._rango_grupo or ids
+            self._rango_grupo = (min(desde, ids[0]), max(hasta, ids[1]))
+            return
+        self._actualizar_hilos("main.mensajes", "id BETWEEN ? AND ?", ids)
+        self.conn.commit()
+        self.cache.invalidar(uids, vistas)
 
-    def buscar_mensajes(self, uid, criterio, valor):
+    @contextlib.contextmanager
+    def agrupar(self, mensajes=()):
+        """
+        Los guardar_mensaje/guardar_mensaje_multiple hechos dentro del bloque se
+        confirman con un solo commit al salir (con una excepción se deshacen todos).
+        La caché se invalida después del commit, para que ninguna lectura guarde
+        una bandeja sin los mensajes nuevos. `mensajes` son los que se van a
+        guardar: sus hilos se resuelven antes de abrir la transacción, porque
+        responder a un mensaje archivado necesita ATTACH.
+        """
+        self._hilos_resueltos = {m.en_respuesta_a: self._hilo_de_respuesta(m)
+                                 for m in mensajes if m.en_respuesta_a is not None}
+        self.conn.commit()
+        self._grupo, self._rango_grupo = [], None
         try:
-            self.limpiar_papelera()
-        except Exception:
-            pass
+            # transacción explícita: sin ella el primer SAVEPOINT abre una propia y su RELEASE confirma
+            self.conn.execute("BEGIN IMMEDIATE")
+            yield
+            # mientras dura la transacción nadie más escribe: el rango es sólo del grupo
+            if self._rango_grupo:
+                self._actualizar_hilos("main.mensajes", "id BETWEEN ? AND ?", self._rango_grupo)
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        finally:
+            pendientes, self._grupo, self._hilos_resueltos = self._grupo, None, {}
+            for uids, vistas in pendientes:
+                self.cache.invalidar(uids, vistas)
 
+    # Listas de distribución
+    def crear_lista(self, propietario_id, nombre, miembros):
         c = self.conn.cursor()
-        if criterio == "asunto":
-            c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE destinatario_id = ? AND eliminado_en IS NULL AND (procesado_prioridad IS NULL OR procesado_prioridad = 0) AND asunto LIKE ? ORDER BY fecha_envio DESC", (uid, f"%{valor}%"))
-        else:
-            c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE destinatario_id = ? AND eliminado_en IS NULL AND (procesado_prioridad IS NULL OR procesado_prioridad = 0) ORDER BY fecha_envio DESC", (uid,))
-        rows = c.fetchall()
-        resultado = []
-        for r in rows:
-            resultado.append(Mensaje.from_row(r))
-        return resultado
+        try:
+            c.execute("INSERT INTO listas_distribucion (propietario_id, nombre) VALUES (?, ?)", (propietario_id, nombre))
+        except sqlite3.IntegrityError:
+            return None
+        lista_id = c.lastrowid
+        c.executemany("INSERT OR IGNORE INTO lista_miembros (lista_id, usuario_id) VALUES (?, ?)",
+                      [(lista_id, uid) for uid in miembros])
+        self.conn.commit()
+        return lista_id
 
-    def obtener_mensajes_prioritarios(self, uid=None):
+    def obtener_lista(self, propietario_id, nombre):
         c = self.conn.cursor()
-        if uid is None:
-            c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE procesado_prioridad = 1 ORDER BY prioridad ASC, fecha_envio DESC")
-        else:
-            c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE destinatario_id = ? AND procesado_prioridad = 1 ORDER BY prioridad ASC, fecha_envio DESC", (uid,))
-        rows = c.fetchall()
-        resultado = []
-        for r in rows:
-            resultado.append(Mensaje.from_row(r))
-        return resultado
+        c.execute("SELECT id FROM listas_distribucion WHERE propietario_id = ? AND nombre = ?", (propietario_id, nombre))
+        row = c.fetchone()
+        return row[0] if row else None
 
-    def marcar_eliminado(self, mid):
+    def listar_listas(self, propietario_id):
         c = self.conn.cursor()
-        c.execute("UPDATE mensajes SET eliminado_en = ? WHERE id = ?", (datetime.datetime.now().isoformat(), mid))
-        self.conn.commit()
+        c.execute("SELECT id, nombre FROM listas_distribucion WHERE propietario_id = ? ORDER BY nombre", (propietario_id,))
+        return c.fetchall()
 
-    def recuperar_mensaje(self, mid):
+    def miembros_lista(self, lista_id):
         c = self.conn.cursor()
-        c.execute("UPDATE mensajes SET eliminado_en = NULL WHERE id = ?", (mid,))
+        c.execute("SELECT usuario_id FROM lista_miembros WHERE lista_id = ? ORDER BY usuario_id", (lista_id,))
+        return [r[0] for r in c.fetchall()]
+
+    # Reglas por usuario
+    def crear_regla(self, regla):
+        c = self.conn.cursor()
+        c.execute("INSERT INTO reglas (usuario_id, campo, patron, es_regex, accion, destino, orden, activa) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                  (regla.usuario_id, regla.campo, regla.patron, 1 if regla.es_regex else 0, regla.accion, regla.destino,
+                   regla.orden, 1 if regla.activa else 0))
         self.conn.commit()
+        regla.id_regla = c.lastrowid
+        return regla.id_regla
 
-    def marcar_prioritario(self, mid):
+    def obtener_reglas(self, uid, solo_activas=True):
+        return self.reglas_de_usuarios([uid], solo_activas).get(uid, [])
+
+    def reglas_de_usuarios(self, uids, solo_activas=True):
+        """Devuelve {usuario_id: [Regla]} en orden de evaluación (orden, id)."""
         c = self.conn.cursor()
-        c.execute("UPDATE mensajes SET procesado_prioridad = 1 WHERE id = ?", (mid,))
+        resultado = {}
+        for lote in self._por_lotes(uids):
+            marcas = ",".join("?" * len(lote))
+            c.execute(f"""
+                SELECT id, usuario_id, campo, patron, accion, destino, es_regex, orden, activa FROM reglas
+                WHERE usuario_id IN ({marcas}) {"AND activa = 1" if solo_activas else ""}
+                ORDER BY usuario_id, orden, id
+            """, lote)
+            for r in c.fetchall():
+                resultado.setdefault(r[1], []).append(Regla(*r))
+        return resultado
+
+    def borrar_regla(self, id_regla, uid):
+        c = self.conn.cursor()
+        c.execute("DELETE FROM reglas WHERE id = ? AND usuario_id = ?", (id_regla, uid))
         self.conn.commit()
+        return c.rowcount
+
+    def aplicar_reglas(self, coincidencias):
+        """
+        Aplica en bloque las acciones de [(mensaje_id, Regla)]: una operación
+        por acción (y por carpeta destino), no una por mensaje.
+        Devuelve {"papelera": n, "prioridad": n, "mover": n}.
+        """
+        por_accion = collections.defaultdict(list)
+        for mid, regla in coincidencias:
+            por_accion[(regla.accion, regla.destino if regla.accion == "mover" else None)].append(mid)
+        totales = {"papelera": 0, "prioridad": 0, "mover": 0}
+        for (accion, destino), ids in por_accion.items():
+            if accion == "papelera":
+                totales[accion] += self.marcar_eliminados(ids)
+            elif accion == "prioridad":
+                totales[accion] += self.marcar_prioritarios(ids)
+            elif accion == "mover":
+                totales[accion] += self.mover_a_carpeta(ids, destino)
+        return totales
+
+    def _codificar_cuerpo(self, cuerpo_json):
+        return comprimir_cuerpo(cuerpo_json, self.codec_compresion, self.umbral_compresion)
+
+    def comprimir_existentes(self, tam_lote=1000):
+        """
+        Migración: comprime en lotes los cuerpos ya guardados sin comprimir que
+        superan el umbral. Una transacción por lote; se puede cortar y repetir.
+        """
+        if self.codec_compresion is None:
+            return 0
+        c = self.conn.cursor()
+        total = 0
+        for tabla in ("mensajes", "contenidos", "cuerpos"):
+            ultimo = 0
+            while True:
+                c.execute(
+                    f"SELECT id, cuerpo_json FROM {tabla} WHERE id > ? AND cuerpo_formato IS NULL AND length(CAST(cuerpo_json AS BLOB)) >= ? ORDER BY id LIMIT ?",
+                    (ultimo, self.umbral_compresion, tam_lote))
+                rows = c.fetchall()
+                if not rows:
+                    break
+                cambios = []
+                for mid, cuerpo_json in rows:
+                    valor, formato = self._codificar_cuerpo(cuerpo_json)
+                    if formato is not None:
+                        cambios.append((valor, formato, mid))
+                c.executemany(f"UPDATE {tabla} SET cuerpo_json = ?, cuerpo_formato = ? WHERE id = ?", cambios)
+                self.conn.commit()
+                total += len(cambios)
+                ultimo = rows[-1][0]
+        return total
+
+    def obtener_mensajes_para_usuario(self, uid, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        """
+        Bandeja de entrada; `desde`/`hasta` (ms, datetime o ISO) limitan fecha_envio
+        a [desde, hasta) y `orden` es (clave de ORDENES_MENSAJES, descendente).
+        """
+        try:
+            self.limpiar_papelera()
+        except Exception:
+            pass
+
+        where = "destinatario_id = ? AND eliminado_ms IS NULL AND (procesado_prioridad IS NULL OR procesado_prioridad = 0) AND carpeta IS NULL"
+        orden_sql = _orden_sql(orden, "fecha_ms DESC")
+        if desde is not None or hasta is not None or orden is not None:
+            # la caché guarda sólo la primera página sin filtros ni orden propio
+            return self._consultar_particiones(where, (uid,), orden_sql, limite, offset, (desde, hasta))
+        return self._leer_con_cache("bandeja", uid, limite, offset, lambda: self._consultar_particiones(
+            where, (uid,), orden_sql, limite, offset))
+
+    def _where_busqueda(self, uid, criterio, valor):
+        where = "destinatario_id = ? AND eliminado_ms IS NULL AND (procesado_prioridad IS NULL OR procesado_prioridad = 0) AND carpeta IS NULL"
+        params = (uid,)
+        if criterio == "asunto":
+            where += " AND asunto LIKE ?"
+            params = (uid, f"%{valor}%")
+        return where, params
+
+    def buscar_mensajes(self, uid, criterio, valor, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        try:
+            self.limpiar_papelera()
+        except Exception:
+            pass
+
+        where, params = self._where_busqueda(uid, criterio, valor)
+        return self._consultar_particiones(where, params, _orden_sql(orden, "fecha_ms DESC"), limite, offset, (desde, hasta))
+
+    def contar_busqueda(self, uid, criterio, valor, desde=None, hasta=None):
+        where, params = self._where_busqueda(uid, criterio, valor)
+        return self._contar_particiones(where, params, (desde, hasta))
+
+    def obtener_mensajes_prioritarios(self, uid=None, limite=None, offset=0, orden=None):
+        orden_sql = _orden_sql(orden, "prioridad ASC, fecha_ms DESC")
+        if uid is None:
+            consultar = lambda: self._consultar_particiones("procesado_prioridad = 1", (), orden_sql, limite, offset)
+        else:
+            consultar = lambda: self._consultar_particiones("destinatario_id = ? AND procesado_prioridad = 1", (uid,), orden_sql, limite, offset)
+        if orden is not None:
+            return consultar()
+        return self._leer_con_cache("prioritarios", uid, limite, offset, consultar)
+
+    def _leer_con_cache(self, vista, uid, limite, offset, consultar):
+        # Sólo se cachea la primera página; la generación evita guardar un resultado leído antes de una escritura
+        if offset:
+            return consultar()
+        clave = (vista, uid, limite)
+        resultado = self.cache.obtener(clave)
+        if resultado is None:
+            generacion = self.cache.generacion(vista, uid)
+            resultado = consultar()
+            self.cache.guardar(clave, resultado, generacion)
+        return list(resultado)
+
+    def _invalidar_mensaje(self, mid, vistas=VISTAS_CACHE):
+        # Invalida las vistas del remitente y del destinatario de `mid` (llamar antes de borrarlo)
+        c = self.conn.cursor()
+        c.execute("SELECT remitente_id, destinatario_id FROM mensajes WHERE id = ?", (mid,))
+        row = c.fetchone()
+        if row is None:
+            # mensaje archivado o inexistente: no vale la pena buscarlo en cada archivo
+            self.cache.limpiar()
+            return
+        self.cache.invalidar(set(row), vistas)
+
+    def obtener_mensaje(self, mid):
+        # Busca por id en la tabla caliente y, si no está, en los archivos
+        c = self.conn.cursor()
+        c.execute(f"SELECT {COLUMNAS_MENSAJE} FROM {_vista_mensajes('main.mensajes')} WHERE id = ?", (mid,))
+        row = c.fetchone()
+        if not row:
+            for _mes, ruta in self.listar_archivos():
+                with self._archivo_adjunto(ruta) as esquema:
+                    c.execute(f"SELECT {COLUMNAS_MENSAJE} FROM {_vista_mensajes(esquema + '.mensajes')} WHERE id = ?", (mid,))
+                    row = c.fetchone()
+                if row:
+                    break
+        if not row:
+            return None
+        m = Mensaje.from_row(row)
+        m.adjuntos = self.obtener_adjuntos(mid)
+        return m
+
+    def marcar_eliminado(self, mid):
+        # La papelera vive sólo en la tabla caliente: si el mensaje estaba archivado, vuelve primero
+        self._traer_de_archivo(mid)
+        c = self.conn.cursor()
+        c.execute("UPDATE mensajes SET eliminado_ms = ? WHERE id = ?", (_ahora_ms(), mid))
+        self.conn.commit()
+        self._invalidar_mensaje(mid)
+
+    def recuperar_mensaje(self, mid):
+        c = self.conn.cursor()
+        c.execute("UPDATE mensajes SET eliminado_ms = NULL WHERE id = ?", (mid,))
+        self.conn.commit()
+        self._invalidar_mensaje(mid)
+
+    def marcar_prioritario(self, mid):
+        self._ejecutar_por_id("UPDATE {tabla} SET procesado_prioridad = 1 WHERE id = ?", (mid,))
+        self._invalidar_mensaje(mid, ("bandeja", "prioritarios"))
+
+    def desmarcar_prioritario(self, mid):
+        self._ejecutar_por_id("UPDATE {tabla} SET procesado_prioridad = 0 WHERE id = ?", (mid,))
+        self._invalidar_mensaje(mid, ("bandeja", "prioritarios"))
+
+    def borrar_mensaje_definitivo(self, mid):
+        # mismo camino que el borrado en bloque: libera adjuntos y contenido compartido, e invalida la caché
+        self.borrar_mensajes([mid])
+
+    def limpiar_papelera(self):
+        # las claves de idempotencia vencidas se purgan con su propio intervalo, haya o no papelera vencida
+        if _ahora_ms() >= self._proxima_limpieza_claves:
+            self.limpiar_claves_idempotencia()
+        c = self.conn.cursor()
+        limite = _ahora_ms() - int(datetime.timedelta(days=4, hours=20).total_seconds() * 1000)
+        # por idx_mensajes_eliminado: sin vencidos la consulta no recorre la tabla
+        vencidos = "SELECT id FROM mensajes WHERE eliminado_ms < ?"
+        c.execute("SELECT DISTINCT remitente_id, destinatario_id FROM mensajes WHERE eliminado_ms < ?", (limite,))
+        afectados = {uid for par in c.fetchall() for uid in par}
+        if not afectados:
+            return
+        self._liberar_referencias(vencidos, (limite,))
+        c.execute("DELETE FROM mensajes WHERE eliminado_ms < ?", (limite,))
+        self.conn.commit()
+        self.cache.invalidar(afectados)
+        self.recolectar_adjuntos()
+
+    # Operaciones en bloque (una transacción, listas IN de a LOTE_IN ids)
+    def _por_lotes(self, ids, tam=None):
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        tam = tam or LOTE_IN
+        for i in range(0, len(ids), tam):
+            yield ids[i:i + tam]
+
+    def _actualizar_en_bloque(self, ids, sql, params=(), vistas=VISTAS_CACHE, liberar_adjuntos=False):
+        """
+        Ejecuta `sql` (con {marcas} en el IN) sobre la tabla caliente para todos
+        los ids en una sola transacción. Devuelve (filas afectadas, ids que no
+        estaban en la tabla caliente) para que el llamador resuelva los archivados.
+        """
+        c = self.conn.cursor()
+        afectados, faltantes, total = set(), [], 0
+        for lote in self._por_lotes(ids):
+            marcas = ",".join("?" * len(lote))
+            c.execute(f"SELECT id, remitente_id, destinatario_id FROM mensajes WHERE id IN ({marcas})", lote)
+            filas = c.fetchall()
+            encontrados = {r[0] for r in filas}
+            afectados.update(u for r in filas for u in r[1:])
+            faltantes.extend(i for i in lote if i not in encontrados)
+            if liberar_adjuntos:
+                self._liberar_referencias(marcas, lote)
+            c.execute(sql.format(marcas=marcas), tuple(params) + tuple(lote))
+            total += c.rowcount
+        self.conn.commit()
+        self.cache.invalidar(afectados, vistas)
+        return total, faltantes
+
+    def marcar_eliminados(self, ids):
+        sql = "UPDATE mensajes SET eliminado_ms = ? WHERE id IN ({marcas})"
+        ahora = (_ahora_ms(),)
+        total, faltantes = self._actualizar_en_bloque(ids, sql, ahora)
+        if faltantes:
+            # la papelera vive en la tabla caliente: los archivados vuelven primero
+            traidos = self._traer_de_archivos(faltantes)
+            if traidos:
+                total += self._actualizar_en_bloque(traidos, sql, ahora)[0]
+        return total
+
+    def recuperar_mensajes(self, ids):
+        # la papelera sólo vive en la tabla caliente, no hay archivados que resolver
+        total, _faltantes = self._actualizar_en_bloque(ids, "UPDATE mensajes SET eliminado_ms = NULL WHERE id IN ({marcas})")
+        return total
+
+    def marcar_prioritarios(self, ids):
+        total, faltantes = self._actualizar_en_bloque(
+            ids, "UPDATE mensajes SET procesado_prioridad = 1 WHERE id IN ({marcas})", vistas=("bandeja", "prioritarios"))
+        if faltantes:
+            total += self._actualizar_en_archivos(faltantes, "UPDATE {tabla} SET procesado_prioridad = 1 WHERE id IN ({marcas})")
+        return total
+
+    def mover_a_carpeta(self, ids, carpeta):
+        # carpeta None devuelve los mensajes a la bandeja de entrada
+        total, faltantes = self._actualizar_en_bloque(
+            ids, "UPDATE mensajes SET carpeta = ? WHERE id IN ({marcas})", (carpeta,), vistas=("bandeja",))
+        if faltantes:
+            total += self._actualizar_en_archivos(faltantes, "UPDATE {tabla} SET carpeta = ? WHERE id IN ({marcas})", (carpeta,))
+        return total
+
+    def borrar_mensajes(self, ids):
+        total, faltantes = self._actualizar_en_bloque(ids, "DELETE FROM mensajes WHERE id IN ({marcas})", liberar_adjuntos=True)
+        if faltantes:
+            total += self._actualizar_en_archivos(faltantes, "DELETE FROM {tabla} WHERE id IN ({marcas})", liberar_adjuntos=True)
+        self.recolectar_adjuntos()
+        return total
+
+    def eliminar_usuario(self, uid, tam_lote=500, pausa=0.01, progreso=None):
+        """
+        Borra el usuario y, por tandas de `tam_lote`, todos sus mensajes enviados
+        y recibidos (también los archivados). Cada tanda es una transacción corta
+        y entre tandas se cede el lock de escritura (`pausa` segundos).
+        `progreso(borrados)` se llama después de cada tanda.
+        """
+        c = self.conn.cursor()
+        # primero la cuenta, así desaparece enseguida aunque queden mensajes por borrar
+        c.execute("DELETE FROM usuarios WHERE id = ?", (uid,))
+        self.conn.commit()
+        borrados = 0
+        while True:
+            c.execute("SELECT id FROM mensajes WHERE remitente_id = ? OR destinatario_id = ? LIMIT ?", (uid, uid, tam_lote))
+            ids = [r[0] for r in c.fetchall()]
+            if not ids:
+                break
+            borrados += self._actualizar_en_bloque(ids, "DELETE FROM mensajes WHERE id IN ({marcas})", liberar_adjuntos=True)[0]
+            if progreso:
+                progreso(borrados)
+            time.sleep(pausa)
+        for _mes, ruta in self.listar_archivos():
+            while True:
+                with self._archivo_adjunto(ruta) as esquema:
+                    tabla = f"{esquema}.mensajes"
+                    c.execute(f"SELECT id FROM {tabla} WHERE remitente_id = ? OR destinatario_id = ? LIMIT ?", (uid, uid, tam_lote))
+                    ids = [r[0] for r in c.fetchall()]
+                    if ids:
+                        marcas = ",".join("?" * len(ids))
+                        self._ajustar_contadores(tabla, f"id IN ({marcas})", ids, -1)
+                        self._liberar_referencias(marcas, ids, tabla)
+                        c.execute(f"DELETE FROM {tabla} WHERE id IN ({marcas})", ids)
+                        self.conn.commit()
+                if not ids:
+                    break
+                borrados += len(ids)
+                if progreso:
+                    progreso(borrados)
+                time.sleep(pausa)
+        c.execute("DELETE FROM contadores WHERE usuario_id = ?", (uid,))
+        c.execute("DELETE FROM huellas_importacion WHERE destinatario_id = ?", (uid,))
+        self.conn.commit()
+        self.cache.limpiar()
+        self.recolectar_adjuntos()
+        return borrados
+
+    def conexion_de_trabajo(self):
+        """
+        Otra BaseDatos sobre el mismo archivo, para un hilo de fondo (sqlite3 no
+        comparte una conexión entre hilos que escriben). Comparte la caché, así
+        sus escrituras invalidan lo que lee la interfaz. La cierra quien la pidió.
+        """
+        db = BaseDatos(self.db_file, self.codec_compresion, self.umbral_compresion, self.adjuntos.raiz,
+                       self.umbral_dedup, self.ttl_idempotencia_ms)
+        db.cache = self.cache
+        return db
+
+    def eliminar_usuario_en_segundo_plano(self, uid, al_terminar=None, **kwargs):
+        """
+        Corre eliminar_usuario en un hilo con su propia conexión (comparte caché y
+        almacén de adjuntos con esta instancia). `al_terminar(borrados)` se llama
+        desde ese hilo.
+        """
+        def trabajo():
+            db = self.conexion_de_trabajo()
+            try:
+                borrados = db.eliminar_usuario(uid, **kwargs)
+            finally:
+                db.conn.close()
+            if al_terminar:
+                al_terminar(borrados)
+
+        hilo = threading.Thread(target=trabajo, daemon=True)
+        hilo.start()
+        return hilo
+
+    def obtener_mensajes_papelera(self, uid, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        """
+        Devuelve la lista de Mensaje que están en la papelera para el usuario dado.
+        La columna en la tabla es `eliminado_ms` (ms desde 1970) — si NO es NULL, está en papelera.
+        Considera tanto mensajes enviados como recibidos por el usuario.
+        `desde`/`hasta` y `orden` funcionan como en la bandeja.
+        """
+        where = "(remitente_id = ? OR destinatario_id = ?) AND eliminado_ms IS NOT NULL"
+        orden_sql = _orden_sql(orden, "fecha_ms DESC")
+        if desde is not None or hasta is not None or orden is not None:
+            return self._consultar_particiones(where, (uid, uid), orden_sql, limite, offset, (desde, hasta))
+        return self._leer_con_cache("papelera", uid, limite, offset, lambda: self._consultar_particiones(
+            where, (uid, uid), orden_sql, limite, offset))
+
+    def obtener_mensajes_carpeta(self, uid, carpeta, limite=None, offset=0):
+        return self._consultar_particiones(
+            "destinatario_id = ? AND carpeta = ? AND eliminado_ms IS NULL", (uid, carpeta), "fecha_ms DESC", limite, offset)
+
+    def listar_carpetas(self, uid):
+        """Devuelve [(carpeta, cantidad)] de los mensajes del usuario movidos por reglas."""
+        c = self.conn.cursor()
+        sql = "SELECT carpeta, COUNT(*) FROM {tabla} WHERE destinatario_id = ? AND carpeta IS NOT NULL AND eliminado_ms IS NULL GROUP BY carpeta"
+        totales = collections.Counter()
+        c.execute(sql.format(tabla="main.mensajes"), (uid,))
+        totales.update(dict(c.fetchall()))
+        for _mes, ruta in self.listar_archivos():
+            with self._archivo_adjunto(ruta) as esquema:
+                c.execute(sql.format(tabla=f"{esquema}.mensajes"), (uid,))
+                totales.update(dict(c.fetchall()))
+        return sorted(totales.items())
+
+    # Contadores de buzón
+    def contadores(self, uid):
+        """Devuelve {"bandeja", "no_leidos", "prioritarios", "papelera"} sin recorrer el buzón."""
+        c = self.conn.cursor()
+        c.execute("SELECT bandeja, no_leidos, prioritarios, papelera FROM contadores WHERE usuario_id = ?", (uid,))
+        row = c.fetchone() or (0, 0, 0, 0)
+        return dict(zip(("bandeja", "no_leidos", "prioritarios", "papelera"), row))
+
+    def marcar_leido(self, mid, leido=True):
+        self._ejecutar_por_id("UPDATE {tabla} SET leido = ? WHERE id = ?", (1 if leido else 0, mid))
+        self._invalidar_mensaje(mid, ("bandeja",))
+
+    def _ajustar_contadores(self, tabla, where, params, signo):
+        """
+        Suma (signo=1) o resta (signo=-1) a los contadores el aporte de las filas
+        de `tabla` que cumplen `where`. Sirve para tablas sin triggers (archivos)
+        y para compensar los triggers cuando una fila sólo cambia de partición.
+        No hace commit.
+        """
+        c = self.conn.cursor()
+        params = tuple(params)
+        c.execute(f"INSERT OR IGNORE INTO contadores (usuario_id) SELECT destinatario_id FROM {tabla} WHERE {where} "
+                  f"UNION SELECT remitente_id FROM {tabla} WHERE {where}", params * 2)
+        columnas = list(_CONTADORES_DESTINATARIO)
+        sumas = ", ".join(f"SUM({_CONTADORES_DESTINATARIO[k].format(r='m')}) AS {k}" for k in columnas)
+        asignaciones = ", ".join(f"{k} = contadores.{k} + ? * t.{k}" for k in columnas)
+        c.execute(f"""
+            UPDATE contadores SET {asignaciones}
+            FROM (SELECT destinatario_id AS uid, {sumas} FROM {tabla} m WHERE {where} GROUP BY destinatario_id) AS t
+            WHERE contadores.usuario_id = t.uid
+        """, (signo,) * len(columnas) + params)
+        c.execute(f"""
+            UPDATE contadores SET papelera = contadores.papelera + ? * t.papelera
+            FROM (SELECT remitente_id AS uid, SUM(m.eliminado_ms IS NOT NULL) AS papelera FROM {tabla} m
+                  WHERE ({where}) AND remitente_id != destinatario_id GROUP BY remitente_id) AS t
+            WHERE contadores.usuario_id = t.uid
+        """, (signo,) + params)
+
+    def recalcular_contadores(self):
+        """Reconstruye la tabla contadores desde cero (tabla caliente + archivos)."""
+        c = self.conn.cursor()
+        c.execute("DELETE FROM contadores")
+        self._ajustar_contadores("main.mensajes", "1", (), 1)
+        self.conn.commit()
+        for _mes, ruta in self.listar_archivos():
+            with self._archivo_adjunto(ruta) as esquema:
+                self._ajustar_contadores(f"{esquema}.mensajes", "1", (), 1)
+                self.conn.commit()
+
+    # Conversaciones (hilos)
+    def _hilo_de_respuesta(self, mensaje):
+        # Un mensaje que responde a otro entra en el hilo de ése; si no, abre uno nuevo (None)
+        if mensaje.en_respuesta_a is None:
+            return None
+        if mensaje.hilo_id is not None:
+            # ya resuelto por quien lo envía (BaseDatosFragmentada, si el original está en otro fragmento)
+            return mensaje.hilo_id
+        if mensaje.en_respuesta_a in self._hilos_resueltos:
+            return self._hilos_resueltos[mensaje.en_respuesta_a]
+        original = self.obtener_mensaje(mensaje.en_respuesta_a)
+        if original is None:
+            return None
+        return original.hilo_id or original.id_mensaje
+
+    def _actualizar_hilos(self, tabla, where, params):
+        """
+        Suma a los resúmenes de hilos las filas de `tabla` que cumplen `where`
+        (recién insertadas); las que no tienen hilo abren uno propio. Las entregas
+        de un mismo contenido cuentan como un solo mensaje. No hace commit.
+        """
+        c = self.conn.cursor()
+        params = tuple(params)
+        c.execute(f"UPDATE {tabla} SET hilo_id = id WHERE hilo_id IS NULL AND ({where})", params)
+        clave = "COALESCE('c' || contenido_id, id)"
+        # con un único MAX(), SQLite toma asunto e id de la fila con la fecha máxima;
+        # el asunto del hilo es el del mensaje que lo abrió (id = hilo_id) si está en el lote
+        c.execute(f"""
+            INSERT INTO hilos (id, asunto, ultimo_mensaje_id, ultima_fecha, cantidad, participantes)
+            SELECT g.hilo_id, COALESCE(r.asunto, g.asunto), g.id, g.fecha, g.cantidad, 0
+            FROM (SELECT hilo_id, asunto, id, MAX(fecha_ms) AS fecha, COUNT(DISTINCT {clave}) AS cantidad
+                  FROM {_vista_mensajes(tabla)} WHERE {where} GROUP BY hilo_id) g
+            LEFT JOIN {_vista_mensajes(tabla)} r ON r.id = g.hilo_id
+            WHERE 1
+            ON CONFLICT(id) DO UPDATE SET
+                ultimo_mensaje_id = CASE WHEN excluded.ultima_fecha >= hilos.ultima_fecha
+                                         THEN excluded.ultimo_mensaje_id ELSE hilos.ultimo_mensaje_id END,
+                ultima_fecha = MAX(hilos.ultima_fecha, excluded.ultima_fecha),
+                cantidad = hilos.cantidad + excluded.cantidad
+        """, params)
+        c.execute(f"""
+            INSERT INTO hilo_participantes (hilo_id, usuario_id, ultimo_mensaje_id, ultima_fecha, cantidad)
+            SELECT hilo_id, uid, id, MAX(fecha_ms), COUNT(DISTINCT clave) FROM (
+                SELECT hilo_id, destinatario_id AS uid, id, fecha_ms, {clave} AS clave FROM {tabla} WHERE {where}
+                UNION ALL
+                SELECT hilo_id, remitente_id, id, fecha_ms, {clave} FROM {tabla} WHERE ({where}) AND remitente_id != destinatario_id
+            ) WHERE 1 GROUP BY hilo_id, uid
+            ON CONFLICT(hilo_id, usuario_id) DO UPDATE SET
+                ultimo_mensaje_id = CASE WHEN excluded.ultima_fecha >= hilo_participantes.ultima_fecha
+                                         THEN excluded.ultimo_mensaje_id ELSE hilo_participantes.ultimo_mensaje_id END,
+                ultima_fecha = MAX(hilo_participantes.ultima_fecha, excluded.ultima_fecha),
+                cantidad = hilo_participantes.cantidad + excluded.cantidad
+        """, params * 2)
+        c.execute(f"""
+            UPDATE hilos SET participantes = (SELECT COUNT(*) FROM hilo_participantes hp WHERE hp.hilo_id = hilos.id)
+            WHERE id IN (SELECT hilo_id FROM {tabla} WHERE {where})
+        """, params)
+
+    def _descontar_hilos(self, subconsulta_ids, params, tabla="main.mensajes"):
+        """
+        Descuenta de los resúmenes las filas de `tabla` que se van a borrar para
+        siempre. Se llama después de descontar `contenidos.entregas`: el remitente
+        de un envío múltiple pierde el mensaje recién cuando no quedan entregas.
+        No hace commit.
+        """
+        c = self.conn.cursor()
+        c.execute(f"""
+            SELECT m.hilo_id, m.remitente_id, m.destinatario_id, m.contenido_id, co.entregas
+            FROM {tabla} m LEFT JOIN main.contenidos co ON co.id = m.contenido_id
+            WHERE m.id IN ({subconsulta_ids}) AND m.hilo_id IS NOT NULL
+        """, params)
+        por_usuario, por_hilo, contenidos = collections.Counter(), collections.Counter(), set()
+        for hilo_id, remitente, destinatario, contenido_id, entregas in c.fetchall():
+            if remitente != destinatario:
+                por_usuario[(hilo_id, destinatario)] += 1
+            if contenido_id is not None:
+                if entregas > 0 or contenido_id in contenidos:
+                    continue
+                contenidos.add(contenido_id)
+            por_hilo[hilo_id] += 1
+            por_usuario[(hilo_id, remitente)] += 1
+        if not por_usuario:
+            return
+        c.executemany("UPDATE hilo_participantes SET cantidad = cantidad - ? WHERE hilo_id = ? AND usuario_id = ?",
+                      [(n, h, u) for (h, u), n in por_usuario.items()])
+        c.executemany("UPDATE hilos SET cantidad = cantidad - ? WHERE id = ?", [(n, h) for h, n in por_hilo.items()])
+        # si se borra el último mensaje, pasa a serlo el más reciente que queda en la tabla caliente
+        # (los archivados son más viejos; recalcular_hilos los considera)
+        otro = f"FROM main.mensajes m WHERE m.hilo_id = {{hilo}} AND m.id NOT IN ({subconsulta_ids})"
+        del_usuario = otro.format(hilo="hilo_participantes.hilo_id") + \
+            " AND (m.destinatario_id = hilo_participantes.usuario_id OR m.remitente_id = hilo_participantes.usuario_id)"
+        del_hilo = otro.format(hilo="hilos.id")
+        params = tuple(params)
+        for lote in self._por_lotes({h for h, _u in por_usuario}):
+            marcas = ",".join("?" * len(lote))
+            c.execute(f"""
+                UPDATE hilo_participantes SET (ultimo_mensaje_id, ultima_fecha) = (SELECT id, MAX(fecha_ms) {del_usuario})
+                WHERE hilo_id IN ({marcas}) AND ultimo_mensaje_id IN ({subconsulta_ids}) AND EXISTS (SELECT 1 {del_usuario})
+            """, params + tuple(lote) + params * 2)
+            c.execute(f"""
+                UPDATE hilos SET (ultimo_mensaje_id, ultima_fecha) = (SELECT id, MAX(fecha_ms) {del_hilo})
+                WHERE id IN ({marcas}) AND ultimo_mensaje_id IN ({subconsulta_ids}) AND EXISTS (SELECT 1 {del_hilo})
+            """, params + tuple(lote) + params * 2)
+            c.execute(f"DELETE FROM hilo_participantes WHERE hilo_id IN ({marcas}) AND cantidad <= 0", lote)
+            c.execute(f"DELETE FROM hilos WHERE id IN ({marcas}) AND cantidad <= 0", lote)
+            c.execute(f"""
+                UPDATE hilos SET participantes = (SELECT COUNT(*) FROM hilo_participantes hp WHERE hp.hilo_id = hilos.id)
+                WHERE id IN ({marcas})
+            """, lote)
+
+    def recalcular_hilos(self):
+        """
+        Reconstruye hilos y hilo_participantes desde cero. Las filas de la tabla
+        caliente y de los archivos (sin cuerpos) se juntan en una tabla temporal,
+        así las entregas de un mismo envío repartidas entre particiones cuentan una vez.
+        """
+        c = self.conn.cursor()
+        columnas = COLUMNAS_MENSAJE.replace("cuerpo_json, ", "")
+        c.execute("DROP TABLE IF EXISTS temp.hilos_recalculo")
+        c.execute(f"CREATE TEMP TABLE hilos_recalculo AS SELECT {COLUMNAS_MENSAJE} FROM main.mensajes WHERE 0")
+        # los mensajes anteriores a los hilos abren uno propio
+        c.execute("UPDATE main.mensajes SET hilo_id = id WHERE hilo_id IS NULL")
+        c.execute(f"INSERT INTO temp.hilos_recalculo ({columnas}) SELECT {columnas} FROM main.mensajes")
+        for _mes, ruta in self.listar_archivos():
+            with self._archivo_adjunto(ruta) as esquema:
+                c.execute(f"UPDATE {esquema}.mensajes SET hilo_id = id WHERE hilo_id IS NULL")
+                c.execute(f"INSERT INTO temp.hilos_recalculo ({columnas}) SELECT {columnas} FROM {esquema}.mensajes")
+        c.execute("DELETE FROM hilos")
+        c.execute("DELETE FROM hilo_participantes")
+        self._actualizar_hilos("temp.hilos_recalculo", "1", ())
+        c.execute("DROP TABLE temp.hilos_recalculo")
+        self.conn.commit()
+
+    def obtener_hilos(self, uid, limite=None, offset=0, hilos=None):
+        """
+        Conversaciones del usuario, la de actividad más reciente primero, leídas
+        del resumen por el índice (usuario_id, ultima_fecha). Cada una es un dict
+        con hilo_id, asunto, ultimo_mensaje_id y ultima_fecha (texto ISO; vistos por
+        el usuario), mensajes (los suyos), mensajes_total y participantes.
+        `hilos` limita el resultado a esos ids.
+        """
+        c = self.conn.cursor()
+        filtro, params = "", ()
+        if hilos is not None:
+            filtro = f" AND hp.hilo_id IN ({','.join('?' * len(hilos))})"
+            params = tuple(hilos)
+        c.execute(f"""
+            SELECT h.id, h.asunto, hp.ultimo_mensaje_id, hp.ultima_fecha, hp.cantidad, h.cantidad, h.participantes
+            FROM hilo_participantes hp JOIN hilos h ON h.id = hp.hilo_id
+            WHERE hp.usuario_id = ?{filtro}
+            ORDER BY hp.ultima_fecha DESC, hp.hilo_id DESC
+            LIMIT ? OFFSET ?
+        """, (uid,) + params + (-1 if limite is None else limite, offset))
+        claves = ("hilo_id", "asunto", "ultimo_mensaje_id", "ultima_fecha", "mensajes", "mensajes_total", "participantes")
+        hilos = [dict(zip(claves, r)) for r in c.fetchall()]
+        for h in hilos:
+            h["ultima_fecha"] = _ms_a_iso(h["ultima_fecha"])
+        return hilos
+
+    def participantes_hilo(self, hilo_id):
+        c = self.conn.cursor()
+        c.execute("SELECT usuario_id FROM hilo_participantes WHERE hilo_id = ? ORDER BY usuario_id", (hilo_id,))
+        return [r[0] for r in c.fetchall()]
+
+    def obtener_hilo(self, hilo_id, uid=None):
+        """Mensajes del hilo en orden cronológico (sólo los que ve `uid`, si se indica)."""
+        where, params = "hilo_id = ?", (hilo_id,)
+        if uid is not None:
+            where += " AND (remitente_id = ? OR destinatario_id = ?)"
+            params += (uid, uid)
+        mensajes = self._consultar_particiones(where, params, "fecha_ms")
+        # cada partición viene ordenada, pero se concatenan de la más nueva a la más vieja
+        mensajes.sort(key=lambda m: (m.fecha_ms, m.id_mensaje))
+        return mensajes
+
+    # Adjuntos
+    def _vincular_adjuntos(self, mid, adjuntos):
+        # Se llama dentro de la transacción del INSERT del mensaje
+        c = self.conn.cursor()
+        for a in adjuntos:
+            c.execute(
+                "INSERT INTO adjuntos (sha256, tamaño, referencias) VALUES (?, ?, 1) "
+                "ON CONFLICT(sha256) DO UPDATE SET referencias = referencias + 1",
+                (a["sha256"], a["tamaño"]))
+            c.execute("INSERT INTO mensaje_adjuntos (mensaje_id, sha256, nombre, tipo) VALUES (?, ?, ?, ?)",
+                      (mid, a["sha256"], a["nombre"], a.get("tipo")))
+
+    def copiar_adjunto(self, mid, sha256, destino):
+        # el mensaje se pasa para que la base fragmentada busque el blob en el almacén de su fragmento
+        self.adjuntos.copiar_a(sha256, destino)
+
+    def obtener_adjuntos(self, mid):
+        c = self.conn.cursor()
+        c.execute("""
+            SELECT ma.sha256, ma.nombre, a.tamaño, ma.tipo
+            FROM mensaje_adjuntos ma JOIN adjuntos a ON a.sha256 = ma.sha256
+            WHERE ma.mensaje_id = ?
+            ORDER BY ma.nombre
+        """, (mid,))
+        return [{"sha256": r[0], "nombre": r[1], "tamaño": r[2], "tipo": r[3]} for r in c.fetchall()]
+
+    def _liberar_referencias(self, subconsulta_ids, params, tabla="main.mensajes"):
+        """
+        Descuenta las referencias a adjuntos y a contenidos compartidos de los
+        mensajes de `tabla` que devuelve `subconsulta_ids` (que se van a borrar
+        para siempre) y borra los contenidos que quedan sin entregas. No hace
+        commit: queda en la misma transacción que el DELETE de los mensajes.
+        """
+        c = self.conn.cursor()
+        c.execute(f"""
+            UPDATE contenidos SET entregas = entregas - (
+                SELECT COUNT(*) FROM {tabla} m WHERE m.contenido_id = contenidos.id AND m.id IN ({subconsulta_ids})
+            )
+            WHERE id IN (SELECT contenido_id FROM {tabla} WHERE id IN ({subconsulta_ids}))
+        """, tuple(params) * 2)
+        self._descontar_hilos(subconsulta_ids, params, tabla)
+        if c.rowcount:
+            c.execute("""
+                UPDATE cuerpos SET referencias = referencias - (
+                    SELECT COUNT(*) FROM contenidos co WHERE co.cuerpo_id = cuerpos.id AND co.entregas <= 0
+                )
+                WHERE id IN (SELECT cuerpo_id FROM contenidos WHERE entregas <= 0)
+            """)
+            c.execute("DELETE FROM contenidos WHERE entregas <= 0")
+            if c.rowcount:
+                c.execute("DELETE FROM cuerpos WHERE referencias <= 0")
+        c.execute(f"""
+            UPDATE adjuntos SET referencias = referencias - (
+                SELECT COUNT(*) FROM mensaje_adjuntos ma
+                WHERE ma.sha256 = adjuntos.sha256 AND ma.mensaje_id IN ({subconsulta_ids})
+            )
+            WHERE sha256 IN (SELECT sha256 FROM mensaje_adjuntos WHERE mensaje_id IN ({subconsulta_ids}))
+        """, tuple(params) * 2)
+        c.execute(f"DELETE FROM mensaje_adjuntos WHERE mensaje_id IN ({subconsulta_ids})", params)
+
+    def recolectar_adjuntos(self):
+        """Borra del disco los blobs que ya no referencia ningún mensaje."""
+        c = self.conn.cursor()
+        c.execute("SELECT sha256 FROM adjuntos WHERE referencias <= 0")
+        borrados = 0
+        for (sha,) in c.fetchall():
+            c.execute("DELETE FROM adjuntos WHERE sha256 = ? AND referencias <= 0", (sha,))
+            self.conn.commit()
+            if c.rowcount:
+                self.adjuntos.borrar(sha)
+                borrados += 1
+        return borrados
+
+    # Particiones de archivo (mensajes viejos en un archivo SQLite por mes)
+    def listar_archivos(self):
+        """Devuelve [(mes, ruta)] de los archivos mensuales, del más reciente al más viejo."""
+        c = self.conn.cursor()
+        c.execute("SELECT mes, ruta FROM archivos_mensajes ORDER BY mes DESC")
+        base = os.path.dirname(os.path.abspath(self.db_file))
+        return [(mes, os.path.join(base, ruta)) for mes, ruta in c.fetchall()]
+
+    @contextlib.contextmanager
+    def _archivo_adjunto(self, ruta, esquema="archivo"):
+        # ATTACH/DETACH no se permiten dentro de una transacción abierta
+        self.conn.commit()
+        self.conn.execute(f"ATTACH DATABASE ? AS {esquema}", (ruta,))
+        try:
+            if ruta not in self._archivos_preparados:
+                # archivos creados con un esquema anterior reciben las columnas nuevas
+                self._preparar_archivo(esquema)
+                self.conn.commit()
+                self._archivos_preparados.add(ruta)
+            yield esquema
+        finally:
+            self.conn.commit()
+            self.conn.execute(f"DETACH DATABASE {esquema}")
+
+    def _consultar_particiones(self, where, params, orden, limite=None, offset=0, rango=None):
+        """
+        Ejecuta la consulta primero sobre la tabla caliente y sólo continúa con los
+        archivos mensuales (del más reciente al más viejo) si la página pedida
+        (limite/offset) no se completó. Sin `limite` devuelve todo.
+        `rango` = (desde, hasta) agrega fecha_ms en [desde, hasta) (None = abierto)
+        y saltea los archivos de meses fuera del rango.
+        Concatenar las particiones sólo respeta el orden por fecha descendente; con
+        otro orden y archivos en el rango cada partición da sus primeras
+        offset + limite filas y se juntan (ver _ordenar_filas).
+        """
+        resultado = []
+        pendiente = offset
+        where, params, en_rango = self._filtro_rango(where, params, rango)
+        if not orden.startswith("fecha_ms DESC"):
+            archivos = [ruta for mes, ruta in self.listar_archivos() if en_rango(mes)]
+            if archivos:
+                return self._juntar_particiones(where, params, orden, limite, offset, archivos)
+
+        def consultar(tabla):
+            nonlocal pendiente
+            c = self.conn.cursor()
+            fuente = _vista_mensajes(tabla)
+            sql = f"SELECT {COLUMNAS_MENSAJE} FROM {fuente} WHERE {where} ORDER BY {orden}"
+            if limite is None:
+                c.execute(sql, params)
+                return c.fetchall()
+            c.execute(sql + " LIMIT ? OFFSET ?", tuple(params) + (limite - len(resultado), pendiente))
+            rows = c.fetchall()
+            if rows:
+                pendiente = 0
+            elif pendiente:
+                # la página empieza más allá de esta partición: descontar sus filas
+                c.execute(f"SELECT COUNT(*) FROM {fuente} WHERE {where}", params)
+                pendiente = max(0, pendiente - c.fetchone()[0])
+            return rows
+
+        resultado.extend(consultar("main.mensajes"))
+        for mes, ruta in self.listar_archivos():
+            if limite is not None and len(resultado) >= limite:
+                break
+            if not en_rango(mes):
+                continue
+            with self._archivo_adjunto(ruta) as esquema:
+                resultado.extend(consultar(f"{esquema}.mensajes"))
+        return [Mensaje.from_row(r) for r in resultado]
+
+    def _juntar_particiones(self, where, params, orden, limite, offset, archivos):
+        c = self.conn.cursor()
+        tope = -1 if limite is None else offset + limite
+
+        def consultar(tabla):
+            c.execute(f"SELECT {COLUMNAS_MENSAJE} FROM {_vista_mensajes(tabla)} WHERE {where} ORDER BY {orden} LIMIT ?",
+                      tuple(params) + (tope,))
+            return c.fetchall()
+
+        filas = consultar("main.mensajes")
+        for ruta in archivos:
+            with self._archivo_adjunto(ruta) as esquema:
+                filas.extend(consultar(f"{esquema}.mensajes"))
+        filas = _ordenar_filas(filas, orden)[offset:None if limite is None else offset + limite]
+        return [Mensaje.from_row(r) for r in filas]
+
+    def _filtro_rango(self, where, params, rango):
+        """
+        Agrega a `where` fecha_ms en [desde, hasta) para `rango` = (desde, hasta)
+        (None = abierto). Devuelve (where, params, en_rango(mes)), esta última
+        para saltear los archivos mensuales que no pueden tener filas del rango.
+        """
+        desde, hasta = (_a_ms(v) for v in (rango or (None, None)))
+        mes_desde = mes_hasta = None
+        if desde is not None:
+            where, params = f"({where}) AND fecha_ms >= ?", tuple(params) + (desde,)
+            mes_desde = _ms_a_iso(desde)[:7]
+        if hasta is not None:
+            where, params = f"({where}) AND fecha_ms < ?", tuple(params) + (hasta,)
+            mes_hasta = _ms_a_iso(hasta - 1)[:7]
+        return where, params, lambda mes: not ((mes_desde and mes < mes_desde) or (mes_hasta and mes > mes_hasta))
+
+    def _contar_particiones(self, where, params, rango=None):
+        # Total de filas que cumplen `where` en la tabla caliente y los archivos
+        where, params, en_rango = self._filtro_rango(where, params, rango)
+        sql = "SELECT COUNT(*) FROM {fuente} WHERE {where}"
+        c = self.conn.cursor()
+        c.execute(sql.format(fuente=_vista_mensajes("main.mensajes"), where=where), params)
+        total = c.fetchone()[0]
+        for mes, ruta in self.listar_archivos():
+            if not en_rango(mes):
+                continue
+            with self._archivo_adjunto(ruta) as esquema:
+                c.execute(sql.format(fuente=_vista_mensajes(f"{esquema}.mensajes"), where=where), params)
+                total += c.fetchone()[0]
+        return total
+
+    def _ejecutar_por_id(self, sql, params):
+        # `sql` usa {tabla}: se prueba la tabla caliente y, si no afectó filas, cada archivo
+        c = self.conn.cursor()
+        c.execute(sql.format(tabla="main.mensajes"), params)
+        self.conn.commit()
+        if c.rowcount:
+            return c.rowcount
+        # en los archivos no hay triggers: los contadores se ajustan a mano (el id es el último parámetro)
+        mid = params[-1]
+        for _mes, ruta in self.listar_archivos():
+            with self._archivo_adjunto(ruta) as esquema:
+                tabla = f"{esquema}.mensajes"
+                self._ajustar_contadores(tabla, "id = ?", (mid,), -1)
+                c.execute(sql.format(tabla=tabla), params)
+                afectadas = c.rowcount
+                if afectadas:
+                    self._ajustar_contadores(tabla, "id = ?", (mid,), 1)
+                    self.conn.commit()
+                    return afectadas
+                self.conn.rollback()
+        return 0
+
+    def _preparar_archivo(self, esquema):
+        # Crea la tabla del archivo y le agrega las columnas que falten respecto de la caliente
+        c = self.conn.cursor()
+        c.execute(f"CREATE TABLE IF NOT EXISTS {esquema}.mensajes (id INTEGER PRIMARY KEY)")
+        self._migrar_fechas(esquema)
+        c.execute(f"PRAGMA {esquema}.table_info(mensajes)")
+        existentes = {r[1] for r in c.fetchall()}
+        c.execute("PRAGMA main.table_info(mensajes)")
+        for _cid, nombre, tipo, _notnull, defecto, _pk in c.fetchall():
+            if nombre in existentes:
+                continue
+            sql = f"ALTER TABLE {esquema}.mensajes ADD COLUMN {nombre} {tipo}"
+            if defecto is not None:
+                sql += f" DEFAULT {defecto}"
+            c.execute(sql)
+        c.execute(f"CREATE INDEX IF NOT EXISTS {esquema}.idx_archivo_dest_fecha ON mensajes(destinatario_id, fecha_ms)")
+        c.execute(f"DROP INDEX IF EXISTS {esquema}.idx_archivo_rem")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {esquema}.idx_archivo_rem_fecha ON mensajes(remitente_id, fecha_ms)")
+        c.execute(f"CREATE INDEX IF NOT EXISTS {esquema}.idx_archivo_hilo ON mensajes(hilo_id)")
+        self._indexar_asuntos(esquema, "idx_archivo_dest_asunto")
+
+    def _indexar_asuntos(self, esquema, indice):
+        """
+        Índice (destinatario, asunto) para ordenar por asunto sin ordenar en memoria.
+        Las entregas de envíos a varios tenían el asunto sólo en `contenidos`: antes
+        de crear el índice se copia a su fila (una sola vez por archivo).
+        """
+        c = self.conn.cursor()
+        c.execute(f"SELECT 1 FROM {esquema}.sqlite_master WHERE type = 'index' AND name = ?", (indice,))
+        if c.fetchone():
+            return
+        c.execute(f"""
+            UPDATE {esquema}.mensajes SET asunto = (SELECT co.asunto FROM main.contenidos co WHERE co.id = mensajes.contenido_id)
+            WHERE asunto IS NULL AND contenido_id IS NOT NULL
+        """)
+        c.execute(f"CREATE INDEX {esquema}.{indice} ON mensajes(destinatario_id, asunto)")
+
+    def mover_a_archivo(self, mes, ids):
+        """Mueve los ids dados (todos del mismo mes 'AAAA-MM') a su archivo, en una sola transacción."""
+        ruta = f"{os.path.splitext(os.path.basename(self.db_file))[0]}_archivo_{mes.replace('-', '_')}.db"
+        c = self.conn.cursor()
+        c.execute("INSERT OR IGNORE INTO archivos_mensajes (mes, ruta) VALUES (?, ?)", (mes, ruta))
+        self.conn.commit()
+        ruta = os.path.join(os.path.dirname(os.path.abspath(self.db_file)), ruta)
+        marcas = ",".join("?" * len(ids))
+        with self._archivo_adjunto(ruta) as esquema:
+            self._preparar_archivo(esquema)
+            self.conn.commit()
+            c.execute(f"INSERT OR REPLACE INTO {esquema}.mensajes ({COLUMNAS_MENSAJE}) SELECT {COLUMNAS_MENSAJE} FROM main.mensajes WHERE id IN ({marcas})", ids)
+            c.execute(f"DELETE FROM main.mensajes WHERE id IN ({marcas})", ids)
+            movidos = c.rowcount
+            # el trigger de DELETE descontó estos mensajes, pero siguen existiendo en el archivo
+            self._ajustar_contadores(f"{esquema}.mensajes", f"id IN ({marcas})", ids, 1)
+            self.conn.commit()
+        # cambia el orden de concatenación entre particiones de las páginas cacheadas
+        self.cache.limpiar()
+        return movidos
+
+    def _traer_de_archivo(self, mid):
+        # Devuelve un mensaje archivado a la tabla caliente (no hace nada si ya está ahí)
+        c = self.conn.cursor()
+        c.execute("SELECT 1 FROM main.mensajes WHERE id = ?", (mid,))
+        if c.fetchone():
+            return False
+        return bool(self._traer_de_archivos([mid]))
+
+    def _traer_de_archivos(self, ids):
+        """Devuelve a la tabla caliente los ids archivados (un ATTACH por archivo). Retorna los ids traídos."""
+        c = self.conn.cursor()
+        pendientes, traidos = set(ids), []
+        for _mes, ruta in self.listar_archivos():
+            if not pendientes:
+                break
+            with self._archivo_adjunto(ruta) as esquema:
+                tabla = f"{esquema}.mensajes"
+                for lote in self._por_lotes(list(pendientes)):
+                    marcas = ",".join("?" * len(lote))
+                    c.execute(f"INSERT INTO main.mensajes ({COLUMNAS_MENSAJE}) SELECT {COLUMNAS_MENSAJE} FROM {tabla} WHERE id IN ({marcas})", lote)
+                    if not c.rowcount:
+                        continue
+                    c.execute(f"SELECT id FROM {tabla} WHERE id IN ({marcas})", lote)
+                    encontrados = [r[0] for r in c.fetchall()]
+                    # el trigger de INSERT los contó otra vez: se descuenta el aporte que ya tenían en el archivo
+                    self._ajustar_contadores(tabla, f"id IN ({marcas})", lote, -1)
+                    c.execute(f"DELETE FROM {tabla} WHERE id IN ({marcas})", lote)
+                    pendientes.difference_update(encontrados)
+                    traidos.extend(encontrados)
+                self.conn.commit()
+        return traidos
+
+    def _actualizar_en_archivos(self, ids, sql, params=(), liberar_adjuntos=False):
+        """
+        Como _actualizar_en_bloque pero para ids archivados: `sql` usa {tabla} y
+        {marcas}; un ATTACH y una transacción por archivo, contadores ajustados a mano.
+        """
+        c = self.conn.cursor()
+        pendientes, total = set(ids), 0
+        for _mes, ruta in self.listar_archivos():
+            if not pendientes:
+                break
+            with self._archivo_adjunto(ruta) as esquema:
+                tabla = f"{esquema}.mensajes"
+                for lote in self._por_lotes(list(pendientes)):
+                    marcas = ",".join("?" * len(lote))
+                    c.execute(f"SELECT id FROM {tabla} WHERE id IN ({marcas})", lote)
+                    encontrados = [r[0] for r in c.fetchall()]
+                    if not encontrados:
+                        continue
+                    marcas = ",".join("?" * len(encontrados))
+                    self._ajustar_contadores(tabla, f"id IN ({marcas})", encontrados, -1)
+                    if liberar_adjuntos:
+                        self._liberar_referencias(marcas, encontrados, tabla)
+                    c.execute(sql.format(tabla=tabla, marcas=marcas), tuple(params) + tuple(encontrados))
+                    self._ajustar_contadores(tabla, f"id IN ({marcas})", encontrados, 1)
+                    pendientes.difference_update(encontrados)
+                    total += len(encontrados)
+                self.conn.commit()
+        if total:
+            self.cache.limpiar()
+        return total
+
+    # Exportación / importación masiva
+    def iterar_mensajes(self, uid=None, desde=None, hasta=None, tam_lote=1000):
+        """
+        Recorre la tabla `mensajes` (y luego los archivos mensuales) en orden de id sin cargarla entera en memoria.
+        Pagina por clave (id > último visto), así la memoria es constante y las
+        escrituras concurrentes no invalidan el recorrido.
+        Filtra opcionalmente por usuario (enviados o recibidos) y por rango de fecha
+        de envío (ms, datetime o texto ISO).
+        """
+        condiciones = ["id > ?"]
+        params = []
+        if uid is not None:
+            condiciones.append("(remitente_id = ? OR destinatario_id = ?)")
+            params += [uid, uid]
+        if desde is not None:
+            condiciones.append("fecha_ms >= ?")
+            params.append(_a_ms(desde))
+        if hasta is not None:
+            condiciones.append("fecha_ms < ?")
+            params.append(_a_ms(hasta))
+        sql = f"""
+            SELECT {COLUMNAS_MENSAJE}
+            FROM {{tabla}}
+            WHERE {' AND '.join(condiciones)}
+            ORDER BY id
+            LIMIT ?
+        """
+
+        def leer_lote(tabla, ultimo):
+            c = self.conn.cursor()
+            c.execute(sql.format(tabla=_vista_mensajes(tabla)), [ultimo] + params + [tam_lote])
+            return c.fetchall()
+
+        for ruta in [None] + [r for _mes, r in self.listar_archivos()]:
+            ultimo = 0
+            while True:
+                if ruta is None:
+                    rows = leer_lote("main.mensajes", ultimo)
+                else:
+                    # se adjunta por lote, así el archivo no queda adjunto mientras se consume
+                    with self._archivo_adjunto(ruta) as esquema:
+                        rows = leer_lote(f"{esquema}.mensajes", ultimo)
+                for r in rows:
+                    yield r
+                if len(rows) < tam_lote:
+                    break
+                ultimo = rows[-1][0]
+
+    def insertar_mensajes_lote(self, filas):
+        """
+        Inserta muchas filas en una sola transacción.
+        Cada fila: (remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad, leido[, carpeta[, clave[, huella]]]);
+        las fechas pueden ser ms, datetime o texto ISO. Las filas cuya clave de
+        idempotencia ya se usó, o cuya huella de importación ya está, se saltean.
+        Devuelve cuántas se insertaron.
+        """
+        sql = ("INSERT INTO mensajes (id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_ms, prioridad, eliminado_ms, "
+               "procesado_prioridad, leido, cuerpo_formato, carpeta, contenido_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        c = self.conn.cursor()
+        ultimo = self._ultimo_id()
+        insertadas, sin_clave = [], []
+        for f in filas:
+            clave = f[10] if len(f) > 10 else None
+            huella = f[11] if len(f) > 11 else None
+            if huella is not None:
+                # por la clave primaria; una fila repetida dentro del mismo lote también se saltea
+                c.execute("INSERT INTO huellas_importacion (huella, destinatario_id) VALUES (?, ?) ON CONFLICT DO NOTHING",
+                          (huella, f[1]))
+                if not c.rowcount:
+                    continue
+            if not self._reservar_clave(f[0], clave)[0]:
+                continue
+            contenido_id, cuerpo, formato = self._contenido_si_cuerpo_guardado(f[2], f[3]), None, None
+            if contenido_id is None:
+                cuerpo, formato = self._codificar_cuerpo(f[3])
+            fila = (self._nuevo_id(), f[0], f[1], f[2], cuerpo, _a_ms(f[4]), f[5], _a_ms(f[6]), f[7], f[8], formato,
+                    f[9] if len(f) > 9 else None, contenido_id)
+            insertadas.append(f)
+            if clave is None:
+                sin_clave.append(fila)
+            else:
+                # con clave va sola, para guardar su id
+                c.execute(sql, fila)
+                self._completar_clave(f[0], clave, c.lastrowid)
+        c.executemany(sql, sin_clave)
+        # cada fila importada abre su propio hilo
+        self._actualizar_hilos("main.mensajes", "id > ? AND id <= ?", (ultimo, self._ultimo_id()))
+        self.conn.commit()
+        self.cache.invalidar({f[1] for f in insertadas} | {f[0] for f in insertadas})
+        return len(insertadas)
+
+
+# ==========================
+# Exportación / importación de buzones (JSONL y mbox)
+# ==========================
+class TransferenciaBuzon:
+    """
+    Exporta e importa mensajes en streaming: la exportación recorre la tabla por
+    lotes y la importación lee la entrada de a un mensaje, insertando en
+    transacciones grandes. La importación guarda un checkpoint (offset en bytes
+    del archivo de entrada) después de cada lote, así se puede reanudar. Los
+    mensajes que no se pueden leer se saltean y se cuentan en `saltados`.
+    """
+    def __init__(self, db: BaseDatos, tam_lote=5000):
+        self.db = db
+        self.tam_lote = tam_lote
+        self.saltados = 0
+
+    # ---- exportación ----
+    def exportar_jsonl(self, ruta, uid=None, desde=None, hasta=None):
+        total = 0
+        with open(ruta, "w", encoding="utf-8") as f:
+            for row in self.db.iterar_mensajes(uid, desde, hasta):
+                f.write(json.dumps(self._fila_a_dict(row), ensure_ascii=False))
+                f.write("\n")
+                total += 1
+        return total
+
+    def exportar_mbox(self, ruta, uid=None, desde=None, hasta=None):
+        correos = {u.id_usuario: u.correo for u in self.db.listar_usuarios()}
+        total = 0
+        with open(ruta, "wb") as f:
+            gen = email.generator.BytesGenerator(f, mangle_from_=True, policy=email.policy.default.clone(linesep="\n"))
+            for row in self.db.iterar_mensajes(uid, desde, hasta):
+                d = self._fila_a_dict(row)
+                remitente = correos.get(d["remitente_id"], f"usuario{d['remitente_id']}@localhost")
+                destinatario = correos.get(d["destinatario_id"], f"usuario{d['destinatario_id']}@localhost")
+                try:
+                    # con la zona local, así Date lleva el desfase correcto
+                    fecha = datetime.datetime.fromisoformat(d["fecha_envio"]).astimezone()
+                except (TypeError, ValueError):
+                    fecha = datetime.datetime.now().astimezone()
+                msg = email.message.EmailMessage()
+                msg["From"] = remitente
+                msg["To"] = destinatario
+                msg["Subject"] = d["asunto"] or ""
+                msg["Date"] = email.utils.format_datetime(fecha)
+                msg["X-Correo-Remitente-Id"] = str(d["remitente_id"])
+                msg["X-Correo-Destinatario-Id"] = str(d["destinatario_id"])
+                msg["X-Correo-Fecha-Envio"] = d["fecha_envio"] or ""
+                msg["X-Correo-Prioridad"] = str(d["prioridad"])
+                msg["X-Correo-Procesado-Prioridad"] = str(d["procesado_prioridad"] or 0)
+                msg["X-Correo-Leido"] = "1" if d["leido"] else "0"
+                if d["eliminado_en"]:
+                    msg["X-Correo-Eliminado-En"] = d["eliminado_en"]
+                if d["metadata"]:
+                    msg["X-Correo-Metadata"] = json.dumps(d["metadata"], ensure_ascii=True)
+                msg.set_content(d["cuerpo"] or "")
+                msg.set_unixfrom(f"From {remitente} {fecha.strftime('%a %b %d %H:%M:%S %Y')}")
+                gen.flatten(msg, unixfrom=True)
+                f.write(b"\n")
+                total += 1
+        return total
+
+    def _fila_a_dict(self, row):
+        m = Mensaje.from_row(row)
+        return {
+            "id": m.id_mensaje,
+            "remitente_id": m.remitente_id,
+            "destinatario_id": m.destinatario_id,
+            "asunto": m.asunto,
+            "cuerpo": m.cuerpo,
+            "metadata": m.metadata,
+            "fecha_envio": m.fecha_envio,
+            "prioridad": m.prioridad,
+            "eliminado_en": _ms_a_iso(row[7]),
+            "procesado_prioridad": row[8],
+            "leido": m.leido,
+        }
+
+    # ---- importación ----
+    def importar_jsonl(self, ruta, ruta_checkpoint=None):
+        return self._importar(ruta, ruta_checkpoint, self._leer_jsonl)
+
+    def importar_mbox(self, ruta, ruta_checkpoint=None):
+        return self._importar(ruta, ruta_checkpoint, self._leer_mbox)
+
+    def _importar(self, ruta, ruta_checkpoint, lector):
+        ruta_checkpoint = ruta_checkpoint or ruta + ".checkpoint"
+        offset, total, self.saltados = 0, 0, 0
+        if os.path.exists(ruta_checkpoint):
+            with open(ruta_checkpoint, encoding="utf-8") as f:
+                estado = json.load(f)
+            offset, total = estado.get("offset", 0), estado.get("importados", 0)
+            self.saltados = estado.get("saltados", 0)
+
+        lote = []
+        with open(ruta, "rb") as f:
+            f.seek(offset)
+            for fila, fin in lector(f):
+                if fila is not None:
+                    lote.append(fila)
+                else:
+                    self.saltados += 1
+                if len(lote) >= self.tam_lote:
+                    total += self.db.insertar_mensajes_lote(lote)
+                    lote = []
+                    self._guardar_checkpoint(ruta_checkpoint, fin, total)
+            if lote:
+                total += self.db.insertar_mensajes_lote(lote)
+        if os.path.exists(ruta_checkpoint):
+            os.remove(ruta_checkpoint)
+        return total
+
+    def _guardar_checkpoint(self, ruta_checkpoint, offset, total):
+        tmp = ruta_checkpoint + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"offset": offset, "importados": total, "saltados": self.saltados}, f)
+        os.replace(tmp, ruta_checkpoint)
+
+    def _fila_desde_dict(self, d):
+        cuerpo = json.dumps({"cuerpo": d.get("cuerpo"), "metadata": d.get("metadata") or {}}, ensure_ascii=False)
+        # la huella sale del mensaje mismo y no vence: importar otra vez el mismo archivo no duplica filas
+        huella = json.dumps([d["remitente_id"], d["destinatario_id"], d.get("fecha_envio"), d.get("asunto"), cuerpo],
+                            ensure_ascii=False)
+        return (
+            d["remitente_id"],
+            d["destinatario_id"],
+            d.get("asunto"),
+            cuerpo,
+            d.get("fecha_envio") or _ahora_ms(),
+            d.get("prioridad") or 5,
+            d.get("eliminado_en"),
+            d.get("procesado_prioridad") or 0,
+            1 if d.get("leido") else 0,
+            None,
+            None,
+            hashlib.sha256(huella.encode("utf-8")).digest(),
+        )
+
+    def _leer_jsonl(self, f):
+        # Genera (fila, offset_despues_de_la_linea); las líneas vacías o inválidas se saltean
+        offset = f.tell()
+        for linea in f:
+            offset += len(linea)
+            linea = linea.strip()
+            if not linea:
+                continue
+            try:
+                fila = self._fila_desde_dict(json.loads(linea))
+            except (ValueError, KeyError):
+                fila = None
+            yield fila, offset
+
+    def _leer_mbox(self, f):
+        # Separa mensajes por la línea "From " inicial, sin cargar el archivo completo
+        ids_por_correo = {u.correo: u.id_usuario for u in self.db.listar_usuarios()}
+        parser = email.parser.BytesParser(policy=email.policy.default)
+        offset = f.tell()
+        actual = []
+        anterior_vacia = True
+        for linea in f:
+            if linea.startswith(b"From ") and anterior_vacia and actual:
+                yield self._fila_o_nada(parser, actual, ids_por_correo), offset
+                actual = []
+            offset += len(linea)
+            anterior_vacia = linea in (b"\n", b"\r\n")
+            if linea.startswith(b"From ") and not actual:
+                continue
+            if linea.startswith(b">From "):
+                linea = linea[1:]
+            actual.append(linea)
+        if actual:
+            yield self._fila_o_nada(parser, actual, ids_por_correo), offset
+
+    def _fila_o_nada(self, parser, lineas, ids_por_correo):
+        # Como en _leer_jsonl: un mensaje con cabeceras inválidas (ids, prioridad, metadata) se saltea
+        try:
+            return self._fila_desde_mbox(parser.parsebytes(b"".join(lineas)), ids_por_correo)
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def _fila_desde_mbox(self, msg, ids_por_correo):
+        def _id(cabecera_id, cabecera_correo):
+            valor = msg.get(cabecera_id)
+            if valor:
+                return int(valor)
+            direccion = email.utils.parseaddr(str(msg.get(cabecera_correo, "")))[1]
+            return ids_por_correo.get(direccion)
+
+        remitente_id = _id("X-Correo-Remitente-Id", "From")
+        destinatario_id = _id("X-Correo-Destinatario-Id", "To")
+        if remitente_id is None or destinatario_id is None:
+            return None
+        fecha = msg.get("X-Correo-Fecha-Envio")
+        if not fecha and msg.get("Date"):
+            try:
+                fecha = email.utils.parsedate_to_datetime(str(msg["Date"])).isoformat()
+            except (TypeError, ValueError):
+                fecha = None
+        cuerpo = msg.get_body(preferencelist=("plain",))
+        texto = cuerpo.get_content().rstrip("\n") if cuerpo is not None else ""
+        metadata = json.loads(msg["X-Correo-Metadata"]) if msg.get("X-Correo-Metadata") else {}
+        return self._fila_desde_dict({
+            "remitente_id": remitente_id,
+            "destinatario_id": destinatario_id,
+            "asunto": str(msg.get("Subject", "")),
+            "cuerpo": texto,
+            "metadata": metadata,
+            "fecha_envio": fecha,
+            "prioridad": int(msg.get("X-Correo-Prioridad", 5)),
+            "eliminado_en": msg.get("X-Correo-Eliminado-En"),
+            "procesado_prioridad": int(msg.get("X-Correo-Procesado-Prioridad", 0)),
+            "leido": msg.get("X-Correo-Leido") == "1",
+        })
+
+
+# ==========================
+# Archivador por mes (particiones de mensajes viejos)
+# ==========================
+class Archivador:
+    """
+    Mueve los mensajes más viejos que `dias` a un archivo SQLite por mes
+    (correo_archivo_AAAA_MM.db) usando ATTACH DATABASE, en lotes de `tam_lote`
+    con una transacción por lote. Los mensajes en la papelera no se archivan:
+    se purgan solos con limpiar_papelera.
+    """
+    def __init__(self, db: BaseDatos, dias=180, tam_lote=2000):
+        self.db = db
+        self.dias = dias
+        self.tam_lote = tam_lote
+
+    def archivar(self):
+        limite = _ahora_ms() - self.dias * 86400000
+        total = 0
+        c = self.db.conn.cursor()
+        while True:
+            # el mes del archivo es el de la hora local, como el que muestra la interfaz
+            c.execute(
+                "SELECT id, strftime('%Y-%m', fecha_ms / 1000, 'unixepoch', 'localtime') FROM mensajes "
+                "WHERE fecha_ms < ? AND eliminado_ms IS NULL ORDER BY id LIMIT ?",
+                (limite, self.tam_lote))
+            rows = c.fetchall()
+            if not rows:
+                break
+            por_mes = {}
+            for mid, mes in rows:
+                por_mes.setdefault(mes, []).append(mid)
+            for mes, ids in por_mes.items():
+                total += self.db.mover_a_archivo(mes, ids)
+        return total
+
+
+# ==========================
+# Copias de seguridad en caliente (API de backup de SQLite)
+# ==========================
+class _DemasiadosReinicios(Exception):
+    pass
+
+
+class ServicioRespaldo:
+    """
+    Copias de la base (y de sus archivos mensuales) sin detener la aplicación.
+
+    Modo "paginas": Connection.backup copia `paginas_por_paso` páginas por paso y
+    espera `pausa_ms` entre pasos, así los escritores toman el lock entre medio.
+    Si otra conexión escribe durante la copia SQLite la empieza de nuevo; después
+    de `max_reinicios` lo que falta se copia en un solo paso (los escritores
+    esperan a que termine). Modo "vacuum": VACUUM INTO escribe una copia
+    compactada, en una sola lectura.
+
+    Cada copia es una carpeta AAAAMMDD-HHMMSS-mmm dentro de `carpeta`, que
+    aparece recién cuando está completa (y verificada con integrity_check si
+    `verificar`); se conservan las últimas `conservar`. Los adjuntos no se copian:
+    son archivos que no cambian y se respaldan aparte.
+    """
+    MODOS = ("paginas", "vacuum")
+    _NOMBRE = re.compile(r"^\d{8}-\d{6}-\d{3}$")
+
+    def __init__(self, db: BaseDatos, carpeta=None, modo="paginas", paginas_por_paso=256, pausa_ms=10,
+                 conservar=7, verificar=True, max_reinicios=20):
+        if modo not in self.MODOS:
+            raise ValueError(f"Modo de respaldo desconocido: {modo}")
+        self.db_file = os.path.abspath(db.db_file)
+        self.carpeta = carpeta or os.path.splitext(self.db_file)[0] + "_respaldos"
+        self.modo = modo
+        self.paginas_por_paso = paginas_por_paso
+        self.pausa_ms = pausa_ms
+        self.conservar = conservar
+        self.verificar = verificar
+        self.max_reinicios = max_reinicios
+        self._lock = threading.Lock()
+        self._parar = threading.Event()
+        self._hilo = None
+        self._stats = {"corridas": 0, "fallos": 0, "ultimo": None, "ultimo_error": None, "en_curso": None}
+
+    def respaldar(self, modo=None, progreso=None):
+        """
+        Hace una copia ahora y devuelve sus métricas: {"ruta", "modo", "archivos",
+        "bytes", "paginas", "pasos", "reinicios", "duracion_s", "verificacion_s"}.
+        `progreso(archivo, copiadas, total)` se llama después de cada paso.
+        Si algo falla la copia incompleta se borra y se propaga el error.
+        """
+        modo = modo or self.modo
+        if modo not in self.MODOS:
+            raise ValueError(f"Modo de respaldo desconocido: {modo}")
+        os.makedirs(self.carpeta, exist_ok=True)
+        ahora = time.time()
+        nombre = time.strftime("%Y%m%d-%H%M%S", time.localtime(ahora)) + f"-{int(ahora * 1000) % 1000:03d}"
+        destino = os.path.join(self.carpeta, nombre)
+        parcial = destino + ".parcial"
+        metricas = {"ruta": destino, "modo": modo, "archivos": 0, "bytes": 0, "paginas": 0, "pasos": 0,
+                    "reinicios": 0, "duracion_s": 0.0, "verificacion_s": 0.0}
+        t0 = time.perf_counter()
+        try:
+            os.makedirs(parcial)
+            copias = self._copiar_todo(parcial, modo, metricas, progreso)
+            metricas["duracion_s"] = time.perf_counter() - t0
+            if self.verificar:
+                t1 = time.perf_counter()
+                for copia in copias:
+                    self._verificar(copia)
+                metricas["verificacion_s"] = time.perf_counter() - t1
+            metricas["archivos"] = len(copias)
+            metricas["bytes"] = sum(os.path.getsize(c) for c in copias)
+            os.replace(parcial, destino)
+        except BaseException as e:
+            shutil.rmtree(parcial, ignore_errors=True)
+            with self._lock:
+                self._stats["fallos"] += 1
+                self._stats["ultimo_error"] = f"{type(e).__name__}: {e}"
+                self._stats["en_curso"] = None
+            raise
+        with self._lock:
+            self._stats["corridas"] += 1
+            self._stats["ultimo"] = dict(metricas)
+            self._stats["en_curso"] = None
+        self.podar()
+        return metricas
+
+    def _copiar_todo(self, parcial, modo, metricas, progreso):
+        # Primero la base principal y después los archivos que figuran en esa copia. Si el
+        # Archivador movió mensajes entre medio quedarían en las dos particiones: se repite.
+        for _intento in range(3):
+            principal = os.path.join(parcial, os.path.basename(self.db_file))
+            copias = [self._copiar(self.db_file, principal, modo, metricas, progreso)]
+            con = sqlite3.connect(principal)
+            try:
+                archivos = [r for (r,) in con.execute("SELECT ruta FROM archivos_mensajes")]
+            finally:
+                con.close()
+            base = os.path.dirname(self.db_file)
+            for ruta in archivos:
+                if os.path.exists(os.path.join(base, ruta)):
+                    copias.append(self._copiar(os.path.join(base, ruta), os.path.join(parcial, ruta), modo, metricas, progreso))
+            if not self._hay_duplicados(principal, copias[1:]):
+                return copias
+            for copia in copias:
+                os.remove(copia)
+        raise RuntimeError("El archivador movió mensajes durante todos los intentos de respaldo")
+
+    def _copiar(self, origen, copia, modo, metricas, progreso):
+        nombre = os.path.basename(origen)
+        fuente = sqlite3.connect(origen)
+        try:
+            if modo == "vacuum":
+                fuente.execute("VACUUM INTO ?", (copia,))
+                destino = sqlite3.connect(copia)
+                try:
+                    paginas = destino.execute("PRAGMA page_count").fetchone()[0]
+                finally:
+                    destino.close()
+                metricas["paginas"] += paginas
+                metricas["pasos"] += 1
+                self._avance(nombre, paginas, paginas, progreso)
+                return copia
+            estado = {"restantes": None, "reinicios": 0}
+
+            def paso(_status, restantes, total):
+                metricas["pasos"] += 1
+                if estado["restantes"] is not None and restantes >= estado["restantes"]:
+                    # otra conexión escribió: SQLite volvió a empezar la copia (si fue después
+                    # del primer paso, lo que falta queda igual en vez de crecer)
+                    estado["reinicios"] += 1
+                    metricas["reinicios"] += 1
+                    if estado["reinicios"] > self.max_reinicios:
+                        raise _DemasiadosReinicios()
+                estado["restantes"] = restantes
+                self._avance(nombre, total - restantes, total, progreso)
+                if restantes and self.pausa_ms:
+                    # se suelta el lock de lectura entre pasos para no frenar a los escritores
+                    time.sleep(self.pausa_ms / 1000)
+
+            destino = sqlite3.connect(copia)
+            try:
+                try:
+                    fuente.backup(destino, pages=self.paginas_por_paso, progress=paso, sleep=self.pausa_ms / 1000)
+                except _DemasiadosReinicios:
+                    fuente.backup(destino, pages=-1)
+                metricas["paginas"] += destino.execute("PRAGMA page_count").fetchone()[0]
+            finally:
+                destino.close()
+            return copia
+        finally:
+            fuente.close()
+
+    def _avance(self, archivo, copiadas, total, progreso):
+        with self._lock:
+            self._stats["en_curso"] = {"archivo": archivo, "copiadas": copiadas, "total": total}
+        if progreso:
+            progreso(archivo, copiadas, total)
+
+    @staticmethod
+    def _hay_duplicados(principal, archivos):
+        if not archivos:
+            return False
+        con = sqlite3.connect(principal)
+        try:
+            for ruta in archivos:
+                con.execute("ATTACH DATABASE ? AS archivo", (ruta,))
+                try:
+                    if con.execute("SELECT 1 FROM main.mensajes WHERE id IN (SELECT id FROM archivo.mensajes) LIMIT 1").fetchone():
+                        return True
+                finally:
+                    con.execute("DETACH DATABASE archivo")
+            return False
+        finally:
+            con.close()
+
+    @staticmethod
+    def _verificar(copia):
+        con = sqlite3.connect(copia)
+        try:
+            problemas = [r[0] for r in con.execute("PRAGMA integrity_check")]
+        finally:
+            con.close()
+        if problemas != ["ok"]:
+            raise RuntimeError(f"La copia {copia} no pasó integrity_check: {'; '.join(problemas[:5])}")
+
+    def listar(self):
+        """Devuelve [(nombre, ruta)] de las copias completas, de la más reciente a la más vieja."""
+        if not os.path.isdir(self.carpeta):
+            return []
+        nombres = sorted((n for n in os.listdir(self.carpeta) if self._NOMBRE.match(n)), reverse=True)
+        return [(n, os.path.join(self.carpeta, n)) for n in nombres]
+
+    def podar(self):
+        """Borra las copias que exceden `conservar`; devuelve cuántas borró."""
+        viejas = self.listar()[self.conservar:]
+        for _nombre, ruta in viejas:
+            shutil.rmtree(ruta, ignore_errors=True)
+        return len(viejas)
+
+    def iniciar(self, intervalo_s):
+        """Respalda ahora y después cada `intervalo_s` segundos en un hilo aparte."""
+        if self._hilo and self._hilo.is_alive():
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._programado, args=(intervalo_s,), name="respaldo", daemon=True)
+        self._hilo.start()
+
+    def _programado(self, intervalo_s):
+        while True:
+            try:
+                self.respaldar()
+            except Exception:
+                # el error queda en estadisticas(); se reintenta en el próximo turno
+                pass
+            if self._parar.wait(intervalo_s):
+                break
+
+    def detener(self, timeout=None):
+        # Una copia en curso termina antes de que el hilo salga
+        self._parar.set()
+        if self._hilo:
+            self._hilo.join(timeout)
+
+    def estadisticas(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats["copias"] = len(self.listar())
+        return stats
+
+
+# ==========================
+# Filtro simple de reglas
+# ==========================
+class Filtro:
+    def __init__(self):
+        self.reglas = {}
+
+    def agregar_regla(self, regla, accion):
+        self.reglas[regla] = accion
+
+    def aplicar_filtro(self, texto):
+        for regla, accion in self.reglas.items():
+            if regla.lower() in texto.lower():
+                return accion
+        return None
+
+
+# ==========================
+# Reglas por usuario (persistidas) y re-filtrado por lotes
+# ==========================
+class Regla:
+    CAMPOS = ("asunto", "remitente", "cuerpo", "metadata")
+    ACCIONES = ("mover", "prioridad", "papelera")
+
+    def __init__(self, id_regla, usuario_id, campo, patron, accion, destino=None, es_regex=False, orden=0, activa=True):
+        if campo not in self.CAMPOS:
+            raise ValueError(f"Campo desconocido: {campo}")
+        if accion not in self.ACCIONES:
+            raise ValueError(f"Acción desconocida: {accion}")
+        if accion == "mover" and not destino:
+            raise ValueError("La acción 'mover' necesita una carpeta destino")
+        self.id_regla = id_regla
+        self.usuario_id = usuario_id
+        self.campo = campo
+        self.patron = patron
+        self.accion = accion
+        self.destino = destino
+        self.es_regex = bool(es_regex)
+        self.orden = orden
+        self.activa = bool(activa)
+        try:
+            self._regex = re.compile(patron, re.IGNORECASE) if self.es_regex else None
+        except re.error as e:
+            raise ValueError(f"Expresión regular inválida: {e}")
+
+    def coincide(self, mensaje: Mensaje, correo_remitente=None):
+        """
+        Sin regex, busca el patrón como subcadena (sin distinguir mayúsculas);
+        para el remitente también vale el id exacto. Con regex usa re.search.
+        La metadata se compara contra su JSON (claves ordenadas).
+        """
+        if self.campo == "remitente":
+            valores = [str(mensaje.remitente_id), correo_remitente or ""]
+            if self._regex is None:
+                return self.patron == valores[0] or self.patron.lower() in valores[1].lower()
+            return any(self._regex.search(v) for v in valores if v)
+        if self.campo == "metadata":
+            valor = json.dumps(mensaje.metadata or {}, ensure_ascii=False, sort_keys=True)
+        else:
+            valor = getattr(mensaje, self.campo) or ""
+            if not isinstance(valor, str):
+                valor = str(valor)
+        if self._regex is None:
+            return self.patron.lower() in valor.lower()
+        return self._regex.search(valor) is not None
+
+    def __str__(self):
+        tipo = "regex" if self.es_regex else "contiene"
+        destino = f" → {self.destino}" if self.accion == "mover" else ""
+        return f"si {self.campo} {tipo} '{self.patron}': {self.accion}{destino}"
+
+
+def primera_regla(reglas, mensaje, correo_remitente=None):
+    # Como Filtro.aplicar_filtro: gana la primera regla (orden, id) que coincide
+    for regla in reglas:
+        if regla.coincide(mensaje, correo_remitente):
+            return regla
+    return None
+
+
+def _evaluar_reglas_lote(reglas, filas, correos):
+    """
+    Trabajo de un proceso del Refiltrador: decodifica (y descomprime) las filas
+    de COLUMNAS_MENSAJE y devuelve [(mensaje_id, índice de la regla que coincide)].
+    """
+    resultado = []
+    for fila in filas:
+        m = Mensaje.from_row(fila)
+        for i, regla in enumerate(reglas):
+            if regla.coincide(m, correos.get(m.remitente_id)):
+                resultado.append((m.id_mensaje, i))
+                break
+    return resultado
+
+
+class Refiltrador:
+    """
+    Aplica reglas a un buzón ya existente (mensajes recibidos fuera de la
+    papelera, también los archivados). La lectura va por lotes de `tam_lote`
+    (iterar_mensajes), la evaluación se reparte entre `procesos` procesos
+    (0 = en este mismo proceso) y cada lote de resultados se escribe con las
+    operaciones en bloque de BaseDatos.
+    """
+
+    def __init__(self, db: BaseDatos, procesos=None, tam_lote=2000):
+        self.db = db
+        self.procesos = (os.cpu_count() or 1) if procesos is None else procesos
+        self.tam_lote = tam_lote
+
+    def aplicar(self, uid, reglas=None, progreso=None):
+        """
+        Aplica `reglas` (por defecto las activas del usuario) y devuelve
+        {"revisados", "papelera", "prioridad", "mover"}. `progreso(revisados)`
+        se llama después de escribir cada lote.
+        """
+        reglas = self.db.obtener_reglas(uid) if reglas is None else list(reglas)
+        totales = {"revisados": 0, "papelera": 0, "prioridad": 0, "mover": 0}
+        if not reglas:
+            return totales
+        correos = {u.id_usuario: u.correo for u in self.db.listar_usuarios()}
+        # si ninguna regla mira el cuerpo, no se decodifica ni se envía a los procesos
+        con_cuerpo = any(r.campo in ("cuerpo", "metadata") for r in reglas)
+
+        def escribir(revisados, coincidencias):
+            for k, v in self.db.aplicar_reglas([(mid, reglas[i]) for mid, i in coincidencias]).items():
+                totales[k] += v
+            totales["revisados"] += revisados
+            if progreso:
+                progreso(totales["revisados"])
+
+        if not self.procesos:
+            for lote in self._lotes(uid, con_cuerpo):
+                escribir(len(lote), _evaluar_reglas_lote(reglas, lote, correos))
+            return totales
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.procesos) as ejecutor:
+            # a lo sumo dos lotes por proceso en vuelo: la memoria no crece con el buzón
+            pendientes = collections.deque()
+            for lote in self._lotes(uid, con_cuerpo):
+                remitentes = {f[1] for f in lote}
+                pendientes.append((len(lote), ejecutor.submit(
+                    _evaluar_reglas_lote, reglas, lote, {u: correos.get(u) for u in remitentes})))
+                if len(pendientes) >= 2 * self.procesos:
+                    n, futuro = pendientes.popleft()
+                    escribir(n, futuro.result())
+            while pendientes:
+                n, futuro = pendientes.popleft()
+                escribir(n, futuro.result())
+        return totales
+
+    def _lotes(self, uid, con_cuerpo=True):
+        lote = []
+        for fila in self.db.iterar_mensajes(uid=uid, tam_lote=self.tam_lote):
+            # sólo el correo recibido y fuera de la papelera
+            if fila[2] != uid or fila[7] is not None:
+                continue
+            if not con_cuerpo:
+                fila = fila[:4] + (None,) + fila[5:]
+            lote.append(fila)
+            if len(lote) >= self.tam_lote:
+                yield lote
+                lote = []
+        if lote:
+            yield lote
+
+
+# ==========================
+# Clasificador de spam (Naive Bayes multinomial sobre bolsa de palabras con hashing)
+# ==========================
+class ClasificadorSpam:
+    """
+    Cada palabra (del asunto con prefijo propio, y del cuerpo) se lleva con
+    crc32 a una de `n_caracteristicas` columnas, así el modelo tiene tamaño fijo
+    y no guarda vocabulario. Se entrena de forma incremental (sumando conteos)
+    y puntúa un mensaje o un lote entero en una sola pasada. Con NumPy el
+    entrenamiento y la puntuación van vectorizados (bincount); sin NumPy se
+    usan arrays de Python con el mismo formato de archivo.
+    """
+    MAGIA = b"NBSPAM1\n"
+    _PALABRA = re.compile(r"\w+")
+
+    def __init__(self, n_caracteristicas=2 ** 18, max_palabras=2000, alfa=1.0):
+        if n_caracteristicas & (n_caracteristicas - 1):
+            raise ValueError("n_caracteristicas debe ser potencia de 2")
+        self.n_caracteristicas = n_caracteristicas
+        self.max_palabras = max_palabras
+        self.alfa = alfa
+        self.documentos = [0, 0]    # [ham, spam]
+        self.palabras = [0.0, 0.0]  # total de palabras vistas por clase
+        if NUMPY_AVAILABLE:
+            self.conteos = [np.zeros(n_caracteristicas), np.zeros(n_caracteristicas)]
+        else:
+            self.conteos = [array.array("d", bytes(8 * n_caracteristicas)) for _ in range(2)]
+        self._indices = {}
+        self._pesos = None
+
+    # ---- características ----
+    def indices(self, asunto, cuerpo):
+        """Columnas (con repetición) de las palabras del mensaje."""
+        memo, mascara = self._indices, self.n_caracteristicas - 1
+        if len(memo) > 200000:
+            memo.clear()
+        resultado = []
+        for prefijo, texto in (("a:", asunto), ("", cuerpo)):
+            if not texto:
+                continue
+            for i, palabra in enumerate(self._PALABRA.finditer(texto.lower())):
+                if i >= self.max_palabras:
+                    break
+                clave = prefijo + palabra.group()
+                col = memo.get(clave)
+                if col is None:
+                    col = memo[clave] = zlib.crc32(clave.encode("utf-8")) & mascara
+                resultado.append(col)
+        return resultado
+
+    @staticmethod
+    def _texto(mensaje):
+        cuerpo = mensaje.cuerpo
+        return mensaje.asunto or "", cuerpo if isinstance(cuerpo, str) else ("" if cuerpo is None else str(cuerpo))
+
+    # ---- entrenamiento ----
+    def entrenar(self, mensajes, etiquetas):
+        """Suma al modelo los Mensaje dados; etiquetas[i] es True si es spam."""
+        por_clase = ([], [])
+        for m, es_spam in zip(mensajes, etiquetas):
+            clase = 1 if es_spam else 0
+            por_clase[clase].extend(self.indices(*self._texto(m)))
+            self.documentos[clase] += 1
+        for clase, cols in enumerate(por_clase):
+            if not cols:
+                continue
+            self.palabras[clase] += len(cols)
+            if NUMPY_AVAILABLE:
+                self.conteos[clase] += np.bincount(np.asarray(cols, dtype=np.int64), minlength=self.n_caracteristicas)
+            else:
+                conteo = self.conteos[clase]
+                for col in cols:
+                    conteo[col] += 1
+        self._pesos = None
+
+    @property
+    def entrenado(self):
+        return self.documentos[0] > 0 and self.documentos[1] > 0
+
+    def _preparar(self):
+        # peso de cada columna = log P(palabra|spam) - log P(palabra|ham), con suavizado de Laplace
+        if self._pesos is not None:
+            return
+        a, n = self.alfa, self.n_caracteristicas
+        den_ham = math.log(self.palabras[0] + a * n)
+        den_spam = math.log(self.palabras[1] + a * n)
+        self._previo = math.log(max(self.documentos[1], 1) / max(self.documentos[0], 1))
+        if NUMPY_AVAILABLE:
+            self._pesos = (np.log(self.conteos[1] + a) - den_spam) - (np.log(self.conteos[0] + a) - den_ham)
+        else:
+            log = math.log
+            self._pesos = array.array("d", (log(s + a) - den_spam - log(h + a) + den_ham
+                                             for h, s in zip(self.conteos[0], self.conteos[1])))
+
+    # ---- puntuación ----
+    def probabilidad(self, mensaje):
+        return self.probabilidades([mensaje])[0]
+
+    def probabilidades(self, mensajes):
+        """P(spam) de cada mensaje; un lote se puntúa con un solo bincount."""
+        if not mensajes:
+            return []
+        self._preparar()
+        listas = [self.indices(*self._texto(m)) for m in mensajes]
+        if NUMPY_AVAILABLE:
+            cols = np.fromiter((c for l in listas for c in l), dtype=np.int64)
+            docs = np.repeat(np.arange(len(listas)), [len(l) for l in listas])
+            puntajes = np.bincount(docs, weights=self._pesos[cols], minlength=len(listas)) + self._previo
+            return list(1.0 / (1.0 + np.exp(-np.clip(puntajes, -50, 50))))
+        pesos = self._pesos
+        resultado = []
+        for l in listas:
+            puntaje = min(max(self._previo + sum(pesos[c] for c in l), -50.0), 50.0)
+            resultado.append(1.0 / (1.0 + math.exp(-puntaje)))
+        return resultado
+
+    # ---- persistencia ----
+    def guardar(self, ruta):
+        # cabecera JSON de una línea + conteos float64 de ham y de spam; se reemplaza de forma atómica
+        cabecera = {"n_caracteristicas": self.n_caracteristicas, "max_palabras": self.max_palabras,
+                    "alfa": self.alfa, "documentos": self.documentos, "palabras": self.palabras}
+        tmp = ruta + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.MAGIA)
+            f.write(json.dumps(cabecera).encode("utf-8") + b"\n")
+            for conteo in self.conteos:
+                if NUMPY_AVAILABLE:
+                    f.write(conteo.astype("<f8").tobytes())
+                else:
+                    datos = array.array("d", conteo)
+                    if sys.byteorder != "little":
+                        datos.byteswap()
+                    f.write(datos.tobytes())
+        os.replace(tmp, ruta)
+
+    @classmethod
+    def cargar(cls, ruta):
+        with open(ruta, "rb") as f:
+            if f.read(len(cls.MAGIA)) != cls.MAGIA:
+                raise ValueError(f"{ruta} no es un modelo de spam")
+            cabecera = json.loads(f.readline())
+            modelo = cls(cabecera["n_caracteristicas"], cabecera["max_palabras"], cabecera["alfa"])
+            modelo.documentos = cabecera["documentos"]
+            modelo.palabras = cabecera["palabras"]
+            n = modelo.n_caracteristicas
+            for clase in range(2):
+                datos = f.read(8 * n)
+                if NUMPY_AVAILABLE:
+                    modelo.conteos[clase] = np.frombuffer(datos, dtype="<f8").astype(np.float64)
+                else:
+                    conteo = array.array("d")
+                    conteo.frombytes(datos)
+                    if sys.byteorder != "little":
+                        conteo.byteswap()
+                    modelo.conteos[clase] = conteo
+        return modelo
+
+
+# ==========================
+# Cola de prioridades en memoria (heap)
+# ==========================
+class ColaPrioridadesMem:
+    def __init__(self):
+        self.cola = []  # (prioridad, id_mensaje)
+        # con ingesta asíncrona se agrega desde el hilo escritor
+        self._lock = threading.Lock()
+
+    def agregar(self, prioridad, mensaje_id):
+        with self._lock:
+            heapq.heappush(self.cola, (prioridad, mensaje_id))
+
+    def obtener(self):
+        with self._lock:
+            if not self.cola:
+                return None
+            return heapq.heappop(self.cola)
+
+    def listar(self):
+        return list(self.cola)
+
+    def vacia(self):
+        return len(self.cola) == 0
+
+
+# ==========================
+# Límite de envíos (token bucket por remitente + cupo global en vuelo)
+# ==========================
+class LimitadorEnvios:
+    """
+    Cada remitente tiene un balde de `capacidad` fichas que se recarga a `tasa`
+    fichas por segundo; cada envío gasta una. Además, a lo sumo `max_en_vuelo`
+    envíos se procesan a la vez. Con modo "rechazar" el envío sin ficha o sin
+    cupo se rechaza enseguida; con modo "esperar" se demora hasta `max_espera`
+    segundos y recién después se rechaza. tasa=None o max_en_vuelo=None
+    desactivan la parte correspondiente.
+
+    El estado es un diccionario ordenado por último uso {remitente: [fichas, instante]};
+    se descartan los remitentes cuyo balde ya se habría llenado (no se pierde nada).
+    """
+    MODOS = ("rechazar", "esperar")
+
+    def __init__(self, tasa=5.0, capacidad=20, max_en_vuelo=8, modo="rechazar", max_espera=2.0,
+                 max_remitentes=100000, reloj=time.monotonic, dormir=time.sleep):
+        if modo not in self.MODOS:
+            raise ValueError(f"Modo desconocido: {modo}")
+        self.tasa = tasa
+        self.capacidad = capacidad
+        self.modo = modo
+        self.max_espera = max_espera
+        self.max_remitentes = max_remitentes
+        self._reloj = reloj
+        self._dormir = dormir
+        self._baldes = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._cupo = threading.BoundedSemaphore(max_en_vuelo) if max_en_vuelo else None
+        self._stats = collections.Counter()
+
+    def admitir(self, remitente_id):
+        """
+        Gasta una ficha de `remitente_id` (esperando si el modo lo permite).
+        Devuelve None si el envío puede seguir o "limitado" si se rechaza.
+        """
+        if not self.tasa:
+            return None
+        with self._lock:
+            ahora = self._reloj()
+            self._desalojar(ahora)
+            balde = self._baldes.pop(remitente_id, None)
+            fichas = self.capacidad if balde is None else min(self.capacidad, balde[0] + (ahora - balde[1]) * self.tasa)
+            espera = 0.0
+            if fichas < 1:
+                espera = (1 - fichas) / self.tasa
+                if self.modo != "esperar" or espera > self.max_espera:
+                    self._baldes[remitente_id] = [fichas, ahora]
+                    self._stats["limitados"] += 1
+                    return "limitado"
+            # en modo esperar la ficha se reserva ya (fichas < 0): quien llega después espera más
+            self._baldes[remitente_id] = [fichas - 1, ahora]
+            if espera:
+                self._stats["demorados"] += 1
+        if espera:
+            self._dormir(espera)
+        return None
+
+    def devolver(self, remitente_id):
+        # Reintegra la ficha de un envío que no llegó a hacerse (por ejemplo, sin cupo)
+        if not self.tasa:
+            return
+        with self._lock:
+            balde = self._baldes.get(remitente_id)
+            if balde is not None:
+                balde[0] = min(self.capacidad, balde[0] + 1)
+
+    @contextlib.contextmanager
+    def cupo(self):
+        """Ocupa un lugar del cupo global mientras dura el bloque; entrega False si no hay lugar."""
+        if self._cupo is None:
+            yield True
+            return
+        if self.modo == "esperar":
+            obtenido = self._cupo.acquire(timeout=self.max_espera)
+        else:
+            obtenido = self._cupo.acquire(blocking=False)
+        if not obtenido:
+            with self._lock:
+                self._stats["sin_cupo"] += 1
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            self._cupo.release()
+
+    def _desalojar(self, ahora):
+        # los baldes están ordenados por último uso: se recorren desde el más viejo
+        while self._baldes:
+            remitente_id, (fichas, instante) = next(iter(self._baldes.items()))
+            lleno = fichas + (ahora - instante) * self.tasa >= self.capacidad
+            if not lleno and len(self._baldes) <= self.max_remitentes:
+                break
+            del self._baldes[remitente_id]
+
+    def estadisticas(self):
+        with self._lock:
+            return {"remitentes": len(self._baldes), "limitados": self._stats["limitados"],
+                    "demorados": self._stats["demorados"], "sin_cupo": self._stats["sin_cupo"]}
+
+
+# ==========================
+# Sistema que unifica todo
+# ==========================
+CARPETA_SPAM = "Spam"
+
+
+class SistemaCorreo:
+    def __init__(self, db: BaseDatos, ruta_modelo_spam=None, umbral_spam=0.9, limitador: LimitadorEnvios = None):
+        self.db = db
+        self.filtro = Filtro()
+        self.cola_mem = ColaPrioridadesMem()
+        # LimitadorEnvios(tasa=None, max_en_vuelo=None) desactiva el límite
+        self.limitador = limitador if limitador is not None else LimitadorEnvios()
+        # con iniciar_ingesta() enviar encola y un hilo escritor guarda por grupos
+        self.ingesta = None
+
+        # Reglas por defecto
+        self.filtro.agregar_regla("urgente", "prioridad")
+        self.filtro.agregar_regla("spam", "eliminar")
+
+        # clasificador de spam: se carga del disco si ya se entrenó alguna vez
+        self.ruta_modelo_spam = ruta_modelo_spam or os.path.splitext(db.db_file)[0] + "_spam.bin"
+        self.umbral_spam = umbral_spam
+        # aprender_spam guarda el modelo en un hilo aparte, a lo sumo una vez cada `espera_guardado_spam` segundos
+        self.espera_guardado_spam = 5.0
+        self._lock_spam = threading.Lock()
+        self._guardado_spam = None
+        self.clasificador = ClasificadorSpam()
+        if os.path.exists(self.ruta_modelo_spam):
+            try:
+                self.clasificador = ClasificadorSpam.cargar(self.ruta_modelo_spam)
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def crear_usuario(self, nombre, correo, contraseña):
+        return self.db.crear_usuario(nombre, correo, contraseña)
+
+    def enviar(self, mensaje: Mensaje, destinatarios=None):
+        """
+        Envía `mensaje` a mensaje.destinatario_id o, si se pasa `destinatarios`,
+        a todos ellos guardando el cuerpo una sola vez; en ese caso el segundo
+        elemento del resultado es la lista de ids (uno por destinatario).
+        Si el limitador no lo admite devuelve ("limitado", None) (el remitente
+        superó su tasa) o ("ocupado", None) (demasiados envíos en curso); en
+        esos casos no se guardó nada y el mismo mensaje se puede reintentar.
+        Con la ingesta asíncrona activa devuelve ("encolado", futuro); ver
+        IngestaAsincrona.enviar.
+        Si mensaje.clave_idempotencia ya se usó devuelve ("duplicado", id o ids del
+        envío original) sin guardar nada: así un reintento no duplica el mensaje.
+        """
+        if self.ingesta is not None:
+            return self.ingesta.enviar(mensaje, destinatarios)
+        previo = self._ids_reintento(self.db, mensaje, destinatarios)
+        if previo is not None:
+            # un reintento no gasta cupo del limitador ni pasa otra vez por los filtros
+            return ("duplicado", previo)
+        if self.limitador.admitir(mensaje.remitente_id):
+            return ("limitado", None)
+        with self.limitador.cupo() as admitido:
+            if not admitido:
+                self.limitador.devolver(mensaje.remitente_id)
+                return ("ocupado", None)
+            return self._enviar_admitido(mensaje, destinatarios)
+
+    def iniciar_ingesta(self, **kwargs):
+        """Activa la ingesta asíncrona (los argumentos van a IngestaAsincrona)."""
+        if self.ingesta is None:
+            # con la base fragmentada hay un escritor por fragmento
+            clase = IngestaFragmentada if isinstance(self.db, BaseDatosFragmentada) else IngestaAsincrona
+            self.ingesta = clase(self, **kwargs)
+        return self.ingesta
+
+    def detener_ingesta(self):
+        # Guarda lo que quedó en la cola y vuelve al envío sincrónico
+        ingesta, self.ingesta = self.ingesta, None
+        if ingesta is not None:
+            ingesta.cerrar()
+
+    def _enviar_admitido(self, mensaje: Mensaje, destinatarios):
+        accion = self._clasificar(mensaje)
+        if accion == "eliminar":
+            self._descartar_adjuntos(mensaje)
+            return ("eliminado", None)
+        resultado, entregas = self._guardar(self.db, mensaje, destinatarios, accion)
+        self._despachar(self.db, mensaje, entregas, accion)
+        return resultado
+
+    def _clasificar(self, mensaje: Mensaje):
+        # El filtro y el clasificador se evalúan una sola vez por mensaje, no por destinatario
+        accion = self.filtro.aplicar_filtro(mensaje.cuerpo)
+        if accion not in ("prioridad", "eliminar") and self._es_spam(mensaje):
+            accion = "spam"
+        return accion
+
+    def _guardar(self, db, mensaje: Mensaje, destinatarios, accion):
+        """
+        Guarda el mensaje en `db` según la acción ya decidida por _clasificar.
+        Devuelve ((estado, id o ids), [(destinatario_id, mensaje_id)]). Un reintento
+        con una clave de idempotencia ya usada devuelve (("duplicado", ids del
+        original), []): no hay entregas nuevas que despachar.
+        """
+        # con la clave ya usada guardar_mensaje* no inserta y devuelve los ids originales
+        estado = "duplicado" if self._ids_reintento(db, mensaje, destinatarios) is not None else None
+        prioridad = 1 if accion == "prioridad" else (mensaje.prioridad or 5)
+        if accion == "spam" and estado is None:
+            mensaje.carpeta = CARPETA_SPAM
+        estado = estado or {"prioridad": "cola", "spam": "spam"}.get(accion, "enviado")
+        if destinatarios is not None and len(set(destinatarios)) > 1:
+            ids = db.guardar_mensaje_multiple(mensaje, destinatarios, prioridad=prioridad)
+            return (estado, ids), [] if estado == "duplicado" else list(zip(dict.fromkeys(destinatarios), ids))
+        if destinatarios:
+            mensaje.destinatario_id = destinatarios[0]
+        mid = db.guardar_mensaje(mensaje, prioridad=prioridad)
+        return (estado, mid), [] if estado == "duplicado" else [(mensaje.destinatario_id, mid)]
+
+    @staticmethod
+    def _ids_reintento(db, mensaje: Mensaje, destinatarios=None):
+        # Ids del envío original si la clave ya se usó, si no None. Por la clave primaria
+        # (remitente_id, clave): una búsqueda por envío (por fragmento de sus destinatarios)
+        if mensaje.clave_idempotencia is None:
+            return None
+        return db.buscar_clave_idempotencia(mensaje.remitente_id, mensaje.clave_idempotencia,
+                                            destinatarios or [mensaje.destinatario_id])
+
+    def _despachar(self, db, mensaje: Mensaje, entregas, accion):
+        # Ya confirmado el mensaje: reglas de los destinatarios y cola de prioritarios
+        self._aplicar_reglas_destinatarios(mensaje, entregas, db)
+        if accion == "prioridad":
+            for _dest, mid in entregas:
+                self.cola_mem.agregar(1, mid)
+
+    # Spam
+    def _es_spam(self, mensaje: Mensaje):
+        # sin ejemplos de las dos clases el clasificador no decide nada
+        return self.clasificador.entrenado and self.clasificador.probabilidad(mensaje) >= self.umbral_spam
+
+    def enviar_lote(self, mensajes):
+        """
+        Guarda muchos mensajes en una transacción (importaciones): filtro global
+        por mensaje, clasificador de spam sobre todo el lote de una vez.
+        No aplica las reglas de los destinatarios (para eso está refiltrar).
+        Devuelve {"enviados", "spam", "eliminados"}.
+        """
+        totales = {"enviados": 0, "spam": 0, "eliminados": 0}
+        aceptados = []
+        for m in mensajes:
+            if self.filtro.aplicar_filtro(m.cuerpo) == "eliminar":
+                totales["eliminados"] += 1
+            else:
+                aceptados.append(m)
+        if self.clasificador.entrenado:
+            probabilidades = self.clasificador.probabilidades(aceptados)
+        else:
+            probabilidades = [0.0] * len(aceptados)
+        filas = []
+        for m, p in zip(aceptados, probabilidades):
+            spam = p >= self.umbral_spam
+            totales["spam" if spam else "enviados"] += 1
+            cuerpo = json.dumps({"cuerpo": m.cuerpo, "metadata": m.metadata}, ensure_ascii=False)
+            filas.append((m.remitente_id, m.destinatario_id, m.asunto, cuerpo, m.fecha_ms, m.prioridad or 5,
+                          None, 0, 0, CARPETA_SPAM if spam else m.carpeta, m.clave_idempotencia))
+        if filas:
+            self.db.insertar_mensajes_lote(filas)
+        return totales
+
+    def aprender_spam(self, ids, es_spam):
+        """
+        Entrena con mensajes que el usuario marcó como spam o sacó de la carpeta de
+        spam. El modelo ocupa varios MiB: no se guarda acá sino en un hilo aparte,
+        una vez por cada `espera_guardado_spam` segundos con aprendizajes (ver guardar_modelo_spam).
+        """
+        mensajes = [m for m in (self.db.obtener_mensaje(i) for i in ids) if m is not None]
+        if mensajes:
+            with self._lock_spam:
+                self.clasificador.entrenar(mensajes, [es_spam] * len(mensajes))
+                if self._guardado_spam is None:
+                    self._guardado_spam = threading.Timer(self.espera_guardado_spam, self.guardar_modelo_spam)
+                    self._guardado_spam.daemon = True
+                    self._guardado_spam.start()
+        return len(mensajes)
+
+    def guardar_modelo_spam(self, solo_pendiente=False):
+        # Guarda el modelo ya y cancela el guardado diferido; con solo_pendiente (al cerrar), sólo si había uno
+        with self._lock_spam:
+            pendiente, self._guardado_spam = self._guardado_spam, None
+            if pendiente is not None:
+                pendiente.cancel()
+            if pendiente is not None or not solo_pendiente:
+                self.clasificador.guardar(self.ruta_modelo_spam)
+
+    def entrenar_spam(self, uid, tam_lote=2000):
+        """
+        Entrena con el buzón existente de `uid`: lo que está en la papelera o en
+        la carpeta de spam cuenta como spam; lo recibido, leído y conservado, como no spam.
+        Devuelve (spam, no_spam).
+        """
+        totales = [0, 0]
+        lote, etiquetas = [], []
+        for fila in self.db.iterar_mensajes(uid=uid, tam_lote=tam_lote):
+            m = Mensaje.from_row(fila)
+            if m.destinatario_id != uid:
+                continue
+            if fila[7] is not None or m.carpeta == CARPETA_SPAM:
+                es_spam = True
+            elif m.leido:
+                es_spam = False
+            else:
+                continue
+            lote.append(m)
+            etiquetas.append(es_spam)
+            totales[0 if es_spam else 1] += 1
+            if len(lote) >= tam_lote:
+                with self._lock_spam:
+                    self.clasificador.entrenar(lote, etiquetas)
+                lote, etiquetas = [], []
+        if lote:
+            with self._lock_spam:
+                self.clasificador.entrenar(lote, etiquetas)
+        self.guardar_modelo_spam()
+        return tuple(totales)
+
+    def _aplicar_reglas_destinatarios(self, mensaje: Mensaje, entregas, db=None):
+        # Reglas de cada destinatario sobre su copia: [(destinatario_id, mensaje_id)]
+        db = db or self.db
+        reglas = db.reglas_de_usuarios({dest for dest, _mid in entregas})
+        if not reglas:
+            return
+        remitente = db.obtener_usuario_por_id(mensaje.remitente_id)
+        correo = remitente.correo if remitente else None
+        coincidencias = []
+        for dest, mid in entregas:
+            regla = primera_regla(reglas.get(dest, ()), mensaje, correo)
+            if regla:
+                coincidencias.append((mid, regla))
+        db.aplicar_reglas(coincidencias)
+
+    def agregar_regla(self, uid, campo, patron, accion, destino=None, es_regex=False, orden=0):
+        regla = Regla(None, uid, campo, patron, accion, destino, es_regex, orden)
+        self.db.crear_regla(regla)
+        return regla
+
+    def refiltrar(self, uid, reglas=None, procesos=None, progreso=None, db=None):
+        return Refiltrador(db or self.db, procesos=procesos).aplicar(uid, reglas, progreso)
+
+    def enviar_a_lista(self, mensaje: Mensaje, lista_id):
+        return self.enviar(mensaje, self.db.miembros_lista(lista_id))
+
+    def resolver_destinatarios(self, propietario_id, texto):
+        """
+        Convierte "2, 5, @equipo" en una lista de ids: números de usuario y
+        nombres de listas de distribución propias precedidos por '@'.
+        Lanza ValueError si algún elemento no se reconoce.
+        """
+        ids = []
+        for parte in texto.replace(";", ",").split(","):
+            parte = parte.strip()
+            if not parte:
+                continue
+            if parte.startswith("@"):
+                lista_id = self.db.obtener_lista(propietario_id, parte[1:])
+                if lista_id is None:
+                    raise ValueError(f"Lista desconocida: {parte}")
+                ids.extend(self.db.miembros_lista(lista_id))
+            else:
+                ids.append(int(parte))
+        return list(dict.fromkeys(ids))
+
+    def responder(self, mid, remitente_id, cuerpo, prioridad=5):
+        """Responde al mensaje `mid` dentro de su hilo, dirigido al otro participante."""
+        original = self.db.obtener_mensaje(mid)
+        if original is None:
+            raise ValueError(f"Mensaje inexistente: {mid}")
+        destinatario = original.remitente_id if original.remitente_id != remitente_id else original.destinatario_id
+        asunto = original.asunto or ""
+        if not asunto.lower().startswith("re:"):
+            asunto = "Re: " + asunto
+        m = Mensaje(None, asunto, cuerpo, remitente_id, destinatario, prioridad=prioridad, en_respuesta_a=mid)
+        return self.enviar(m)
+
+    def procesar_proximo_prioritario(self):
+        item = self.cola_mem.obtener()
+        if not item:
+            return None
+        prioridad, mid = item
+        self.db.marcar_prioritario(mid)
+        return self.db.obtener_mensaje(mid)
+
+    def priorizar_mensaje(self, mid):
+        self.db.marcar_prioritario(mid)
+
+    def _descartar_adjuntos(self, mensaje):
+        # Blobs subidos para un mensaje que no se guardó: se borran si nadie más los referencia
+        c = self.db.conn.cursor()
+        for a in mensaje.adjuntos:
+            c.execute("SELECT 1 FROM adjuntos WHERE sha256 = ?", (a["sha256"],))
+            if not c.fetchone():
+                self.db.adjuntos.borrar(a["sha256"])
+
+    def adjuntar_archivo(self, mensaje: Mensaje, ruta):
+        # El blob se guarda (o se reutiliza si ya existe) antes de enviar; la referencia se cuenta al guardar el mensaje
+        ref = self.db.adjuntos.guardar_archivo(ruta)
+        mensaje.adjuntos.append(ref)
+        return ref
+
+
+# ==========================
+# Ingesta asíncrona (un escritor, commits agrupados)
+# ==========================
+class IngestaAsincrona:
+    """
+    `enviar` hace en el hilo que llama lo barato (límite por remitente, filtro,
+    clasificador de spam), encola el mensaje y devuelve un Future. Un único hilo
+    escritor, con su propia conexión, vacía la cola y confirma por grupos: cuando
+    junta `max_lote` mensajes o pasaron `max_espera_ms` desde el primero del grupo.
+    Así el costo del fsync se reparte entre todo el grupo.
+
+    `durabilidad` fija PRAGMA synchronous de la conexión del escritor:
+    "completa" (FULL), "normal" (NORMAL) o "ninguna" (OFF: un corte de luz puede
+    perder grupos ya confirmados). wal=True pasa la base a modo WAL, que queda
+    guardado en el archivo. Los futuros se resuelven recién después del commit
+    de su grupo, con el mismo (estado, id) que devolvería el envío sincrónico.
+    """
+    DURABILIDADES = {"completa": "FULL", "normal": "NORMAL", "ninguna": "OFF"}
+    _FIN = object()
+
+    def __init__(self, sistema: SistemaCorreo, max_lote=256, max_espera_ms=20, durabilidad="completa",
+                 wal=False, max_pendientes=10000, db=None):
+        if durabilidad not in self.DURABILIDADES:
+            raise ValueError(f"Durabilidad desconocida: {durabilidad}")
+        self.sistema = sistema
+        self.max_lote = max_lote
+        self.max_espera_ms = max_espera_ms
+        self.durabilidad = durabilidad
+        # `db` es la base en la que escribe, si no es la del sistema (un fragmento, ver IngestaFragmentada)
+        base = db or sistema.db
+        self.db = base.conexion_de_trabajo()
+        if wal:
+            self.db.conn.execute("PRAGMA journal_mode=WAL")
+        self.db.conn.execute(f"PRAGMA synchronous={self.DURABILIDADES[durabilidad]}")
+        self._cola = queue.Queue(max_pendientes)
+        self._cerrada = False
+        self._lock = threading.Lock()
+        self._stats = collections.Counter()
+        self._histograma = collections.Counter()
+        self._hilo = threading.Thread(target=self._escritor, name="ingesta", daemon=True)
+        self._hilo.start()
+
+    def enviar(self, mensaje: Mensaje, destinatarios=None):
+        """
+        Devuelve ("encolado", futuro), o sin encolar nada ("eliminado", None),
+        ("limitado", None) u ("ocupado", None) (la cola está llena; con el
+        limitador en modo "esperar" antes se espera hasta su max_espera).
+        futuro.result() da (estado, id o ids) una vez confirmado el grupo.
+        Un reintento de un envío ya confirmado devuelve ("duplicado", ids) como
+        SistemaCorreo.enviar; si el original sigue en la cola lo resuelve el escritor.
+        """
+        if self._cerrada:
+            raise RuntimeError("La ingesta está cerrada")
+        # con la conexión del sistema: la de la ingesta es del hilo escritor
+        previo = self.sistema._ids_reintento(self.sistema.db, mensaje, destinatarios)
+        if previo is not None:
+            return ("duplicado", previo)
+        limitador = self.sistema.limitador
+        if limitador.admitir(mensaje.remitente_id):
+            return ("limitado", None)
+        accion = self.sistema._clasificar(mensaje)
+        if accion == "eliminar":
+            self.sistema._descartar_adjuntos(mensaje)
+            return ("eliminado", None)
+        futuro = self._encolar(mensaje, destinatarios, accion,
+                               limitador.max_espera if limitador.modo == "esperar" else 0)
+        if futuro is None:
+            limitador.devolver(mensaje.remitente_id)
+            return ("ocupado", None)
+        return ("encolado", futuro)
+
+    def _encolar(self, mensaje, destinatarios, accion, espera=0):
+        # Devuelve el futuro del mensaje, o None si la cola sigue llena después de `espera` segundos (None: sin límite)
+        futuro = concurrent.futures.Future()
+        try:
+            if espera == 0:
+                self._cola.put_nowait((mensaje, destinatarios, accion, futuro))
+            else:
+                self._cola.put((mensaje, destinatarios, accion, futuro), timeout=espera)
+        except queue.Full:
+            with self._lock:
+                self._stats["sin_lugar"] += 1
+            return None
+        return futuro
+
+    def flush(self, timeout=None):
+        """Espera a que todo lo encolado hasta ahora esté confirmado. Devuelve False si venció `timeout`."""
+        if self._cerrada or not self._hilo.is_alive():
+            return True
+        listo = threading.Event()
+        self._cola.put(listo)
+        return listo.wait(timeout)
+
+    def cerrar(self, timeout=None):
+        # No acepta más envíos, guarda lo pendiente y termina el escritor
+        if self._cerrada:
+            return
+        self._cerrada = True
+        self._cola.put(self._FIN)
+        self._hilo.join(timeout)
+
+    def _escritor(self):
+        try:
+            while True:
+                lote, marcas, fin = self._tomar_lote()
+                if lote:
+                    self._escribir(lote)
+                for listo in marcas:
+                    listo.set()
+                if fin:
+                    break
+        finally:
+            self.db.conn.close()
+
+    def _tomar_lote(self):
+        # Bloquea hasta el primer elemento; después junta hasta max_lote o hasta que venza el plazo
+        lote, marcas = [], []
+        item = self._cola.get()
+        limite = time.monotonic() + self.max_espera_ms / 1000
+        while True:
+            if item is self._FIN:
+                return lote, marcas, True
+            if isinstance(item, threading.Event):
+                # flush: se confirma ya lo juntado
+                marcas.append(item)
+                return lote, marcas, False
+            lote.append(item)
+            if len(lote) >= self.max_lote:
+                return lote, marcas, False
+            resto = limite - time.monotonic()
+            try:
+                # vencido el plazo igual se toma lo que ya está en la cola
+                item = self._cola.get(timeout=resto) if resto > 0 else self._cola.get_nowait()
+            except queue.Empty:
+                return lote, marcas, False
+
+    def _escribir(self, lote):
+        vigentes = [e for e in lote if e[3].set_running_or_notify_cancel()]
+        resultados = []
+        try:
+            with self.db.agrupar([e[0] for e in vigentes]):
+                for mensaje, destinatarios, accion, _futuro in vigentes:
+                    # un mensaje que falla se deshace solo, sin tirar el resto del grupo
+                    self.db.conn.execute("SAVEPOINT ingesta")
+                    try:
+                        resultados.append(self.sistema._guardar(self.db, mensaje, destinatarios, accion))
+                    except Exception as e:
+                        self.db.conn.execute("ROLLBACK TO ingesta")
+                        resultados.append(e)
+                    self.db.conn.execute("RELEASE ingesta")
+        except Exception as e:
+            with self._lock:
+                self._stats["errores"] += len(vigentes)
+            for _m, _d, _a, futuro in vigentes:
+                futuro.set_exception(e)
+            return
+        with self._lock:
+            self._stats["lotes"] += 1
+            self._stats["mensajes"] += len(vigentes)
+            self._stats["lote_max"] = max(self._stats["lote_max"], len(vigentes))
+            # histograma por potencias de dos: 1, 2, 4, 8...
+            self._histograma[1 << (max(len(vigentes), 1).bit_length() - 1)] += 1
+        for (mensaje, _d, accion, futuro), resultado in zip(vigentes, resultados):
+            if isinstance(resultado, Exception):
+                with self._lock:
+                    self._stats["errores"] += 1
+                futuro.set_exception(resultado)
+                continue
+            try:
+                self.sistema._despachar(self.db, mensaje, resultado[1], accion)
+            except Exception:
+                # el mensaje ya está guardado: una regla que falla no cambia el resultado
+                pass
+            futuro.set_result(resultado[0])
+
+    def estadisticas(self):
+        with self._lock:
+            lotes = self._stats["lotes"]
+            return {"lotes": lotes, "mensajes": self._stats["mensajes"],
+                    "lote_medio": self._stats["mensajes"] / lotes if lotes else 0.0,
+                    "lote_max": self._stats["lote_max"], "histograma_lotes": dict(sorted(self._histograma.items())),
+                    "pendientes": self._cola.qsize(), "errores": self._stats["errores"],
+                    "sin_lugar": self._stats["sin_lugar"]}
+
+
+# ==========================
+# Base fragmentada por usuario (un archivo SQLite por fragmento)
+# ==========================
+# Cada fragmento numera sus mensajes desde indice * ESPACIO_IDS_FRAGMENTO: los ids
+# no se repiten entre fragmentos y el rango dice dónde se creó cada mensaje.
+ESPACIO_IDS_FRAGMENTO = 1 << 40
+_ATRIBUTOS_ORDEN = {"id": "id_mensaje", "asunto": "asunto", "remitente": "remitente_id",
+                    "destinatario": "destinatario_id", "fecha": "fecha_ms", "prioridad": "prioridad"}
+
+
+def _juntar_ordenados(listas, orden, clave_defecto, limite, offset):
+    """Une las páginas de varios fragmentos (cada una de hasta offset + limite filas) en el orden pedido."""
+    mensajes = [m for lista in listas for m in lista]
+    if orden is None:
+        mensajes.sort(key=clave_defecto)
+    else:
+        clave, descendente = orden
+        atributo = _ATRIBUTOS_ORDEN[clave]
+
+        def valor(m):
+            v = getattr(m, atributo)
+            # como en SQLite, NULL va antes que cualquier valor
+            return (v is not None, v if v is not None else "", m.id_mensaje)
+        mensajes.sort(key=valor, reverse=descendente)
+    return mensajes[offset:None if limite is None else offset + limite]
+
+
+class BaseDatosFragmentada:
+    """
+    Reparte los buzones en varios archivos SQLite (fragmentos) según el id del
+    destinatario, así los escritores de fragmentos distintos no se esperan entre
+    sí. El fragmento 0 es `db_file` y además el directorio: usuarios, listas, a
+    qué fragmento va cada usuario (fragmentos_usuarios) y dónde quedó cada
+    mensaje que refragmentar movió (mensajes_movidos). Los usuarios se copian a
+    todos los fragmentos para que las reglas se evalúen ahí mismo.
+
+    Un mensaje se guarda en el fragmento de su destinatario, con sus adjuntos y
+    su hilo; la bandeja, búsquedas, carpetas y reglas de un usuario leen sólo su
+    fragmento. La papelera (tiene también lo enviado, que está en el fragmento de
+    cada destinatario) y los prioritarios de todos se leen de todos y se juntan.
+    Los blobs de un mensaje están en el almacén de su fragmento (fragmento_de_mensaje).
+    """
+    def __init__(self, db_file=DB_FILE, fragmentos=None, **kwargs):
+        self.db_file = db_file
+        self._kwargs = kwargs
+        self.directorio = BaseDatos(db_file, **kwargs)
+        self.directorio.usar_secuencia_propia(0, ESPACIO_IDS_FRAGMENTO)
+        c = self.directorio.conn.cursor()
+        c.execute("CREATE TABLE IF NOT EXISTS fragmentos (indice INTEGER PRIMARY KEY, ruta TEXT NOT NULL)")
+        c.execute("CREATE TABLE IF NOT EXISTS fragmentos_usuarios (usuario_id INTEGER PRIMARY KEY, fragmento INTEGER NOT NULL)")
+        c.execute("CREATE TABLE IF NOT EXISTS mensajes_movidos (id INTEGER PRIMARY KEY, fragmento INTEGER NOT NULL)")
+        c.execute("SELECT indice, ruta FROM fragmentos ORDER BY indice")
+        registrados = c.fetchall()
+        if not registrados:
+            # base existente: sus usuarios siguen en el fragmento 0 hasta que se refragmente
+            c.execute("INSERT INTO fragmentos_usuarios (usuario_id, fragmento) SELECT id, 0 FROM usuarios")
+            registrados = [(0, os.path.basename(db_file))]
+            c.execute("INSERT INTO fragmentos (indice, ruta) VALUES (0, ?)", (registrados[0][1],))
+        self.directorio.conn.commit()
+        self.fragmentos = [self.directorio] + [self._abrir(i, ruta) for i, ruta in registrados[1:]]
+        for i in range(len(self.fragmentos), fragmentos or 1):
+            self._agregar_fragmento(i)
+        c.execute("SELECT usuario_id, fragmento FROM fragmentos_usuarios")
+        self._asignacion = dict(c.fetchall())
+        self.adjuntos = self.directorio.adjuntos
+
+    @property
+    def conn(self):
+        return self.directorio.conn
+
+    def _abrir(self, indice, ruta):
+        base = os.path.dirname(os.path.abspath(self.db_file))
+        db = BaseDatos(os.path.join(base, ruta), **self._kwargs)
+        c = db.conn.cursor()
+        db.usar_secuencia_propia(indice * ESPACIO_IDS_FRAGMENTO, (indice + 1) * ESPACIO_IDS_FRAGMENTO)
+        c.executemany("INSERT OR REPLACE INTO usuarios (id, nombre, correo, contraseña) VALUES (?, ?, ?, ?)",
+                      self.directorio.conn.execute("SELECT id, nombre, correo, contraseña FROM usuarios").fetchall())
+        db.conn.commit()
+        return db
+
+    def _agregar_fragmento(self, indice):
+        ruta = f"{os.path.splitext(os.path.basename(self.db_file))[0]}_fragmento_{indice}.db"
+        self.directorio.conn.execute("INSERT OR REPLACE INTO fragmentos (indice, ruta) VALUES (?, ?)", (indice, ruta))
+        self.directorio.conn.commit()
+        self.fragmentos.append(self._abrir(indice, ruta))
+
+    def cerrar(self):
+        for db in self.fragmentos:
+            db.conn.close()
+
+    # Ubicación
+    def indice_de_usuario(self, uid):
+        indice = self._asignacion.get(uid)
+        return indice if indice is not None else uid % len(self.fragmentos)
+
+    def fragmento(self, uid):
+        return self.fragmentos[self.indice_de_usuario(uid)]
+
+    def _ubicar(self, ids):
+        """{indice de fragmento: [ids]}: el del rango del id, salvo que refragmentar lo haya movido."""
+        ids = list(dict.fromkeys(int(i) for i in ids))
+        movidos = {}
+        c = self.directorio.conn.cursor()
+        for lote in self.directorio._por_lotes(ids):
+            c.execute(f"SELECT id, fragmento FROM mensajes_movidos WHERE id IN ({','.join('?' * len(lote))})", lote)
+            movidos.update(c.fetchall())
+        grupos = {}
+        for mid in ids:
+            indice = movidos.get(mid, mid // ESPACIO_IDS_FRAGMENTO)
+            grupos.setdefault(indice if indice < len(self.fragmentos) else 0, []).append(mid)
+        return grupos
+
+    def fragmento_de_mensaje(self, mid):
+        (indice, _ids), = self._ubicar([mid]).items()
+        return self.fragmentos[indice]
+
+    def _en_fragmentos(self, ids, operacion):
+        # Aplica `operacion(db, ids)` en el fragmento de cada grupo de ids y suma los resultados
+        return sum(operacion(self.fragmentos[i], grupo) for i, grupo in self._ubicar(ids).items())
+
+    # Directorio
+    def crear_usuario(self, nombre, correo, contraseña):
+        uid = self.directorio.crear_usuario(nombre, correo, contraseña)
+        if uid is None:
+            return None
+        for db in self.fragmentos[1:]:
+            db.conn.execute("INSERT OR REPLACE INTO usuarios (id, nombre, correo, contraseña) VALUES (?, ?, ?, ?)",
+                            (uid, nombre, correo, contraseña))
+            db.conn.commit()
+        indice = uid % len(self.fragmentos)
+        self.directorio.conn.execute("INSERT OR REPLACE INTO fragmentos_usuarios (usuario_id, fragmento) VALUES (?, ?)", (uid, indice))
+        self.directorio.conn.commit()
+        self._asignacion[uid] = indice
+        return uid
+
+    def obtener_usuario_por_id(self, uid):
+        return self.directorio.obtener_usuario_por_id(uid)
+
+    def obtener_usuario_por_correo(self, correo):
+        return self.directorio.obtener_usuario_por_correo(correo)
+
+    def listar_usuarios(self):
+        return self.directorio.listar_usuarios()
+
+    def crear_lista(self, propietario_id, nombre, miembros):
+        return self.directorio.crear_lista(propietario_id, nombre, miembros)
+
+    def obtener_lista(self, propietario_id, nombre):
+        return self.directorio.obtener_lista(propietario_id, nombre)
+
+    def listar_listas(self, propietario_id):
+        return self.directorio.listar_listas(propietario_id)
+
+    def miembros_lista(self, lista_id):
+        return self.directorio.miembros_lista(lista_id)
+
+    # Reglas: viven en el fragmento del usuario, junto a su correo entrante
+    def crear_regla(self, regla):
+        return self.fragmento(regla.usuario_id).crear_regla(regla)
+
+    def obtener_reglas(self, uid, solo_activas=True):
+        return self.fragmento(uid).obtener_reglas(uid, solo_activas)
+
+    def reglas_de_usuarios(self, uids, solo_activas=True):
+        por_fragmento = collections.defaultdict(list)
+        for uid in uids:
+            por_fragmento[self.indice_de_usuario(uid)].append(uid)
+        resultado = {}
+        for indice, grupo in por_fragmento.items():
+            resultado.update(self.fragmentos[indice].reglas_de_usuarios(grupo, solo_activas))
+        return resultado
+
+    def borrar_regla(self, id_regla, uid):
+        return self.fragmento(uid).borrar_regla(id_regla, uid)
+
+    def aplicar_reglas(self, coincidencias):
+        reglas = dict(coincidencias)
+        totales = collections.Counter()
+        for indice, ids in self._ubicar(reglas).items():
+            totales.update(self.fragmentos[indice].aplicar_reglas([(mid, reglas[mid]) for mid in ids]))
+        return {k: totales[k] for k in ("papelera", "prioridad", "mover")}
+
+    # Escritura
+    def preparar_envio(self, mensaje: Mensaje, indices):
+        """
+        Deja listo `mensaje` para guardarse en los fragmentos `indices`: resuelve
+        su hilo (el original puede estar en otro fragmento) y copia sus adjuntos
+        al almacén de cada uno. Los blobs que el directorio no usa se borran de él.
+        """
+        if mensaje.en_respuesta_a is not None and mensaje.hilo_id is None:
+            original = self.obtener_mensaje(mensaje.en_respuesta_a)
+            if original is not None:
+                mensaje.hilo_id = original.hilo_id or original.id_mensaje
+        if not mensaje.adjuntos:
+            return
+        for indice in indices:
+            for a in mensaje.adjuntos:
+                self.fragmentos[indice].adjuntos.copiar_de(self.adjuntos, a["sha256"])
+        if 0 not in indices:
+            c = self.directorio.conn.cursor()
+            for a in mensaje.adjuntos:
+                c.execute("SELECT 1 FROM adjuntos WHERE sha256 = ?", (a["sha256"],))
+                if not c.fetchone():
+                    self.adjuntos.borrar(a["sha256"])
+
+    def agrupar_destinatarios(self, destinatarios):
+        """{indice de fragmento: [destinatarios]}, sin repetidos y en el orden dado."""
+        grupos = {}
+        for dest in dict.fromkeys(destinatarios):
+            grupos.setdefault(self.indice_de_usuario(dest), []).append(dest)
+        return grupos
+
+    def guardar_mensaje(self, mensaje: Mensaje, prioridad:int=5):
+        indice = self.indice_de_usuario(mensaje.destinatario_id)
+        self.preparar_envio(mensaje, [indice])
+        return self.fragmentos[indice].guardar_mensaje(mensaje, prioridad)
+
+    def guardar_mensaje_multiple(self, mensaje: Mensaje, destinatarios, prioridad:int=5):
+        # Un guardado por fragmento: el cuerpo queda una vez en cada uno
+        grupos = self.agrupar_destinatarios(destinatarios)
+        self.preparar_envio(mensaje, list(grupos))
+        ids = {}
+        for indice, grupo in grupos.items():
+            parte = copy.copy(mensaje)
+            if len(grupo) > 1:
+                ids.update(zip(grupo, self.fragmentos[indice].guardar_mensaje_multiple(parte, grupo, prioridad)))
+            else:
+                parte.destinatario_id = grupo[0]
+                ids[grupo[0]] = self.fragmentos[indice].guardar_mensaje(parte, prioridad)
+        return [ids[d] for d in dict.fromkeys(destinatarios)]
+
+    def buscar_clave_idempotencia(self, remitente_id, clave, destinatarios=None):
+        # un envío repartido guardó la clave en cada fragmento que tocó, con los ids de su parte:
+        # se leen sólo esos fragmentos y se juntan en el orden de `destinatarios`
+        if destinatarios and None not in destinatarios:
+            grupos = self.agrupar_destinatarios(destinatarios)
+            ids = {}
+            for indice, grupo in grupos.items():
+                parte = self.fragmentos[indice].buscar_clave_idempotencia(remitente_id, clave)
+                if parte is None:
+                    return None
+                ids.update(zip(grupo, parte if isinstance(parte, list) else [parte]))
+            ordenados = [ids[d] for d in dict.fromkeys(destinatarios)]
+            return ordenados if len(ordenados) > 1 else ordenados[0]
+        for db in self.fragmentos:
+            ids = db.buscar_clave_idempotencia(remitente_id, clave)
+            if ids is not None:
+                return ids
+        return None
+
+    def insertar_mensajes_lote(self, filas):
+        por_fragmento = collections.defaultdict(list)
+        for f in filas:
+            por_fragmento[self.indice_de_usuario(f[1])].append(f)
+        return sum(self.fragmentos[i].insertar_mensajes_lote(grupo) for i, grupo in por_fragmento.items())
+
+    # Lecturas del buzón de un usuario: sólo su fragmento
+    def obtener_mensajes_para_usuario(self, uid, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        return self.fragmento(uid).obtener_mensajes_para_usuario(uid, limite, offset, desde, hasta, orden)
+
+    def buscar_mensajes(self, uid, criterio, valor, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        return self.fragmento(uid).buscar_mensajes(uid, criterio, valor, limite, offset, desde, hasta, orden)
+
+    def contar_busqueda(self, uid, criterio, valor, desde=None, hasta=None):
+        return self.fragmento(uid).contar_busqueda(uid, criterio, valor, desde, hasta)
+
+    def obtener_mensajes_carpeta(self, uid, carpeta, limite=None, offset=0):
+        return self.fragmento(uid).obtener_mensajes_carpeta(uid, carpeta, limite, offset)
+
+    def listar_carpetas(self, uid):
+        return self.fragmento(uid).listar_carpetas(uid)
+
+    def contadores(self, uid):
+        propio = self.fragmento(uid)
+        n = propio.contadores(uid)
+        # los enviados que el usuario borró cuentan en la papelera del fragmento de cada destinatario
+        n["papelera"] += sum(db.contadores(uid)["papelera"] for db in self.fragmentos if db is not propio)
+        return n
 
-    def desmarcar_prioritario(self, mid):
-        c = self.conn.cursor()
-        c.execute("UPDATE mensajes SET procesado_prioridad = 0 WHERE id = ?", (mid,))
-        self.conn.commit()
+    # Lecturas de varios fragmentos: cada uno devuelve hasta offset + limite filas y se juntan
+    def obtener_mensajes_prioritarios(self, uid=None, limite=None, offset=0, orden=None):
+        if uid is not None:
+            return self.fragmento(uid).obtener_mensajes_prioritarios(uid, limite, offset, orden)
+        tope = None if limite is None else offset + limite
+        listas = [db.obtener_mensajes_prioritarios(None, tope, 0, orden) for db in self.fragmentos]
+        return _juntar_ordenados(listas, orden, lambda m: (m.prioridad, -m.fecha_ms), limite, offset)
 
-    def borrar_mensaje_definitivo(self, mid):
-        c = self.conn.cursor()
-        c.execute("DELETE FROM mensajes WHERE id = ?", (mid,))
-        self.conn.commit()
+    def obtener_mensajes_papelera(self, uid, limite=None, offset=0, desde=None, hasta=None, orden=None):
+        tope = None if limite is None else offset + limite
+        listas = [db.obtener_mensajes_papelera(uid, tope, 0, desde, hasta, orden) for db in self.fragmentos]
+        return _juntar_ordenados(listas, orden, lambda m: -m.fecha_ms, limite, offset)
 
     def limpiar_papelera(self):
-        c = self.conn.cursor()
-        limite = datetime.datetime.now() - datetime.timedelta(days=4, hours=20)
-        c.execute("DELETE FROM mensajes WHERE eliminado_en IS NOT NULL AND eliminado_en < ?", (limite.isoformat(),))
-        self.conn.commit()
+        for db in self.fragmentos:
+            db.limpiar_papelera()
 
-    def obtener_mensajes_papelera(self, uid):
+    def iterar_mensajes(self, uid=None, desde=None, hasta=None, tam_lote=1000):
+        # fragmento por fragmento: el orden por id vale dentro de cada uno
+        for db in self.fragmentos:
+            yield from db.iterar_mensajes(uid, desde, hasta, tam_lote)
+
+    # Hilos: una conversación tiene mensajes en el fragmento de cada destinatario
+    def obtener_hilos(self, uid, limite=None, offset=0):
         """
-        Devuelve la lista de Mensaje que están en la papelera para el usuario dado.
-        La columna en la tabla es `eliminado_en` (timestamp) — si NO es NULL, está en papelera.
-        Considera tanto mensajes enviados como recibidos por el usuario.
+        Como BaseDatos.obtener_hilos. Cada fragmento da sus offset + limite hilos
+        más recientes (el fragmento con la última actividad de un hilo lo trae si
+        entra en la página) y los de la página se vuelven a pedir a todos para
+        sumar sus resúmenes. Un envío repartido entre fragmentos cuenta una vez
+        en cada uno.
         """
-        c = self.conn.cursor()
-        c.execute("""
-            SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad
-            FROM mensajes
-            WHERE (remitente_id = ? OR destinatario_id = ?) AND eliminado_en IS NOT NULL
-            ORDER BY fecha_envio DESC
-        """, (uid, uid))
-        rows = c.fetchall()
-        resultado = []
-        for r in rows:
-            resultado.append(Mensaje.from_row(r))
-        return resultado
+        tope = None if limite is None else offset + limite
+        candidatos = {}
+        for db in self.fragmentos:
+            for h in db.obtener_hilos(uid, tope, 0):
+                previo = candidatos.get(h["hilo_id"])
+                if previo is None or h["ultima_fecha"] > previo:
+                    candidatos[h["hilo_id"]] = h["ultima_fecha"]
+        orden = sorted(candidatos, key=lambda hid: (candidatos[hid], hid), reverse=True)
+        pagina = orden[offset:None if limite is None else offset + limite]
+        if not pagina:
+            return []
+        juntos = {}
+        for db in self.fragmentos:
+            partes = db.obtener_hilos(uid, hilos=pagina)
+            participantes = collections.defaultdict(set)
+            if partes:
+                marcas = ",".join("?" * len(partes))
+                for hid, u in db.conn.execute(f"SELECT hilo_id, usuario_id FROM hilo_participantes WHERE hilo_id IN ({marcas})",
+                                              [h["hilo_id"] for h in partes]):
+                    participantes[hid].add(u)
+            for h in partes:
+                j = juntos.get(h["hilo_id"])
+                if j is None:
+                    j = juntos[h["hilo_id"]] = dict(h, mensajes=0, mensajes_total=0, participantes=set())
+                elif h["ultima_fecha"] > j["ultima_fecha"]:
+                    j["ultimo_mensaje_id"], j["ultima_fecha"] = h["ultimo_mensaje_id"], h["ultima_fecha"]
+                j["asunto"] = j["asunto"] or h["asunto"]
+                j["mensajes"] += h["mensajes"]
+                j["mensajes_total"] += h["mensajes_total"]
+                j["participantes"] |= participantes[h["hilo_id"]]
+        hilos = [juntos[hid] for hid in pagina if hid in juntos]
+        for h in hilos:
+            h["participantes"] = len(h["participantes"])
+        return hilos
+
+    def obtener_hilo(self, hilo_id, uid=None):
+        mensajes = [m for db in self.fragmentos for m in db.obtener_hilo(hilo_id, uid)]
+        mensajes.sort(key=lambda m: (m.fecha_ms, m.id_mensaje))
+        return mensajes
+
+    def eliminar_usuario_en_segundo_plano(self, uid, al_terminar=None, **kwargs):
+        """
+        Borra al usuario de todos los fragmentos (está copiado en cada uno y sus
+        enviados están en el de cada destinatario), uno tras otro en un hilo.
+        `al_terminar(borrados)` se llama desde ese hilo con el total.
+        """
+        def trabajo():
+            borrados = []
+            for db in self.fragmentos:
+                db.eliminar_usuario_en_segundo_plano(uid, borrados.append, **kwargs).join()
+            self.directorio.conn.execute("DELETE FROM fragmentos_usuarios WHERE usuario_id = ?", (uid,))
+            self.directorio.conn.commit()
+            self._asignacion.pop(uid, None)
+            if al_terminar:
+                al_terminar(sum(borrados))
+
+        hilo = threading.Thread(target=trabajo, daemon=True)
+        hilo.start()
+        return hilo
+
+    # Por id de mensaje
+    def obtener_mensaje(self, mid):
+        return self.fragmento_de_mensaje(mid).obtener_mensaje(mid)
+
+    def copiar_adjunto(self, mid, sha256, destino):
+        self.fragmento_de_mensaje(mid).copiar_adjunto(mid, sha256, destino)
+
+    def marcar_leido(self, mid, leido=True):
+        self.fragmento_de_mensaje(mid).marcar_leido(mid, leido)
 
+    def marcar_prioritario(self, mid):
+        self.fragmento_de_mensaje(mid).marcar_prioritario(mid)
 
+    def marcar_eliminados(self, ids):
+        return self._en_fragmentos(ids, BaseDatos.marcar_eliminados)
 
+    def recuperar_mensajes(self, ids):
+        return self._en_fragmentos(ids, BaseDatos.recuperar_mensajes)
 
+    def marcar_prioritarios(self, ids):
+        return self._en_fragmentos(ids, BaseDatos.marcar_prioritarios)
 
+    def mover_a_carpeta(self, ids, carpeta):
+        return self._en_fragmentos(ids, lambda db, grupo: db.mover_a_carpeta(grupo, carpeta))
 
-# ==========================
-# Filtro simple de reglas
-# ==========================
-class Filtro:
-    def __init__(self):
-        self.reglas = {}
+    def borrar_mensajes(self, ids):
+        return self._en_fragmentos(ids, BaseDatos.borrar_mensajes)
 
-    def agregar_regla(self, regla, accion):
-        self.reglas[regla] = accion
+    def marcar_eliminado(self, mid):
+        self.fragmento_de_mensaje(mid).marcar_eliminado(mid)
 
-    def aplicar_filtro(self, texto):
-        for regla, accion in self.reglas.items():
-            if regla.lower() in texto.lower():
-                return accion
-        return None
+    def recuperar_mensaje(self, mid):
+        self.fragmento_de_mensaje(mid).recuperar_mensaje(mid)
 
+    def desmarcar_prioritario(self, mid):
+        self.fragmento_de_mensaje(mid).desmarcar_prioritario(mid)
 
-# ==========================
-# Cola de prioridades en memoria (heap)
-# ==========================
-class ColaPrioridadesMem:
-    def __init__(self):
-        self.cola = []  # (prioridad, id_mensaje)
+    def borrar_mensaje_definitivo(self, mid):
+        self.fragmento_de_mensaje(mid).borrar_mensaje_definitivo(mid)
 
-    def agregar(self, prioridad, mensaje_id):
-        heapq.heappush(self.cola, (prioridad, mensaje_id))
+    def obtener_adjuntos(self, mid):
+        return self.fragmento_de_mensaje(mid).obtener_adjuntos(mid)
 
-    def obtener(self):
-        if not self.cola:
-            return None
-        return heapq.heappop(self.cola)
+    def mover_a_archivo(self, mes, ids):
+        return self._en_fragmentos(ids, lambda db, grupo: db.mover_a_archivo(mes, grupo))
 
-    def listar(self):
-        return list(self.cola)
+    def participantes_hilo(self, hilo_id):
+        return sorted({u for db in self.fragmentos for u in db.participantes_hilo(hilo_id)})
 
-    def vacia(self):
-        return len(self.cola) == 0
+    # Mantenimiento: cada fragmento por separado
+    def comprimir_existentes(self, tam_lote=1000):
+        return sum(db.comprimir_existentes(tam_lote) for db in self.fragmentos)
 
+    def limpiar_claves_idempotencia(self):
+        return sum(db.limpiar_claves_idempotencia() for db in self.fragmentos)
 
-# ==========================
-# Sistema que unifica todo
-# ==========================
-class SistemaCorreo:
-    def __init__(self, db: BaseDatos):
-        self.db = db
-        self.filtro = Filtro()
-        self.cola_mem = ColaPrioridadesMem()
+    def recolectar_adjuntos(self):
+        return sum(db.recolectar_adjuntos() for db in self.fragmentos)
 
-        # Reglas por defecto
-        self.filtro.agregar_regla("urgente", "prioridad")
-        self.filtro.agregar_regla("spam", "eliminar")
+    def recalcular_contadores(self):
+        for db in self.fragmentos:
+            db.recalcular_contadores()
 
-    def crear_usuario(self, nombre, correo, contraseña):
-        return self.db.crear_usuario(nombre, correo, contraseña)
+    def recalcular_hilos(self):
+        for db in self.fragmentos:
+            db.recalcular_hilos()
 
-    def enviar(self, mensaje: Mensaje):
-        accion = self.filtro.aplicar_filtro(mensaje.cuerpo)
-        prioridad = mensaje.prioridad or 5
-        if accion == "prioridad":
-            prioridad = 1
-            mid = self.db.guardar_mensaje(mensaje, prioridad=prioridad)
-            self.cola_mem.agregar(prioridad, mid)
-            return ("cola", mid)
-        elif accion == "eliminar":
-            return ("eliminado", None)
-        else:
-            mid = self.db.guardar_mensaje(mensaje, prioridad=prioridad)
-            return ("enviado", mid)
+    def __getattr__(self, nombre):
+        # Un método de BaseDatos que no está repartido arriba no cae en silencio en un solo fragmento
+        if not nombre.startswith("__") and hasattr(BaseDatos, nombre):
+            raise AttributeError(f"BaseDatosFragmentada no reparte {nombre}(): "
+                                 "hay que llamarlo en fragmento(uid) o fragmento_de_mensaje(mid)")
+        raise AttributeError(f"'BaseDatosFragmentada' no tiene el atributo {nombre!r}")
 
-    def procesar_proximo_prioritario(self):
-        item = self.cola_mem.obtener()
-        if not item:
-            return None
-        prioridad, mid = item
-        self.db.marcar_prioritario(mid)
-        c = self.db.conn.cursor()
-        c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE id = ?", (mid,))
+    # Refragmentación
+    def refragmentar(self, n, tam_lote=500, progreso=None):
+        """
+        Pasa a `n` fragmentos y lleva el buzón de cada usuario al que le toca
+        (id % n): sus mensajes recibidos, también los archivados (vuelven a la
+        tabla caliente del destino), con adjuntos y reglas. Los ids no cambian:
+        mensajes_movidos guarda dónde quedó cada uno. Se puede interrumpir y
+        volver a correr. Hay que correrlo sin ingestas activas. Los archivos de
+        los fragmentos que sobran quedan en disco.
+        Devuelve {"fragmentos", "usuarios", "mensajes", "huerfanos"}.
+        """
+        if n < 1:
+            raise ValueError("Hace falta al menos un fragmento")
+        for i in range(len(self.fragmentos), n):
+            self._agregar_fragmento(i)
+        for db in self.fragmentos:
+            # qué contenido de otro fragmento ya se copió acá (ver _copiar_contenido)
+            db.conn.execute("""
+                CREATE TABLE IF NOT EXISTS contenidos_copiados (
+                    fragmento_origen INTEGER NOT NULL,
+                    contenido_origen INTEGER NOT NULL,
+                    contenido_id INTEGER NOT NULL,
+                    PRIMARY KEY (fragmento_origen, contenido_origen)
+                ) WITHOUT ROWID
+            """)
+            db.conn.commit()
+        totales = {"fragmentos": n, "usuarios": 0, "mensajes": 0, "huerfanos": 0}
+        usuarios = self.directorio.listar_usuarios()
+        for k, u in enumerate(usuarios, 1):
+            uid, destino = u.id_usuario, u.id_usuario % n
+            # primero la asignación: lo que llegue mientras tanto ya va al destino
+            self.directorio.conn.execute("INSERT OR REPLACE INTO fragmentos_usuarios (usuario_id, fragmento) VALUES (?, ?)", (uid, destino))
+            self.directorio.conn.commit()
+            movidos = 0
+            for origen in range(len(self.fragmentos)):
+                if origen != destino:
+                    movidos += self._mover_buzon(uid, origen, destino, tam_lote)
+            if self._asignacion.get(uid) != destino or movidos:
+                totales["usuarios"] += 1
+            self._asignacion[uid] = destino
+            totales["mensajes"] += movidos
+            if progreso:
+                progreso(k, len(usuarios))
+        for db in self.fragmentos[n:]:
+            totales["huerfanos"] += db.conn.execute("SELECT COUNT(*) FROM mensajes").fetchone()[0]
+            db.conn.close()
+        self.directorio.conn.execute("DELETE FROM fragmentos WHERE indice >= ?", (n,))
+        self.directorio.conn.commit()
+        del self.fragmentos[n:]
+        # cada tanda movida sumó sus hilos por separado: entregas de un envío que llegaron a un
+        # fragmento en tandas distintas contarían varias veces. Se recuentan desde las filas
+        self.recalcular_hilos()
+        return totales
+
+    @staticmethod
+    def _copiar_contenido(c, origen, contenido_id, cuerpo_json, cuerpo_formato):
+        # Id en el destino (cursor `c`) del contenido `contenido_id` del fragmento `origen`: la primera
+        # entrega lo copia con el cuerpo ya resuelto y las siguientes suman una entrega
+        c.execute("SELECT contenido_id FROM contenidos_copiados WHERE fragmento_origen = ? AND contenido_origen = ?",
+                  (origen, contenido_id))
         row = c.fetchone()
-        if not row:
-            return None
-        mensaje = Mensaje.from_row(row)
-        return mensaje
+        if row:
+            c.execute("UPDATE contenidos SET entregas = entregas + 1 WHERE id = ?", (row[0],))
+            return row[0]
+        c.execute("INSERT INTO contenidos (cuerpo_json, cuerpo_formato, entregas) VALUES (?, ?, 1)", (cuerpo_json, cuerpo_formato))
+        nuevo = c.lastrowid
+        c.execute("INSERT INTO contenidos_copiados (fragmento_origen, contenido_origen, contenido_id) VALUES (?, ?, ?)",
+                  (origen, contenido_id, nuevo))
+        return nuevo
+
+    def _mover_buzon(self, uid, origen, destino, tam_lote):
+        a, b = self.fragmentos[origen], self.fragmentos[destino]
+        archivados = []
+        for _mes, ruta in a.listar_archivos():
+            with a._archivo_adjunto(ruta) as esquema:
+                archivados += [r[0] for r in a.conn.execute(f"SELECT id FROM {esquema}.mensajes WHERE destinatario_id = ?", (uid,))]
+        if archivados:
+            a._traer_de_archivos(archivados)
+        columnas = COLUMNAS_MENSAJE.split(", ")
+        contenido, cuerpo, formato = (columnas.index(k) for k in ("contenido_id", "cuerpo_json", "cuerpo_formato"))
+        total = 0
+        while True:
+            filas = a.conn.execute(f"SELECT {COLUMNAS_MENSAJE} FROM {_vista_mensajes('main.mensajes')} "
+                                   "WHERE destinatario_id = ? ORDER BY id LIMIT ?", (uid, tam_lote)).fetchall()
+            if not filas:
+                break
+            ids = [f[0] for f in filas]
+            marcas = ",".join("?" * len(ids))
+            # una corrida anterior cortada pudo dejar algunos ya copiados
+            ya = {r[0] for r in b.conn.execute(f"SELECT id FROM mensajes WHERE id IN ({marcas})", ids)}
+            nuevas = [f for f in filas if f[0] not in ya]
+            for f in nuevas:
+                for adj in a.obtener_adjuntos(f[0]):
+                    b.adjuntos.copiar_de(a.adjuntos, adj["sha256"])
+            c = b.conn.cursor()
+            for f in nuevas:
+                if f[contenido] is not None:
+                    # las entregas de un mismo envío que llegan al destino comparten una copia de su contenido
+                    f = list(f)
+                    f[contenido] = self._copiar_contenido(c, origen, f[contenido], f[cuerpo], f[formato])
+                    f[cuerpo] = f[formato] = None
+                c.execute(f"INSERT INTO mensajes ({COLUMNAS_MENSAJE}) VALUES ({','.join('?' * len(columnas))})", tuple(f))
+                b._vincular_adjuntos(f[0], a.obtener_adjuntos(f[0]))
+            if nuevas:
+                b._actualizar_hilos("main.mensajes", f"id IN ({','.join('?' * len(nuevas))})", [f[0] for f in nuevas])
+            b.conn.commit()
+            d = self.directorio.conn
+            d.executemany("INSERT OR REPLACE INTO mensajes_movidos (id, fragmento) VALUES (?, ?)",
+                          [(mid, destino) for mid in ids if mid // ESPACIO_IDS_FRAGMENTO != destino])
+            d.executemany("DELETE FROM mensajes_movidos WHERE id = ?", [(mid,) for mid in ids if mid // ESPACIO_IDS_FRAGMENTO == destino])
+            d.commit()
+            a.borrar_mensajes(ids)
+            total += len(ids)
+        b.cache.limpiar()
+        huellas = a.conn.execute("SELECT huella FROM huellas_importacion WHERE destinatario_id = ?", (uid,)).fetchall()
+        if huellas:
+            b.conn.executemany("INSERT OR IGNORE INTO huellas_importacion (huella, destinatario_id) VALUES (?, ?)",
+                               [(h, uid) for h, in huellas])
+            b.conn.commit()
+            a.conn.execute("DELETE FROM huellas_importacion WHERE destinatario_id = ?", (uid,))
+            a.conn.commit()
+        for regla in a.obtener_reglas(uid, solo_activas=False):
+            id_viejo = regla.id_regla
+            b.crear_regla(regla)
+            a.borrar_regla(id_viejo, uid)
+        return total
+
+
+class IngestaFragmentada(IngestaAsincrona):
+    """
+    IngestaAsincrona sobre una BaseDatosFragmentada: una ingesta (con su conexión
+    y su hilo escritor) por fragmento, así los commits de fragmentos distintos
+    van en paralelo. Un envío a destinatarios de varios fragmentos se parte en
+    uno por fragmento y su futuro se resuelve cuando terminan todos, con los ids
+    en el orden de `destinatarios`.
+    """
+    def __init__(self, sistema: SistemaCorreo, **kwargs):
+        self.sistema = sistema
+        self.router = sistema.db
+        self.ingestas = [IngestaAsincrona(sistema, db=db, **kwargs) for db in self.router.fragmentos]
+        self._cerrada = False
 
-    def priorizar_mensaje(self, mid):
-        self.db.marcar_prioritario(mid)
+    def _encolar(self, mensaje, destinatarios, accion, espera=0):
+        if destinatarios is not None and len(set(destinatarios)) > 1:
+            grupos = self.router.agrupar_destinatarios(destinatarios)
+        else:
+            dest = destinatarios[0] if destinatarios else mensaje.destinatario_id
+            grupos = {self.router.indice_de_usuario(dest): [dest]}
+        self.router.preparar_envio(mensaje, list(grupos))
+        if len(grupos) == 1:
+            (indice, grupo), = grupos.items()
+            return self.ingestas[indice]._encolar(mensaje, destinatarios and grupo, accion, espera)
+        partes = []
+        for indice, grupo in grupos.items():
+            # el primero puede no entrar; los demás esperan lugar, para no guardar un envío a medias
+            futuro = self.ingestas[indice]._encolar(copy.copy(mensaje), grupo, accion, espera if not partes else None)
+            if futuro is None:
+                return None
+            partes.append((grupo, futuro))
+        return self._combinar(partes, destinatarios)
+
+    @staticmethod
+    def _combinar(partes, destinatarios):
+        combinado = concurrent.futures.Future()
+        pendientes = [len(partes)]
+        lock = threading.Lock()
+
+        def al_terminar(_futuro):
+            with lock:
+                pendientes[0] -= 1
+                if pendientes[0]:
+                    return
+            ids, estado = {}, "enviado"
+            for grupo, futuro in partes:
+                if futuro.exception() is not None:
+                    combinado.set_exception(futuro.exception())
+                    return
+                estado, resultado = futuro.result()
+                ids.update(zip(grupo, resultado if isinstance(resultado, list) else [resultado]))
+            combinado.set_result((estado, [ids[d] for d in dict.fromkeys(destinatarios)]))
+
+        for _grupo, futuro in partes:
+            futuro.add_done_callback(al_terminar)
+        return combinado
+
+    def flush(self, timeout=None):
+        limite = None if timeout is None else time.monotonic() + timeout
+        return all(i.flush(None if limite is None else max(0, limite - time.monotonic())) for i in self.ingestas)
+
+    def cerrar(self, timeout=None):
+        self._cerrada = True
+        for ingesta in self.ingestas:
+            ingesta.cerrar(timeout)
+
+    def estadisticas(self):
+        por_fragmento = [i.estadisticas() for i in self.ingestas]
+        resumen = {k: sum(s[k] for s in por_fragmento) for k in ("lotes", "mensajes", "pendientes", "errores", "sin_lugar")}
+        resumen["lote_medio"] = resumen["mensajes"] / resumen["lotes"] if resumen["lotes"] else 0.0
+        resumen["lote_max"] = max(s["lote_max"] for s in por_fragmento)
+        resumen["fragmentos"] = por_fragmento
+        return resumen
+
+
+# ==========================
+# Protocolo del chat (JSON o binario compacto)
+# ==========================
+# Marco binario: cabecera de 10 bytes (versión, tipo, fecha en ms) y el resto de
+# los campos (sender, text...) como un mapa msgpack. El cliente anuncia en su
+# "join", que siempre va en JSON, los formatos que entiende; el servidor le
+# contesta con una "bienvenida" que dice cuál usar. Un servidor o un cliente
+# que no conocen la negociación siguen hablando JSON.
+VERSION_CHAT = 1
+FORMATO_CHAT_JSON = "json"
+FORMATO_CHAT_BINARIO = "bin1"
+# en orden de preferencia
+FORMATOS_CHAT = (FORMATO_CHAT_BINARIO, FORMATO_CHAT_JSON)
+_CABECERA_CHAT = struct.Struct(">BBq")
+# el código 0 es "otro tipo": el nombre va en el cuerpo
+_TIPOS_CHAT = (None, "msg", "join", "bienvenida", "error")
+_CODIGOS_TIPO_CHAT = {t: i for i, t in enumerate(_TIPOS_CHAT) if t}
+
+
+def _empaquetar_msgpack(valor, salida):
+    # Subconjunto de msgpack (nil, bool, int, float, str, bin, array, map), siempre la forma más corta
+    if type(valor) is str and len(valor) < 32 and valor.isascii():
+        # lo más común en el chat: claves y nombres cortos
+        salida.append(0xA0 | len(valor))
+        salida += valor.encode("ascii")
+    elif valor is None:
+        salida.append(0xC0)
+    elif valor is True or valor is False:
+        salida.append(0xC3 if valor else 0xC2)
+    elif isinstance(valor, int):
+        if -32 <= valor < 128:
+            salida.append(valor & 0xFF)
+        elif valor >= 0:
+            for limite, marca, fmt in ((1 << 8, 0xCC, ">B"), (1 << 16, 0xCD, ">H"), (1 << 32, 0xCE, ">I"), (1 << 64, 0xCF, ">Q")):
+                if valor < limite:
+                    salida.append(marca)
+                    salida += struct.pack(fmt, valor)
+                    break
+            else:
+                raise ValueError(f"entero fuera de rango: {valor}")
+        else:
+            for limite, marca, fmt in ((1 << 7, 0xD0, ">b"), (1 << 15, 0xD1, ">h"), (1 << 31, 0xD2, ">i"), (1 << 63, 0xD3, ">q")):
+                if valor >= -limite:
+                    salida.append(marca)
+                    salida += struct.pack(fmt, valor)
+                    break
+            else:
+                raise ValueError(f"entero fuera de rango: {valor}")
+    elif isinstance(valor, float):
+        salida.append(0xCB)
+        salida += struct.pack(">d", valor)
+    elif isinstance(valor, str):
+        datos = valor.encode("utf-8")
+        _cabecera_msgpack(salida, len(datos), 0xA0, 32, 0xD9, 0xDA, 0xDB)
+        salida += datos
+    elif isinstance(valor, (bytes, bytearray, memoryview)):
+        datos = bytes(valor)
+        _cabecera_msgpack(salida, len(datos), None, 0, 0xC4, 0xC5, 0xC6)
+        salida += datos
+    elif isinstance(valor, (list, tuple)):
+        _cabecera_msgpack(salida, len(valor), 0x90, 16, None, 0xDC, 0xDD)
+        for v in valor:
+            _empaquetar_msgpack(v, salida)
+    elif isinstance(valor, dict):
+        _cabecera_msgpack(salida, len(valor), 0x80, 16, None, 0xDE, 0xDF)
+        for k, v in valor.items():
+            _empaquetar_msgpack(k, salida)
+            _empaquetar_msgpack(v, salida)
+    else:
+        raise TypeError(f"no se puede codificar {type(valor).__name__}")
+
+
+def _cabecera_msgpack(salida, n, fija, max_fija, marca8, marca16, marca32):
+    # Largo de str/bin/array/map: en el mismo byte si entra, si no con 1, 2 o 4 bytes
+    if fija is not None and n < max_fija:
+        salida.append(fija | n)
+    elif marca8 is not None and n < 1 << 8:
+        salida += bytes((marca8, n))
+    elif n < 1 << 16:
+        salida.append(marca16)
+        salida += struct.pack(">H", n)
+    else:
+        salida.append(marca32)
+        salida += struct.pack(">I", n)
+
+
+_MSGPACK_FIJOS = {0xC0: None, 0xC2: False, 0xC3: True}
+# marca -> (formato struct del valor o del largo, tipo): "n" número, "s" str, "b" bin, "a" array, "m" map
+_MSGPACK_MARCAS = {
+    0xCC: (">B", "n"), 0xCD: (">H", "n"), 0xCE: (">I", "n"), 0xCF: (">Q", "n"),
+    0xD0: (">b", "n"), 0xD1: (">h", "n"), 0xD2: (">i", "n"), 0xD3: (">q", "n"),
+    0xCA: (">f", "n"), 0xCB: (">d", "n"),
+    0xD9: (">B", "s"), 0xDA: (">H", "s"), 0xDB: (">I", "s"),
+    0xC4: (">B", "b"), 0xC5: (">H", "b"), 0xC6: (">I", "b"),
+    0xDC: (">H", "a"), 0xDD: (">I", "a"), 0xDE: (">H", "m"), 0xDF: (">I", "m"),
+}
+
+
+def _desempaquetar_msgpack(datos, pos=0):
+    """Lee un valor msgpack desde `pos`; devuelve (valor, posición siguiente)."""
+    try:
+        marca = datos[pos]
+    except IndexError:
+        raise ValueError("marco msgpack incompleto") from None
+    pos += 1
+    if 0xA0 <= marca < 0xC0:
+        # fixstr, lo más común
+        fin = pos + (marca & 0x1F)
+        if fin > len(datos):
+            raise ValueError("marco msgpack incompleto")
+        return datos[pos:fin].decode("utf-8"), fin
+    if marca < 0x80:
+        return marca, pos
+    if marca >= 0xE0:
+        return marca - 0x100, pos
+    if marca in _MSGPACK_FIJOS:
+        return _MSGPACK_FIJOS[marca], pos
+    if 0x90 <= marca < 0xA0:
+        tipo, n = "a", marca & 0x0F
+    elif 0x80 <= marca < 0x90:
+        tipo, n = "m", marca & 0x0F
+    elif marca in _MSGPACK_MARCAS:
+        fmt, tipo = _MSGPACK_MARCAS[marca]
+        tam = struct.calcsize(fmt)
+        if pos + tam > len(datos):
+            raise ValueError("marco msgpack incompleto")
+        n = struct.unpack_from(fmt, datos, pos)[0]
+        pos += tam
+        if tipo == "n":
+            return n, pos
+    else:
+        raise ValueError(f"marca msgpack no soportada: 0x{marca:02x}")
+    if tipo in ("s", "b"):
+        if pos + n > len(datos):
+            raise ValueError("marco msgpack incompleto")
+        crudo = bytes(datos[pos:pos + n])
+        return (crudo.decode("utf-8") if tipo == "s" else crudo), pos + n
+    if tipo == "a":
+        lista = []
+        for _ in range(n):
+            v, pos = _desempaquetar_msgpack(datos, pos)
+            lista.append(v)
+        return lista, pos
+    mapa = {}
+    for _ in range(n):
+        k, pos = _desempaquetar_msgpack(datos, pos)
+        mapa[k], pos = _desempaquetar_msgpack(datos, pos)
+    return mapa, pos
+
+
+def empaquetar_msgpack(valor):
+    if MSGPACK_AVAILABLE:
+        return msgpack.packb(valor, use_bin_type=True)
+    salida = bytearray()
+    _empaquetar_msgpack(valor, salida)
+    return bytes(salida)
+
+
+def desempaquetar_msgpack(datos):
+    if MSGPACK_AVAILABLE:
+        try:
+            return msgpack.unpackb(datos, raw=False)
+        except Exception as e:
+            raise ValueError(f"marco msgpack inválido: {e}") from None
+    valor, pos = _desempaquetar_msgpack(datos)
+    if pos != len(datos):
+        raise ValueError("sobran bytes después del valor msgpack")
+    return valor
+
+
+def codificar_chat(datos, formato=FORMATO_CHAT_JSON):
+    """Marco del chat para `datos` (dict con type, sender, text, ts...): texto JSON o bytes del marco binario."""
+    if formato != FORMATO_CHAT_BINARIO:
+        return json.dumps(datos, ensure_ascii=False)
+    resto = dict(datos)
+    tipo = resto.pop("type", None)
+    codigo = _CODIGOS_TIPO_CHAT.get(tipo, 0)
+    if codigo == 0 and tipo is not None:
+        resto["type"] = tipo
+    ts = resto.pop("ts", None)
+    try:
+        ms = _a_ms(ts) or 0
+    except (TypeError, ValueError):
+        # una fecha que no es ISO viaja tal cual en el cuerpo
+        ms = 0
+        resto["ts"] = ts
+    return _CABECERA_CHAT.pack(VERSION_CHAT, codigo, ms) + empaquetar_msgpack(resto)
+
+
+def decodificar_chat(marco):
+    """
+    Inversa de codificar_chat: un marco de texto se lee como JSON y uno binario
+    con la cabecera (la fecha vuelve como texto ISO). ValueError si no es válido.
+    """
+    if isinstance(marco, str):
+        return json.loads(marco)
+    marco = bytes(marco)
+    if len(marco) < _CABECERA_CHAT.size:
+        raise ValueError("marco de chat demasiado corto")
+    version, codigo, ms = _CABECERA_CHAT.unpack_from(marco)
+    if version != VERSION_CHAT:
+        raise ValueError(f"versión de marco de chat desconocida: {version}")
+    if codigo >= len(_TIPOS_CHAT):
+        raise ValueError(f"tipo de marco de chat desconocido: {codigo}")
+    resto = desempaquetar_msgpack(marco[_CABECERA_CHAT.size:])
+    if not isinstance(resto, dict):
+        raise ValueError("el cuerpo del marco de chat no es un mapa")
+    datos = {"type": _TIPOS_CHAT[codigo]} if codigo else {}
+    datos.update(resto)
+    if ms:
+        datos["ts"] = _ms_a_iso(ms)
+    return datos
+
+
+def elegir_formato_chat(ofrecidos, aceptados=FORMATOS_CHAT):
+    """El primero de `aceptados` que el cliente ofreció; JSON si no ofreció ninguno conocido."""
+    ofrecidos = ofrecidos if isinstance(ofrecidos, (list, tuple)) else ()
+    for formato in aceptados:
+        if formato in ofrecidos:
+            return formato
+    return FORMATO_CHAT_JSON
+
+
+def _opciones_compresion_ws(compresion, servidor):
+    """
+    Argumentos de websockets.serve/connect para permessage-deflate: None lo
+    desactiva, "deflate" usa la configuración de websockets y un dict va a la
+    fábrica de la extensión (server_max_window_bits, client_max_window_bits,
+    compress_settings={"memLevel": ...}...) para acotar la memoria por conexión.
+    """
+    if compresion is None or compresion == "deflate":
+        return {"compression": compresion}
+    from websockets.extensions import permessage_deflate
+    fabrica = (permessage_deflate.ServerPerMessageDeflateFactory if servidor
+               else permessage_deflate.ClientPerMessageDeflateFactory)
+    return {"compression": None, "extensions": [fabrica(**compresion)]}
 
 
 # ==========================
@@ -365,11 +4483,16 @@ class BroadcastServer:
     """
     Simple broadcast server: every received message is forwarded to all connected clients.
     Runs in its own thread with its own asyncio loop.
+    Each client gets frames in the format it negotiated at join (see codificar_chat);
+    `compresion` configures permessage-deflate (see _opciones_compresion_ws).
     """
-    def __init__(self, host=DEFAULT_WS_HOST, port=DEFAULT_WS_PORT):
+    def __init__(self, host=DEFAULT_WS_HOST, port=DEFAULT_WS_PORT, compresion="deflate", formatos=FORMATOS_CHAT):
         self.host = host
         self.port = port
-        self.clients = set()
+        self.compresion = compresion
+        self.formatos = formatos
+        # cliente -> formato de chat negociado (JSON hasta que se une ofreciendo otro)
+        self.clients = {}
         self.loop = None
         self._thread = None
         self._lock = threading.Lock()
@@ -377,21 +4500,33 @@ class BroadcastServer:
     async def handler(self, websocket, *args):
         # Register
         with self._lock:
-            self.clients.add(websocket)
+            self.clients[websocket] = FORMATO_CHAT_JSON
         print("Cliente conectado (broadcast). Total:", len(self.clients))
 
         try:
             async for msg in websocket:
-                # Difundir mensaje en bruto a todos los clientes
-                await self.broadcast(msg)
+                try:
+                    datos = decodificar_chat(msg)
+                except ValueError:
+                    datos = None
+                if not isinstance(datos, dict):
+                    # no es un marco del protocolo: se difunde en bruto, como siempre
+                    await self.broadcast(msg)
+                    continue
+                if datos.get("type") == "join" and "formatos" in datos:
+                    formato = elegir_formato_chat(datos["formatos"], self.formatos)
+                    with self._lock:
+                        self.clients[websocket] = formato
+                    await self._safe_send(websocket, codificar_chat(
+                        {"type": "bienvenida", "formato": formato, "version": VERSION_CHAT}))
+                await self.broadcast(datos, msg)
         except websockets.ConnectionClosed:
             pass
         except Exception as e:
             print("Handler error:", e)
         finally:
             with self._lock:
-                if websocket in self.clients:
-                    self.clients.remove(websocket)
+                self.clients.pop(websocket, None)
             print("Cliente desconectado (broadcast). Total:", len(self.clients))
 
     async def _safe_send(self, ws, message):
@@ -400,16 +4535,38 @@ class BroadcastServer:
         except Exception:
             pass
 
-    async def broadcast(self, message):
+    async def broadcast(self, message, original=None):
         with self._lock:
-            clients = list(self.clients)
+            clients = list(self.clients.items())
         if not clients:
             return
-        await asyncio.gather(*(self._safe_send(c, message) for c in clients), return_exceptions=True)
+        envios = self.preparar_difusion(message, clients, original)
+        await asyncio.gather(*(self._safe_send(c, marco) for c, marco in envios), return_exceptions=True)
+
+    @staticmethod
+    def preparar_difusion(message, clients, original=None):
+        """
+        [(cliente, marco)] para difundir `message` a `clients` ([(cliente, formato)]).
+        Un dict se codifica una sola vez por formato y todos los clientes de ese
+        formato reciben el mismo objeto; `original` (el marco tal como llegó) se
+        reutiliza para los de su formato. Cualquier otro valor va tal cual.
+        """
+        if not isinstance(message, dict):
+            return [(c, message) for c, _formato in clients]
+        marcos = {}
+        if original is not None:
+            marcos[FORMATO_CHAT_JSON if isinstance(original, str) else FORMATO_CHAT_BINARIO] = original
+        envios = []
+        for c, formato in clients:
+            if formato not in marcos:
+                marcos[formato] = codificar_chat(message, formato)
+            envios.append((c, marcos[formato]))
+        return envios
 
     async def start_async(self):
         print(f"Starting Broadcast WS server on {self.host}:{self.port}")
-        async with websockets.serve(self.handler, self.host, self.port):
+        async with websockets.serve(self.handler, self.host, self.port,
+                                    **_opciones_compresion_ws(self.compresion, servidor=True)):
             await asyncio.Future()  # correr para siempre
 
     def _run_loop(self):
@@ -436,10 +4593,14 @@ class WSClient:
     Client that receives broadcast messages. Runs a simple asyncio loop in a thread.
     Note: uses websockets.connect and listens for incoming messages.
     """
-    def __init__(self, uri, incoming_queue: queue.Queue, sender_name="anon"):
+    def __init__(self, uri, incoming_queue: queue.Queue, sender_name="anon", formatos=FORMATOS_CHAT, compresion="deflate"):
         self.uri = uri
         self.incoming = incoming_queue
         self.sender_name = sender_name
+        # formatos que se ofrecen al unirse; hasta la bienvenida del servidor se habla JSON
+        self.formatos = formatos
+        self.formato = FORMATO_CHAT_JSON
+        self.compresion = compresion
         self._stop = threading.Event()
         self._thread = None
         self._ws = None
@@ -467,25 +4628,35 @@ class WSClient:
 
     async def _main(self):
         try:
-            async with websockets.connect(self.uri) as ws:
+            async with websockets.connect(self.uri, **_opciones_compresion_ws(self.compresion, servidor=False)) as ws:
                 self._ws = ws
-                # informa al servidor sobre el remitente
+                # informa al servidor sobre el remitente y los formatos que entiende (el join siempre en JSON)
                 try:
-                    await ws.send(json.dumps({"type":"join","sender":self.sender_name,"ts":datetime.datetime.now().isoformat()}))
+                    await ws.send(codificar_chat({"type": "join", "sender": self.sender_name,
+                                                  "ts": datetime.datetime.now().isoformat(), "formatos": list(self.formatos)}))
                 except Exception:
                     pass
                 async for message in ws:
-                    # Intentar analizar json, de lo contrario entrega mensaje crudo
+                    # Intentar analizar el marco (JSON o binario), de lo contrario entrega mensaje crudo
                     try:
-                        data = json.loads(message)
+                        data = decodificar_chat(message)
                     except Exception:
                         data = {"type":"raw","raw":message}
+                    if isinstance(data, dict) and data.get("type") == "bienvenida":
+                        # el servidor eligió el formato: desde ahora se envía en ése
+                        if data.get("formato") in self.formatos:
+                            self.formato = data["formato"]
+                        continue
                     self.incoming.put(data)
                     if self._stop.is_set():
                         break
         except Exception as e:
             self.incoming.put({"type":"error","msg":str(e)})
 
+    def enviar_chat(self, datos):
+        # Codifica en el formato negociado y envía
+        self.send(codificar_chat(datos, self.formato))
+
     def send(self, text):
         # Enviar a través de la conexión ws abierta si está disponible 
         if self._loop and self._ws:
@@ -524,6 +4695,228 @@ def ws_send_in_thread(uri, text, incoming):
         pass
 
 
+# ==========================
+# Lista virtual (Treeview que sólo tiene las filas visibles)
+# ==========================
+class FuentePaginada:
+    """
+    Datos de una ListaVirtual leídos por páginas. `contar()` da el total,
+    `leer(offset, limite, orden)` devuelve los objetos de una página (orden es
+    None o (clave, descendente), ver _orden_sql) y `fila(obj)` los convierte en
+    (iid, valores, tags). Guarda las últimas `max_paginas` páginas leídas.
+    """
+    def __init__(self, contar, leer, fila, tam_pagina=100, max_paginas=20):
+        self._contar = contar
+        self._leer = leer
+        self._fila = fila
+        self.tam_pagina = tam_pagina
+        self.max_paginas = max_paginas
+        self.orden = None
+        self._paginas = collections.OrderedDict()
+        self._total = None
+
+    def total(self):
+        if self._total is None:
+            self._total = self._contar()
+        return self._total
+
+    def filas(self, desde, cantidad):
+        """Filas [desde, desde + cantidad) dentro del total; lee sólo las páginas que falten."""
+        desde = max(0, desde)
+        resultado = []
+        i, fin = desde, min(desde + cantidad, self.total())
+        while i < fin:
+            numero = i // self.tam_pagina
+            base = numero * self.tam_pagina
+            pagina = self._pagina(numero)
+            trozo = pagina[i - base:fin - base]
+            if len(pagina) < self.tam_pagina:
+                # página incompleta: se borraron filas desde que se contó, el total se corrige
+                self._total = base + len(pagina)
+                fin = min(fin, self._total)
+            if not trozo:
+                break
+            resultado.extend(trozo)
+            i += len(trozo)
+        return resultado
+
+    def _pagina(self, numero):
+        pagina = self._paginas.get(numero)
+        if pagina is not None:
+            self._paginas.move_to_end(numero)
+            return pagina
+        pagina = [self._fila(o) for o in self._leer(numero * self.tam_pagina, self.tam_pagina, self.orden)]
+        self._paginas[numero] = pagina
+        while len(self._paginas) > self.max_paginas:
+            self._paginas.popitem(last=False)
+        return pagina
+
+    def ordenar(self, clave, descendente=False):
+        self.orden = (clave, descendente) if clave is not None else None
+        self.invalidar()
+
+    def invalidar(self):
+        self._paginas.clear()
+        self._total = None
+
+
+class ListaVirtual(ttk.Frame):
+    """
+    Treeview para listados muy largos: sólo existen como ítems las filas que se
+    ven; al desplazarse se reemplazan por las de la nueva posición, leídas de la
+    FuentePaginada (que además precarga `margen` filas antes y después).
+    Las columnas de `ordenables` ({columna: clave de ORDENES_MENSAJES}) ordenan
+    al hacer clic en el encabezado, con ORDER BY en la consulta.
+    La selección se guarda por iid, así se conserva al desplazarse.
+    """
+    def __init__(self, master, columnas, fuente=None, anchos=None, ordenables=None, margen=50, selectmode="extended"):
+        super().__init__(master)
+        self.columnas = columnas
+        self.ordenables = ordenables or {}
+        self.margen = margen
+        self.fuente = None
+        self.inicio = 0
+        self.visibles = 20
+        self._seleccion = set()
+        self.tree = ttk.Treeview(self, columns=columnas, show="headings", selectmode=selectmode)
+        self.barra = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self._barra)
+        self.barra.pack(side=tk.RIGHT, fill=tk.Y)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        for c in columnas:
+            if c in self.ordenables:
+                self.tree.heading(c, text=c.capitalize(), command=lambda c=c: self._ordenar(c))
+            else:
+                self.tree.heading(c, text=c.capitalize())
+            self.tree.column(c, width=(anchos or {}).get(c, 120))
+        self.tree.bind("<Configure>", self._al_redimensionar)
+        self.tree.bind("<<TreeviewSelect>>", self._al_seleccionar)
+        self.tree.bind("<ButtonPress-1>", self._al_clic)
+        self.tree.bind("<MouseWheel>", self._rueda)
+        self.tree.bind("<Button-4>", self._rueda)
+        self.tree.bind("<Button-5>", self._rueda)
+        self.tree.bind("<Up>", lambda e: self._mover_foco(-1))
+        self.tree.bind("<Down>", lambda e: self._mover_foco(1))
+        self.tree.bind("<Prior>", lambda e: self._mover_foco(-self.visibles))
+        self.tree.bind("<Next>", lambda e: self._mover_foco(self.visibles))
+        self.tree.bind("<Home>", lambda e: self._desplazar_a(0) or "break")
+        self.tree.bind("<End>", lambda e: self._desplazar_a(self._total()) or "break")
+        if fuente is not None:
+            self.cambiar_fuente(fuente)
+
+    def tag_configure(self, *args, **kwargs):
+        self.tree.tag_configure(*args, **kwargs)
+
+    def cambiar_fuente(self, fuente):
+        self.fuente = fuente
+        self.inicio = 0
+        self._seleccion.clear()
+        self._dibujar()
+
+    def refrescar(self):
+        # Relee desde la base manteniendo la posición (después de borrar, marcar, etc.)
+        if self.fuente is not None:
+            self.fuente.invalidar()
+        self._dibujar()
+
+    def seleccion(self):
+        return list(self._seleccion)
+
+    def _total(self):
+        return self.fuente.total() if self.fuente is not None else 0
+
+    def _desplazar_a(self, inicio):
+        inicio = max(0, min(inicio, self._total() - self.visibles))
+        if inicio != self.inicio:
+            self.inicio = inicio
+            self._dibujar()
+
+    def _dibujar(self):
+        self.tree.delete(*self.tree.get_children())
+        if self.fuente is None:
+            self.barra.set(0, 1)
+            return
+        self.inicio = max(0, min(self.inicio, self.fuente.total() - self.visibles))
+        antes = min(self.inicio, self.margen)
+        filas = self.fuente.filas(self.inicio - antes, antes + self.visibles + self.margen)
+        visibles = filas[antes:antes + self.visibles]
+        for iid, valores, tags in visibles:
+            if not self.tree.exists(iid):
+                self.tree.insert("", tk.END, iid=iid, values=valores, tags=tags)
+        self.tree.selection_set([iid for iid, _v, _t in visibles if iid in self._seleccion])
+        total = self.fuente.total()
+        if total:
+            self.barra.set(self.inicio / total, (self.inicio + len(visibles)) / total)
+        else:
+            self.barra.set(0, 1)
+
+    def _ordenar(self, columna):
+        if self.fuente is None:
+            return
+        clave = self.ordenables[columna]
+        actual = self.fuente.orden
+        descendente = bool(actual and actual[0] == clave and not actual[1])
+        self.fuente.ordenar(clave, descendente)
+        for c in self.columnas:
+            texto = c.capitalize()
+            if c == columna:
+                texto += " ▼" if descendente else " ▲"
+            self.tree.heading(c, text=texto)
+        self.inicio = 0
+        self._dibujar()
+
+    def _barra(self, accion, *args):
+        if accion == tk.MOVETO:
+            self._desplazar_a(int(float(args[0]) * self._total()))
+        elif accion == tk.SCROLL:
+            paso = int(args[0]) * (self.visibles if args[1] == tk.PAGES else 1)
+            self._desplazar_a(self.inicio + paso)
+
+    def _rueda(self, evento):
+        arriba = evento.num == 4 or getattr(evento, "delta", 0) > 0
+        self._desplazar_a(self.inicio + (-3 if arriba else 3))
+        return "break"
+
+    def _mover_foco(self, delta):
+        # Flechas y avance de página: mueven la fila activa y desplazan la ventana al pasar el borde
+        hijos = self.tree.get_children()
+        if not hijos:
+            return "break"
+        foco = self.tree.focus()
+        actual = self.inicio + (hijos.index(foco) if foco in hijos else 0)
+        destino = max(0, min(actual + delta, self._total() - 1))
+        if destino < self.inicio:
+            self._desplazar_a(destino)
+        elif destino >= self.inicio + len(hijos):
+            self._desplazar_a(destino - self.visibles + 1)
+        hijos = self.tree.get_children()
+        indice = destino - self.inicio
+        if 0 <= indice < len(hijos):
+            self._seleccion = {hijos[indice]}
+            self.tree.selection_set(hijos[indice])
+            self.tree.focus(hijos[indice])
+        return "break"
+
+    def _al_clic(self, evento):
+        # Clic sin Shift ni Control: la selección nueva reemplaza también a la que no está a la vista
+        if not evento.state & 0x0005:
+            self._seleccion.clear()
+
+    def _al_seleccionar(self, _evento=None):
+        fuera_de_vista = {iid for iid in self._seleccion if not self.tree.exists(iid)}
+        self._seleccion = fuera_de_vista | set(self.tree.selection())
+
+    def _al_redimensionar(self, evento):
+        # Cuántas filas entran: la altura de fila sale del estilo y el encabezado de la primera fila dibujada
+        alto_fila = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        hijos = self.tree.get_children()
+        caja = self.tree.bbox(hijos[0]) if hijos else ""
+        encabezado = caja[1] if caja else alto_fila + 4
+        visibles = max(1, (evento.height - encabezado) // alto_fila)
+        if visibles != self.visibles:
+            self.visibles = visibles
+            self._dibujar()
+
+
 # ==========================
 # Interfaz gráfica (Tkinter) extendida con Chat broadcast
 # ==========================
@@ -619,7 +5012,10 @@ class App(tk.Tk):
         toolbar = ttk.Frame(self, padding=8)
         toolbar.pack(fill=tk.X)
         ttk.Label(toolbar, text=f"Conectado como: {self.usuario_actual.nombre}").pack(side=tk.LEFT)
+        self.lbl_contadores = ttk.Label(toolbar, text="")
+        self.lbl_contadores.pack(side=tk.LEFT, padx=12)
         ttk.Button(toolbar, text="Nuevo mensaje", command=self._ventana_enviar).pack(side=tk.RIGHT)
+        ttk.Button(toolbar, text="Listas", command=self._crear_lista).pack(side=tk.RIGHT, padx=6)
         ttk.Button(toolbar, text="Mensajes Prioritarios", command=self._abrir_ventana_prioritarios).pack(side=tk.RIGHT, padx=6)
         ttk.Button(toolbar, text="Cerrar sesión", command=self._cerrar_sesion).pack(side=tk.RIGHT, padx=6)
         ttk.Button(toolbar, text="Eliminar usuario", command=self._eliminar_usuario).pack(side=tk.RIGHT, padx=6)
@@ -632,11 +5028,10 @@ class App(tk.Tk):
         left.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
 
         cols = ("id","asunto","remitente","fecha","prioridad")
-        self.tree = ttk.Treeview(left, columns=cols, show='headings')
-        for c in cols:
-            self.tree.heading(c, text=c.capitalize())
-            self.tree.column(c, width=120)
-        self.tree.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
+        self.lista = ListaVirtual(left, cols, ordenables={c: c for c in cols})
+        self.lista.tag_configure("no_leido", font=("TkDefaultFont", 9, "bold"))
+        self.lista.pack(fill=tk.BOTH, expand=True, side=tk.LEFT)
+        self._fuente_actual = None
 
         side = ttk.Frame(left, width=200)
         side.pack(fill=tk.Y, side=tk.RIGHT)
@@ -645,7 +5040,11 @@ class App(tk.Tk):
         ttk.Button(side, text="Buscar asunto", command=self._buscar_asunto).pack(fill=tk.X, pady=4)
         ttk.Button(side, text="Ver detalle", command=self._ver_detalle).pack(fill=tk.X, pady=4)
         ttk.Button(side, text="Eliminar", command=self._eliminar_mensaje).pack(fill=tk.X, pady=4)
+        ttk.Button(side, text="Marcar como spam", command=self._marcar_spam).pack(fill=tk.X, pady=4)
         ttk.Button(side, text="Papelera", command=self._abrir_papelera).pack(fill=tk.X, pady=4)
+        ttk.Button(side, text="Conversaciones", command=self._abrir_conversaciones).pack(fill=tk.X, pady=4)
+        ttk.Button(side, text="Carpetas", command=self._abrir_carpetas).pack(fill=tk.X, pady=4)
+        ttk.Button(side, text="Reglas", command=self._abrir_reglas).pack(fill=tk.X, pady=4)
 
         # Right: Chat panel
         chat_frame = ttk.Frame(content, width=360, padding=6)
@@ -737,20 +5136,19 @@ class App(tk.Tk):
             return
         uri = f"ws://{host}"
 
-        # Enviamos JSON para que los clientes receptores puedan analizarlo
-        payload = json.dumps({
+        datos = {
             "type": "msg",
             "sender": self.usuario_actual.nombre if self.usuario_actual else "anon",
             "text": text,
             "ts": datetime.datetime.now().isoformat()
-        }, ensure_ascii=False)
+        }
 
-        # Si tenemos una conexión ws_client en vivo, usamos su método de envío 
+        # Si tenemos una conexión ws_client en vivo, envía en el formato que negoció
         if self.ws_client:
-            self.ws_client.send(payload)
+            self.ws_client.enviar_chat(datos)
         else:
-            # usa conexión de corta duración
-            threading.Thread(target=ws_send_in_thread, args=(uri, payload, self.ws_incoming), daemon=True).start()
+            # usa conexión de corta duración, en JSON (sin join no hay negociación)
+            threading.Thread(target=ws_send_in_thread, args=(uri, codificar_chat(datos), self.ws_incoming), daemon=True).start()
 
         # Mostrar localmente también
         ts = datetime.datetime.now().isoformat()
@@ -794,20 +5192,40 @@ class App(tk.Tk):
             self.db.limpiar_papelera()
         except Exception:
             pass
-        if not hasattr(self, 'tree'):
+        if not hasattr(self, 'lista'):
             return
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-        mensajes = self.db.obtener_mensajes_para_usuario(self.usuario_actual.id_usuario)
-        for m in mensajes:
-            self.tree.insert('', tk.END, values=(m.id_mensaje, m.asunto, m.remitente_id, m.fecha_envio, m.prioridad))
+        # la lista pide a la base sólo las páginas que se ven; al volver de una búsqueda se cambia la fuente
+        if self._fuente_actual == "bandeja":
+            self.lista.refrescar()
+        else:
+            self._fuente_actual = "bandeja"
+            self.lista.cambiar_fuente(self._fuente_bandeja())
+        self._actualizar_contadores()
+
+    def _fila_bandeja(self, m):
+        return (str(m.id_mensaje), (m.id_mensaje, m.asunto, m.remitente_id, m.fecha_envio, m.prioridad),
+                () if m.leido else ("no_leido",))
 
-    def _ventana_enviar(self):
+    def _fuente_bandeja(self):
+        uid = self.usuario_actual.id_usuario
+        return FuentePaginada(
+            lambda: self.db.contadores(uid)["bandeja"],
+            lambda offset, limite, orden: self.db.obtener_mensajes_para_usuario(uid, limite, offset, orden=orden),
+            self._fila_bandeja)
+
+    def _actualizar_contadores(self):
+        if not hasattr(self, 'lbl_contadores') or not self.usuario_actual:
+            return
+        n = self.db.contadores(self.usuario_actual.id_usuario)
+        self.lbl_contadores.config(text=f"Bandeja: {n['bandeja']}  No leídos: {n['no_leidos']}  "
+                                        f"Prioritarios: {n['prioritarios']}  Papelera: {n['papelera']}")
+
+    def _ventana_enviar(self, respuesta_a=None):
         top = tk.Toplevel(self)
-        top.title("Enviar mensaje")
+        top.title("Enviar mensaje" if respuesta_a is None else "Responder")
         top.geometry("420x360")
 
-        ttk.Label(top, text="Destinatario (ID):").pack(pady=4)
+        ttk.Label(top, text="Destinatario(s) (IDs separados por coma o @lista):").pack(pady=4)
         ent_dest = ttk.Entry(top)
         ent_dest.pack(fill=tk.X, padx=8)
 
@@ -824,11 +5242,34 @@ class App(tk.Tk):
         ent_prio.insert(0, "5")
         ent_prio.pack(fill=tk.X, padx=8)
 
+        if respuesta_a is not None:
+            yo = self.usuario_actual.id_usuario
+            ent_dest.insert(0, str(respuesta_a.remitente_id if respuesta_a.remitente_id != yo else respuesta_a.destinatario_id))
+            asunto = respuesta_a.asunto or ""
+            ent_asunto.insert(0, asunto if asunto.lower().startswith("re:") else "Re: " + asunto)
+
+        archivos = []
+        lbl_adjuntos = ttk.Label(top, text="Sin adjuntos")
+
+        def adjuntar():
+            rutas = filedialog.askopenfilenames(parent=top)
+            archivos.extend(rutas)
+            if archivos:
+                lbl_adjuntos.config(text=", ".join(os.path.basename(r) for r in archivos))
+
+        ttk.Button(top, text="Adjuntar archivo", command=adjuntar).pack(pady=4)
+        lbl_adjuntos.pack(padx=8)
+        # una clave por ventana: un doble clic o un reintento devuelven el mismo envío
+        clave = uuid.uuid4().hex
+
         def enviar_accion():
             try:
-                dest_id = int(ent_dest.get())
-            except Exception:
-                messagebox.showerror("Error", "ID destinatario inválido")
+                destinatarios = self.sistema.resolver_destinatarios(self.usuario_actual.id_usuario, ent_dest.get())
+            except ValueError as e:
+                messagebox.showerror("Error", f"Destinatario inválido: {e}")
+                return
+            if not destinatarios:
+                messagebox.showerror("Error", "Indique al menos un destinatario")
                 return
             asunto = ent_asunto.get()
             cuerpo = txt_cuerpo.get("1.0", tk.END).strip()
@@ -839,12 +5280,34 @@ class App(tk.Tk):
             if not cuerpo:
                 messagebox.showerror("Error", "Cuerpo vacío")
                 return
-            m = Mensaje(id_mensaje=None, asunto=asunto, cuerpo=cuerpo, remitente_id=self.usuario_actual.id_usuario, destinatario_id=dest_id, prioridad=prioridad)
-            estado, mid = self.sistema.enviar(m)
+            m = Mensaje(id_mensaje=None, asunto=asunto, cuerpo=cuerpo, remitente_id=self.usuario_actual.id_usuario, destinatario_id=destinatarios[0], prioridad=prioridad,
+                        en_respuesta_a=respuesta_a.id_mensaje if respuesta_a is not None else None,
+                        clave_idempotencia=clave)
+            try:
+                for ruta in archivos:
+                    self.sistema.adjuntar_archivo(m, ruta)
+            except OSError as e:
+                messagebox.showerror("Error", f"No se pudo adjuntar: {e}")
+                return
+            estado, mid = self.sistema.enviar(m, destinatarios)
             if estado == "eliminado":
                 messagebox.showinfo("Filtro", "Mensaje eliminado por filtro")
             elif estado == "cola":
                 messagebox.showinfo("Enviado", f"Mensaje guardado y puesto en cola prioritaria (id={mid})")
+            elif estado == "spam":
+                messagebox.showinfo("Enviado", f"Mensaje entregado en la carpeta {CARPETA_SPAM} del destinatario")
+            elif estado == "limitado":
+                messagebox.showwarning("No enviado", "Está enviando demasiados mensajes seguidos; intente de nuevo en unos segundos")
+                return
+            elif estado == "ocupado":
+                messagebox.showwarning("No enviado", "El sistema está ocupado; intente de nuevo")
+                return
+            elif estado == "encolado":
+                top.destroy()
+                self._al_confirmar_envio(mid)
+                return
+            elif estado == "duplicado":
+                messagebox.showinfo("Enviado", "Este mensaje ya se había enviado")
             else:
                 messagebox.showinfo("Enviado", "Mensaje enviado y guardado")
             top.destroy()
@@ -852,40 +5315,83 @@ class App(tk.Tk):
 
         ttk.Button(top, text="Enviar", command=enviar_accion).pack(pady=6)
 
+    def _al_confirmar_envio(self, futuro):
+        # El escritor confirma en su hilo: el futuro se consulta desde el bucle de Tk
+        if not futuro.done():
+            self.after(50, self._al_confirmar_envio, futuro)
+            return
+        if futuro.exception() is not None:
+            messagebox.showerror("Error", f"No se pudo guardar el mensaje: {futuro.exception()}")
+            return
+        estado, mid = futuro.result()
+        if estado == "cola":
+            messagebox.showinfo("Enviado", f"Mensaje guardado y puesto en cola prioritaria (id={mid})")
+        elif estado == "spam":
+            messagebox.showinfo("Enviado", f"Mensaje entregado en la carpeta {CARPETA_SPAM} del destinatario")
+        elif estado == "duplicado":
+            messagebox.showinfo("Enviado", "Este mensaje ya se había enviado")
+        else:
+            messagebox.showinfo("Enviado", "Mensaje enviado y guardado")
+        self._cargar_bandeja()
+
+    def _crear_lista(self):
+        existentes = ", ".join("@" + nombre for _id, nombre in self.db.listar_listas(self.usuario_actual.id_usuario))
+        nombre = simpledialog.askstring("Listas de distribución", f"Listas actuales: {existentes or '(ninguna)'}\n\nNombre de la nueva lista:", parent=self)
+        if not nombre:
+            return
+        miembros = simpledialog.askstring("Listas de distribución", "IDs de los miembros (separados por coma):", parent=self)
+        try:
+            ids = [int(x) for x in (miembros or "").split(",") if x.strip()]
+        except ValueError:
+            messagebox.showerror("Error", "IDs inválidos")
+            return
+        if self.db.crear_lista(self.usuario_actual.id_usuario, nombre.strip().lstrip("@"), ids) is None:
+            messagebox.showerror("Error", "Ya existe una lista con ese nombre")
+            return
+        messagebox.showinfo("OK", f"Lista @{nombre.strip().lstrip('@')} creada con {len(ids)} miembro(s)")
+
     def _buscar_asunto(self):
         termino = simpledialog.askstring("Buscar", "Asunto contiene:", parent=self)
         if termino is None:
             return
-        resultados = self.db.buscar_mensajes(self.usuario_actual.id_usuario, "asunto", termino)
-        for i in self.tree.get_children():
-            self.tree.delete(i)
-        for m in resultados:
-            self.tree.insert('', tk.END, values=(m.id_mensaje, m.asunto, m.remitente_id, m.fecha_envio, m.prioridad))
+        uid = self.usuario_actual.id_usuario
+        self._fuente_actual = "busqueda"
+        self.lista.cambiar_fuente(FuentePaginada(
+            lambda: self.db.contar_busqueda(uid, "asunto", termino),
+            lambda offset, limite, orden: self.db.buscar_mensajes(uid, "asunto", termino, limite, offset, orden=orden),
+            self._fila_bandeja))
 
     def _eliminar_mensaje(self):
-        sel = self.tree.selection()
+        sel = self.lista.seleccion()
+        if not sel:
+            messagebox.showinfo("Info", "Seleccione un mensaje")
+            return
+        ids = [int(s) for s in sel]
+        self.db.marcar_eliminados(ids)
+        messagebox.showinfo("Eliminado", "Mensaje(s) movido(s) a papelera (4 días y 20 hs)")
+        self._cargar_bandeja()
+
+    def _marcar_spam(self):
+        sel = self.lista.seleccion()
         if not sel:
             messagebox.showinfo("Info", "Seleccione un mensaje")
             return
-        mid = self.tree.item(sel[0])['values'][0]
-        self.db.marcar_eliminado(mid)
-        messagebox.showinfo("Eliminado", "Mensaje movido a papelera (4 días y 20 hs)")
+        ids = [int(s) for s in sel]
+        # sólo lo que el usuario marca como spam (no cualquier borrado) es ejemplo de spam para el clasificador
+        self.sistema.aprender_spam(ids, True)
+        self.db.mover_a_carpeta(ids, CARPETA_SPAM)
         self._cargar_bandeja()
 
     def _ver_detalle(self):
-        sel = self.tree.selection()
+        sel = self.lista.seleccion()
         if not sel:
             messagebox.showinfo("Info", "Seleccione un mensaje")
             return
-        item = self.tree.item(sel[0])
-        mid = item['values'][0]
-        c = self.db.conn.cursor()
-        c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE id = ?", (mid,))
-        row = c.fetchone()
-        if not row:
+        mid = int(sel[0])
+        m = self.db.obtener_mensaje(mid)
+        if not m:
             messagebox.showerror("Error", "Mensaje no encontrado")
             return
-        m = Mensaje.from_row(row)
         top = tk.Toplevel(self)
         top.title(f"Mensaje {m.id_mensaje}")
         ttk.Label(top, text=f"Asunto: {m.asunto}").pack(anchor=tk.W, padx=8, pady=4)
@@ -896,16 +5402,47 @@ class App(tk.Tk):
         txt.pack(fill=tk.BOTH, expand=True, padx=8, pady=6)
         txt.insert(tk.END, m.cuerpo)
         txt.config(state=tk.DISABLED)
+        self._panel_adjuntos(top, m)
+        ttk.Button(top, text="Responder", command=lambda: self._ventana_enviar(respuesta_a=m)).pack(pady=4)
+        if not m.leido:
+            self.db.marcar_leido(m.id_mensaje)
+            self.lista.refrescar()
+            self._actualizar_contadores()
+
+    def _panel_adjuntos(self, top, m):
+        if not m.adjuntos:
+            return
+        ttk.Label(top, text="Adjuntos:").pack(anchor=tk.W, padx=8)
+        lst = tk.Listbox(top, height=min(len(m.adjuntos), 5))
+        lst.pack(fill=tk.X, padx=8)
+        for a in m.adjuntos:
+            lst.insert(tk.END, f"{a['nombre']} ({a['tamaño']} bytes)")
+
+        def guardar_adjunto():
+            sel = lst.curselection()
+            if not sel:
+                messagebox.showinfo("Info", "Seleccione un adjunto", parent=top)
+                return
+            a = m.adjuntos[sel[0]]
+            destino = filedialog.asksaveasfilename(parent=top, initialfile=a["nombre"])
+            if not destino:
+                return
+            try:
+                self.db.copiar_adjunto(m.id_mensaje, a["sha256"], destino)
+            except Exception as e:
+                messagebox.showerror("Error", f"No se pudo guardar el adjunto: {e}", parent=top)
+
+        ttk.Button(top, text="Guardar adjunto", command=guardar_adjunto).pack(pady=4)
 
     def _priorizar_seleccionado(self):
-        sel = self.tree.selection()
+        sel = self.lista.seleccion()
         if not sel:
             messagebox.showinfo("Info", "Seleccione un mensaje para priorizar")
             return
-        mid = self.tree.item(sel[0])['values'][0]
+        ids = [int(s) for s in sel]
         try:
-            self.db.marcar_prioritario(mid)
-            messagebox.showinfo("OK", "Mensaje marcado como prioritario y movido a la ventana de Prioritarios")
+            self.db.marcar_prioritarios(ids)
+            messagebox.showinfo("OK", "Mensaje(s) marcado(s) como prioritario(s) y movido(s) a la ventana de Prioritarios")
             self._cargar_bandeja()
         except Exception as e:
             messagebox.showerror("Error", f"No se pudo priorizar el mensaje")
@@ -922,45 +5459,207 @@ class App(tk.Tk):
         if not messagebox.askyesno("Confirmar", "¿Seguro que desea eliminar su usuario?\nSe borrarán TODOS sus mensajes enviados y recibidos.\nEsta acción no se puede deshacer."):
             return
         uid = self.usuario_actual.id_usuario
-        c = self.db.conn.cursor()
-        c.execute("DELETE FROM mensajes WHERE remitente_id = ? OR destinatario_id = ?", (uid, uid))
-        c.execute("DELETE FROM usuarios WHERE id = ?", (uid,))
-        self.db.conn.commit()
-        messagebox.showinfo("Cuenta eliminada", "El usuario y sus mensajes han sido eliminados.")
+        # los mensajes se borran por tandas en segundo plano para no bloquear al resto de los usuarios
+        self.db.eliminar_usuario_en_segundo_plano(uid)
+        messagebox.showinfo("Cuenta eliminada", "El usuario fue eliminado. Sus mensajes se están borrando en segundo plano.")
         self.usuario_actual = None
         for widget in self.winfo_children():
             widget.destroy()
         self._crear_widgets_inicio()
     
+    def _fila_con_nombres(self, nombres):
+        # Fila con nombres de remitente y destinatario; `nombres` evita releer el usuario en cada página
+        def nombre(uid):
+            if uid not in nombres:
+                u = self.db.obtener_usuario_por_id(uid)
+                nombres[uid] = u.nombre if u else uid
+            return nombres[uid]
+
+        def fila(m):
+            return (str(m.id_mensaje), (m.id_mensaje, m.asunto or "", nombre(m.remitente_id),
+                                        nombre(m.destinatario_id), m.fecha_envio, m.prioridad), ())
+        return fila
+
     def _abrir_ventana_prioritarios(self):
         win = tk.Toplevel(self)
         win.title("Mensajes Prioritarios")
         win.geometry("700x400")
 
         cols = ("id","asunto","remitente","destinatario","fecha","prioridad")
+        uid = self.usuario_actual.id_usuario
+        # mensajes prioritarios desde la DB, de a una página por vez
+        lista = ListaVirtual(win, cols, FuentePaginada(
+            lambda: self.db.contadores(uid)["prioritarios"],
+            lambda offset, limite, orden: self.db.obtener_mensajes_prioritarios(uid, limite, offset, orden=orden),
+            self._fila_con_nombres({})), ordenables={c: c for c in cols})
+        lista.pack(fill=tk.BOTH, expand=True)
+
+        ttk.Button(win, text="Cerrar", command=win.destroy).pack(pady=8)
+
+    def _abrir_conversaciones(self):
+        win = tk.Toplevel(self)
+        win.title("Conversaciones")
+        win.geometry("760x420")
+        uid = self.usuario_actual.id_usuario
+        por_pagina = 50
+
+        cols = ("hilo", "asunto", "mensajes", "participantes", "ultima")
         tree = ttk.Treeview(win, columns=cols, show='headings')
+        for c in cols:
+            tree.heading(c, text=c.capitalize())
+            tree.column(c, width=130)
+        tree.column("asunto", width=260)
         tree.pack(fill=tk.BOTH, expand=True)
 
+        def cargar_mas():
+            # página siguiente del resumen: no agrupa el buzón
+            hilos = self.db.obtener_hilos(uid, limite=por_pagina, offset=len(tree.get_children()))
+            for h in hilos:
+                tree.insert('', tk.END, values=(h["hilo_id"], h["asunto"], h["mensajes"], h["participantes"], h["ultima_fecha"]))
+            if len(hilos) < por_pagina:
+                btn_mas.config(state=tk.DISABLED)
+
+        def ver_conversacion():
+            sel = tree.selection()
+            if not sel:
+                messagebox.showinfo("Info", "Seleccione una conversación")
+                return
+            hilo_id = tree.item(sel[0])['values'][0]
+            top = tk.Toplevel(win)
+            top.title(f"Conversación {hilo_id}")
+            txt = tk.Text(top, height=25, width=90)
+            txt.pack(fill=tk.BOTH, expand=True, padx=8, pady=6)
+            for m in self.db.obtener_hilo(hilo_id, uid):
+                txt.insert(tk.END, f"--- {m.fecha_envio}  De: {m.remitente_id} → {m.destinatario_id}  [{m.asunto}]\n{m.cuerpo}\n\n")
+            txt.config(state=tk.DISABLED)
+
+        btn_frame = ttk.Frame(win)
+        btn_frame.pack(fill=tk.X, pady=6)
+        ttk.Button(btn_frame, text="Ver conversación", command=ver_conversacion).pack(side=tk.LEFT, padx=4)
+        btn_mas = ttk.Button(btn_frame, text="Más", command=cargar_mas)
+        btn_mas.pack(side=tk.LEFT, padx=4)
+        ttk.Button(btn_frame, text="Cerrar", command=win.destroy).pack(side=tk.RIGHT, padx=4)
+        cargar_mas()
+
+    def _abrir_reglas(self):
+        win = tk.Toplevel(self)
+        win.title("Reglas")
+        win.geometry("640x420")
+        uid = self.usuario_actual.id_usuario
+
+        lst = tk.Listbox(win, height=10)
+        lst.pack(fill=tk.BOTH, expand=True, padx=8, pady=6)
+        reglas = []
+
+        def cargar():
+            reglas[:] = self.db.obtener_reglas(uid, solo_activas=False)
+            lst.delete(0, tk.END)
+            for r in reglas:
+                lst.insert(tk.END, f"{r.id_regla}: {r}")
+
+        form = ttk.Frame(win)
+        form.pack(fill=tk.X, padx=8)
+        cmb_campo = ttk.Combobox(form, values=Regla.CAMPOS, state="readonly", width=10)
+        cmb_campo.set("asunto")
+        ent_patron = ttk.Entry(form, width=24)
+        var_regex = tk.BooleanVar(value=False)
+        cmb_accion = ttk.Combobox(form, values=Regla.ACCIONES, state="readonly", width=10)
+        cmb_accion.set("mover")
+        ent_destino = ttk.Entry(form, width=14)
+        for i, (texto, widget) in enumerate((("Campo", cmb_campo), ("Patrón", ent_patron), ("Acción", cmb_accion), ("Carpeta", ent_destino))):
+            ttk.Label(form, text=texto).grid(row=0, column=i, sticky=tk.W)
+            widget.grid(row=1, column=i, padx=2)
+        ttk.Checkbutton(form, text="Regex", variable=var_regex).grid(row=1, column=4, padx=2)
+
+        def agregar():
+            try:
+                self.sistema.agregar_regla(uid, cmb_campo.get(), ent_patron.get(), cmb_accion.get(),
+                                           ent_destino.get().strip() or None, var_regex.get(), orden=len(reglas))
+            except ValueError as e:
+                messagebox.showerror("Error", str(e), parent=win)
+                return
+            cargar()
+
+        def borrar():
+            sel = lst.curselection()
+            if sel:
+                self.db.borrar_regla(reglas[sel[0]].id_regla, uid)
+                cargar()
+
+        def aplicar_al_buzon():
+            # en segundo plano (proceso aparte por lote) con su propia conexión al fragmento del
+            # usuario; el resultado vuelve al hilo de Tk con after()
+            base = self.db.fragmento(uid) if isinstance(self.db, BaseDatosFragmentada) else self.db
+
+            def trabajo():
+                db = base.conexion_de_trabajo()
+                try:
+                    r = self.sistema.refiltrar(uid, db=db)
+                    texto = (f"{r['revisados']} revisados: {r['papelera']} a papelera, "
+                             f"{r['prioridad']} prioritarios, {r['mover']} movidos")
+                except Exception as e:
+                    texto = f"Error al aplicar reglas: {e}"
+                finally:
+                    db.conn.close()
+                self.after(0, lambda: (messagebox.showinfo("Reglas", texto), self._cargar_bandeja()))
+            threading.Thread(target=trabajo, daemon=True).start()
+
+        btns = ttk.Frame(win)
+        btns.pack(fill=tk.X, pady=6)
+        ttk.Button(btns, text="Agregar", command=agregar).pack(side=tk.LEFT, padx=4)
+        ttk.Button(btns, text="Borrar", command=borrar).pack(side=tk.LEFT, padx=4)
+        ttk.Button(btns, text="Aplicar a mi buzón", command=aplicar_al_buzon).pack(side=tk.LEFT, padx=4)
+        ttk.Button(btns, text="Cerrar", command=win.destroy).pack(side=tk.RIGHT, padx=4)
+        cargar()
+
+    def _abrir_carpetas(self):
+        win = tk.Toplevel(self)
+        win.title("Carpetas")
+        win.geometry("760x400")
+        uid = self.usuario_actual.id_usuario
+
+        lst = tk.Listbox(win, width=22)
+        lst.pack(side=tk.LEFT, fill=tk.Y, padx=6, pady=6)
+        btn_volver = ttk.Button(win, text="Volver a la bandeja")
+        btn_volver.pack(side=tk.BOTTOM, pady=4)
+        cols = ("id", "asunto", "remitente", "fecha")
+        tree = ttk.Treeview(win, columns=cols, show='headings', selectmode="extended")
         for c in cols:
             tree.heading(c, text=c.capitalize())
-            tree.column(c, width=120)
+        tree.pack(fill=tk.BOTH, expand=True, padx=6, pady=6)
+        carpetas = []
 
-        # obtener mensajes prioritarios desde la DB
-        mensajes = self.db.obtener_mensajes_prioritarios(self.usuario_actual.id_usuario)
+        def cargar_carpetas():
+            lst.delete(0, tk.END)
+            carpetas.clear()
+            for nombre, n in self.db.listar_carpetas(uid):
+                carpetas.append(nombre)
+                lst.insert(tk.END, f"{nombre} ({n})")
 
-        for m in mensajes:
-            remit = self.db.obtener_usuario_por_id(m.remitente_id)
-            dest = self.db.obtener_usuario_por_id(m.destinatario_id)
-            tree.insert("", tk.END, values=(
-                m.id_mensaje,
-                m.asunto,
-                remit.nombre if remit else m.remitente_id,
-                dest.nombre if dest else m.destinatario_id,
-                m.fecha_envio,
-                m.prioridad
-            ))
+        def mostrar(_evento=None):
+            for i in tree.get_children():
+                tree.delete(i)
+            sel = lst.curselection()
+            if not sel:
+                return
+            for m in self.db.obtener_mensajes_carpeta(uid, carpetas[sel[0]]):
+                tree.insert('', tk.END, values=(m.id_mensaje, m.asunto, m.remitente_id, m.fecha_envio))
 
-        ttk.Button(win, text="Cerrar", command=win.destroy).pack(pady=8)
+        def volver_a_bandeja():
+            sel = tree.selection()
+            if not sel:
+                return
+            ids = [tree.item(s)['values'][0] for s in sel]
+            self.db.mover_a_carpeta(ids, None)
+            if carpetas[lst.curselection()[0]] == CARPETA_SPAM:
+                # rescatado de Spam: ejemplo de correo legítimo
+                self.sistema.aprender_spam(ids, False)
+            cargar_carpetas()
+            self._cargar_bandeja()
+
+        lst.bind("<<ListboxSelect>>", mostrar)
+        btn_volver.config(command=volver_a_bandeja)
+        cargar_carpetas()
 
     def _abrir_papelera(self):
         win = tk.Toplevel(self)
@@ -968,46 +5667,30 @@ class App(tk.Tk):
         win.geometry("800x450")
 
         cols = ("id","asunto","remitente","destinatario","fecha","prioridad")
-        tree = ttk.Treeview(win, columns=cols, show='headings')
-        tree.pack(fill=tk.BOTH, expand=True, side=tk.TOP, padx=6, pady=6)
-
-        for c in cols:
-            tree.heading(c, text=c.capitalize())
-            tree.column(c, width=130)
+        uid = self.usuario_actual.id_usuario
+        lista = ListaVirtual(win, cols, FuentePaginada(
+            lambda: self.db.contadores(uid)["papelera"],
+            lambda offset, limite, orden: self.db.obtener_mensajes_papelera(uid, limite, offset, orden=orden),
+            self._fila_con_nombres({})), anchos={c: 130 for c in cols}, ordenables={c: c for c in cols})
+        lista.pack(fill=tk.BOTH, expand=True, side=tk.TOP, padx=6, pady=6)
 
         # Frame de botones abajo
         btn_frame = ttk.Frame(win)
         btn_frame.pack(fill=tk.X, padx=6, pady=6)
 
         def cargar_lista():
-            for i in tree.get_children():
-                tree.delete(i)
-            mensajes = self.db.obtener_mensajes_papelera(self.usuario_actual.id_usuario)
-            for m in mensajes:
-                remit = self.db.obtener_usuario_por_id(m.remitente_id)
-                dest = self.db.obtener_usuario_por_id(m.destinatario_id)
-                tree.insert("", tk.END, iid=str(m.id_mensaje), values=(
-                    m.id_mensaje,
-                    m.asunto or "",
-                    remit.nombre if remit else m.remitente_id,
-                    dest.nombre if dest else m.destinatario_id,
-                    m.fecha_envio,
-                    m.prioridad
-                ))
+            lista.refrescar()
 
         def ver_detalle_papelera():
-            sel = tree.selection()
+            sel = lista.seleccion()
             if not sel:
                 messagebox.showinfo("Info", "Seleccione un mensaje")
                 return
             mid = int(sel[0])
-            c = self.db.conn.cursor()
-            c.execute("SELECT id, remitente_id, destinatario_id, asunto, cuerpo_json, fecha_envio, prioridad, eliminado_en, procesado_prioridad FROM mensajes WHERE id = ?", (mid,))
-            row = c.fetchone()
-            if not row:
+            m = self.db.obtener_mensaje(mid)
+            if not m:
                 messagebox.showerror("Error", "Mensaje no encontrado")
                 return
-            m = Mensaje.from_row(row)
             top = tk.Toplevel(win)
             top.title(f"Mensaje {m.id_mensaje}")
             top.geometry("600x400")
@@ -1022,18 +5705,16 @@ class App(tk.Tk):
             txt.config(state=tk.DISABLED)
 
         def restaurar_seleccionados():
-            sels = tree.selection()
+            sels = lista.seleccion()
             if not sels:
                 messagebox.showinfo("Info", "Seleccione al menos un mensaje para restaurar.")
                 return
             if not messagebox.askyesno("Confirmar", f"Restaurar {len(sels)} mensaje(s) a la bandeja de entrada?"):
                 return
-            for s in sels:
-                mid = int(s)
-                try:
-                    self.db.recuperar_mensaje(mid)   # esto pone eliminado_en = NULL
-                except Exception as e:
-                    messagebox.showerror("Error", f"No se pudo restaurar id={mid}: {e}")
+            try:
+                self.db.recuperar_mensajes([int(s) for s in sels])   # esto pone eliminado_ms = NULL
+            except Exception as e:
+                messagebox.showerror("Error", f"No se pudieron restaurar los mensajes: {e}")
             messagebox.showinfo("Restaurado", "Mensaje(s) restaurado(s).")
             cargar_lista()
             # refrescar bandeja principal
@@ -1043,18 +5724,16 @@ class App(tk.Tk):
                 pass
 
         def borrar_definitivo():
-            sels = tree.selection()
+            sels = lista.seleccion()
             if not sels:
                 messagebox.showinfo("Info", "Seleccione al menos un mensaje para borrar definitivamente.")
                 return
             if not messagebox.askyesno("Confirmar", f"Borrar DEFINITIVAMENTE {len(sels)} mensaje(s)? Esta acción no se puede deshacer."):
                 return
-            for s in sels:
-                mid = int(s)
-                try:
-                    self.db.borrar_mensaje_definitivo(mid)
-                except Exception as e:
-                    messagebox.showerror("Error", f"No se pudo borrar id={mid}: {e}")
+            try:
+                self.db.borrar_mensajes([int(s) for s in sels])
+            except Exception as e:
+                messagebox.showerror("Error", f"No se pudieron borrar los mensajes: {e}")
             messagebox.showinfo("Borrado", "Mensaje(s) eliminados permanentemente.")
             cargar_lista()
             try:
@@ -1068,14 +5747,292 @@ class App(tk.Tk):
         ttk.Button(btn_frame, text="Refrescar", command=cargar_lista).pack(side=tk.LEFT, padx=4)
         ttk.Button(btn_frame, text="Cerrar", command=win.destroy).pack(side=tk.RIGHT, padx=4)
 
-        # carga inicial
-        cargar_lista()
 
     
 
+# ==========================
+# Benchmarks (línea de comandos: `bench <nombre>`)
+# ==========================
+def _texto_de_prueba(rnd, palabras):
+    vocabulario = ["oferta", "reunión", "proyecto", "informe", "cliente", "semana", "entrega",
+                   "newsletter", "novedades", "precio", "equipo", "urgente", "gracias", "saludos"]
+    return " ".join(rnd.choice(vocabulario) for _ in range(palabras))
+
+
+def benchmark_compresion(n=2000, palabras=3000):
+    """Compara tamaño de la base y latencia de lectura con y sin compresión de cuerpos."""
+    rnd = random.Random(1)
+    cuerpos = [_texto_de_prueba(rnd, palabras) for _ in range(50)]
+    resultados = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        for codec in (None, "zlib", "lzma"):
+            ruta = os.path.join(tmp, f"bench_{codec}.db")
+            # sin deduplicar: los 50 cuerpos repetidos se guardarían una sola vez y no se mediría el codec
+            db = BaseDatos(ruta, codec_compresion=codec, umbral_dedup=None)
+            crear_usuarios_demo(db)
+            t0 = time.perf_counter()
+            for i in range(n):
+                db.guardar_mensaje(Mensaje(None, f"Asunto {i}", cuerpos[i % len(cuerpos)], 1, 2))
+            t_escritura = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            mensajes = db.obtener_mensajes_para_usuario(2)
+            t_lista = time.perf_counter() - t0
+            t0 = time.perf_counter()
+            for m in mensajes:
+                m.cuerpo
+            t_cuerpos = time.perf_counter() - t0
+            db.conn.close()
+            resultados[codec or "sin comprimir"] = {
+                "tamaño_mb": os.path.getsize(ruta) / 1e6,
+                "escritura_ms_por_msg": t_escritura * 1000 / n,
+                "lista_ms": t_lista * 1000,
+                "lectura_cuerpo_us_por_msg": t_cuerpos * 1e6 / n,
+            }
+    for nombre, r in resultados.items():
+        print(f"{nombre:>14}: {r['tamaño_mb']:.2f} MB, escritura {r['escritura_ms_por_msg']:.3f} ms/msg, "
+              f"lista {r['lista_ms']:.1f} ms, cuerpo {r['lectura_cuerpo_us_por_msg']:.1f} us/msg")
+    return resultados
+
+
+def benchmark_spam(n=20000, palabras=150):
+    """Mensajes por segundo del clasificador de spam: entrenamiento, puntuación individual y por lote."""
+    rnd = random.Random(7)
+    comunes = ["hola", "gracias", "saludos", "semana", "hoy", "mañana", "equipo", "correo", "link", "info",
+               "oferta", "cliente", "precio", "urgente", "descuento", "entrega"]
+    ham = ["reunión", "proyecto", "informe", "cliente", "entrega", "minuta", "agenda", "revisión", "presupuesto", "código"]
+    spam = ["oferta", "gratis", "premio", "ganaste", "descuento", "click", "dinero", "préstamo", "casino", "urgente"]
+
+    def generar(es_spam):
+        # pocas palabras propias de la clase entre muchas compartidas
+        propio = spam if es_spam else ham
+        texto = " ".join(rnd.choice(propio if rnd.random() < 0.03 else comunes) for _ in range(palabras))
+        return Mensaje(None, rnd.choice(propio) + " " + rnd.choice(comunes), texto, 1, 2)
+
+    etiquetas = [rnd.random() < 0.4 for _ in range(n)]
+    mensajes = [generar(e) for e in etiquetas]
+    mitad = n // 2
+    clasificador = ClasificadorSpam()
+    resultados = {"numpy": NUMPY_AVAILABLE}
+
+    t0 = time.perf_counter()
+    clasificador.entrenar(mensajes[:mitad], etiquetas[:mitad])
+    resultados["entrenamiento_msg_s"] = mitad / (time.perf_counter() - t0)
+
+    prueba, esperadas = mensajes[mitad:], etiquetas[mitad:]
+    clasificador.probabilidad(prueba[0])  # prepara los pesos fuera de la medición
+    individuales = prueba[:2000]
+    t0 = time.perf_counter()
+    for m in individuales:
+        clasificador.probabilidad(m)
+    resultados["individual_msg_s"] = len(individuales) / (time.perf_counter() - t0)
+
+    t0 = time.perf_counter()
+    probabilidades = clasificador.probabilidades(prueba)
+    resultados["lote_msg_s"] = len(prueba) / (time.perf_counter() - t0)
+    aciertos = sum((p >= 0.5) == e for p, e in zip(probabilidades, esperadas))
+    resultados["exactitud"] = aciertos / len(prueba)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        ruta = os.path.join(tmp, "spam.bin")
+        clasificador.guardar(ruta)
+        t0 = time.perf_counter()
+        cargado = ClasificadorSpam.cargar(ruta)
+        cargado.probabilidad(prueba[0])
+        resultados["carga_ms"] = (time.perf_counter() - t0) * 1000
+
+        db = BaseDatos(os.path.join(tmp, "bench_spam.db"))
+        crear_usuarios_demo(db)
+        sistema = SistemaCorreo(db, ruta_modelo_spam=ruta)
+        t0 = time.perf_counter()
+        sistema.enviar_lote(prueba)
+        resultados["enviar_lote_msg_s"] = len(prueba) / (time.perf_counter() - t0)
+        db.conn.close()
+
+    print(f"NumPy: {'sí' if resultados['numpy'] else 'no (Python puro)'}")
+    print(f"entrenamiento {resultados['entrenamiento_msg_s']:.0f} msg/s, individual {resultados['individual_msg_s']:.0f} msg/s, "
+          f"lote {resultados['lote_msg_s']:.0f} msg/s, enviar_lote {resultados['enviar_lote_msg_s']:.0f} msg/s")
+    print(f"exactitud {resultados['exactitud']:.3f}, carga del modelo {resultados['carga_ms']:.1f} ms")
+    return resultados
+
+
+def benchmark_ingesta(n=2000, max_lote=256):
+    """Mensajes por segundo enviando de a uno (un commit por mensaje) contra la ingesta con commits agrupados."""
+    resultados = {}
+    sin_limite = dict(tasa=None, max_en_vuelo=None)
+    with tempfile.TemporaryDirectory() as tmp:
+        db = BaseDatos(os.path.join(tmp, "bench_sincronico.db"))
+        crear_usuarios_demo(db)
+        sistema = SistemaCorreo(db, limitador=LimitadorEnvios(**sin_limite))
+        t0 = time.perf_counter()
+        for i in range(n):
+            sistema.enviar(Mensaje(None, f"Asunto {i}", "Texto de prueba", 1, 2))
+        resultados["sincronico"] = {"msg_s": n / (time.perf_counter() - t0)}
+        db.conn.close()
+
+        for durabilidad in ("completa", "normal"):
+            db = BaseDatos(os.path.join(tmp, f"bench_ingesta_{durabilidad}.db"))
+            crear_usuarios_demo(db)
+            sistema = SistemaCorreo(db, limitador=LimitadorEnvios(**sin_limite))
+            ingesta = sistema.iniciar_ingesta(max_lote=max_lote, durabilidad=durabilidad, max_pendientes=n)
+            t0 = time.perf_counter()
+            for i in range(n):
+                sistema.enviar(Mensaje(None, f"Asunto {i}", "Texto de prueba", 1, 2))
+            t_encolado = time.perf_counter() - t0
+            ingesta.flush()
+            t_total = time.perf_counter() - t0
+            stats = ingesta.estadisticas()
+            sistema.detener_ingesta()
+            db.conn.close()
+            resultados[f"ingesta_{durabilidad}"] = {"msg_s": n / t_total, "encolado_us_por_msg": t_encolado * 1e6 / n,
+                                                   "lote_medio": stats["lote_medio"], "lotes": stats["lotes"]}
+    for nombre, r in resultados.items():
+        extra = ""
+        if "lote_medio" in r:
+            extra = f", encolar {r['encolado_us_por_msg']:.1f} us/msg, {r['lotes']} commits (lote medio {r['lote_medio']:.1f})"
+        print(f"{nombre:>17}: {r['msg_s']:.0f} msg/s{extra}")
+    return resultados
+
+
+def benchmark_fragmentos(n=2000, productores=8, fragmentos=(1, 2, 4), usuarios=16):
+    """
+    Mensajes por segundo con `productores` hilos enviando a la vez, según la
+    cantidad de fragmentos: con un commit por mensaje (max_lote=1, cada escritor
+    espera su fsync) y con commits agrupados.
+    """
+    resultados = {}
+    sin_limite = dict(tasa=None, max_en_vuelo=None)
+    for max_lote in (1, 256):
+        for k in fragmentos:
+            with tempfile.TemporaryDirectory() as tmp:
+                db = BaseDatosFragmentada(os.path.join(tmp, "bench.db"), fragmentos=k)
+                for u in range(usuarios):
+                    db.crear_usuario(f"u{u}", f"u{u}@example.com", "x")
+                sistema = SistemaCorreo(db, limitador=LimitadorEnvios(**sin_limite))
+                ingesta = sistema.iniciar_ingesta(max_lote=max_lote, max_pendientes=n)
+                rnd = random.Random(k)
+                destinos = [rnd.randint(1, usuarios) for _ in range(n)]
+
+                def producir(desde):
+                    for i in range(desde, n, productores):
+                        sistema.enviar(Mensaje(None, f"Asunto {i}", "Texto de prueba", 1, destinos[i]))
+
+                hilos = [threading.Thread(target=producir, args=(p,)) for p in range(productores)]
+                t0 = time.perf_counter()
+                for h in hilos:
+                    h.start()
+                for h in hilos:
+                    h.join()
+                ingesta.flush()
+                resultados[(max_lote, k)] = n / (time.perf_counter() - t0)
+                sistema.detener_ingesta()
+                db.cerrar()
+    for (max_lote, k), msg_s in resultados.items():
+        base = resultados[(max_lote, fragmentos[0])]
+        print(f"max_lote={max_lote:>3}, {k} fragmento(s): {msg_s:.0f} msg/s (x{msg_s / base:.2f})")
+    return resultados
+
+
+def _bytes_en_el_cable(n):
+    # carga más la cabecera de un marco WebSocket del servidor (sin máscara)
+    return n + (2 if n < 126 else 4 if n < 1 << 16 else 10)
+
+
+def _deflate_por_mensaje(marcos, contexto):
+    # permessage-deflate (RFC 7692): deflate crudo con flush de sincronización y sin los 4 bytes finales;
+    # con contexto (context takeover) el compresor de la conexión recuerda los mensajes anteriores
+    compresor = zlib.compressobj(wbits=-15)
+    total = 0
+    for marco in marcos:
+        if not contexto:
+            compresor = zlib.compressobj(wbits=-15)
+        datos = marco.encode("utf-8") if isinstance(marco, str) else marco
+        total += _bytes_en_el_cable(len(compresor.compress(datos) + compresor.flush(zlib.Z_SYNC_FLUSH)) - 4)
+    return total
+
+
+def benchmark_chat(n=20000, suscriptores=200, difusiones=500):
+    """Bytes en el cable y CPU por marco del chat en JSON y binario, con y sin permessage-deflate, y costo de difundir."""
+    rnd = random.Random(3)
+    nombres = ["Alice", "Bob", "Carlos", "Dana", "Ezequiel", "Florencia"]
+    base = _ahora_ms()
+    mensajes = [{"type": "msg", "sender": rnd.choice(nombres), "text": _texto_de_prueba(rnd, rnd.randint(1, 20)),
+                 "ts": _ms_a_iso(base + i * 1500)} for i in range(n)]
+    resultados = {"msgpack": MSGPACK_AVAILABLE}
+    for formato in (FORMATO_CHAT_JSON, FORMATO_CHAT_BINARIO):
+        t0 = time.perf_counter()
+        marcos = [codificar_chat(m, formato) for m in mensajes]
+        t_codificar = time.perf_counter() - t0
+        t0 = time.perf_counter()
+        for marco in marcos:
+            decodificar_chat(marco)
+        t_decodificar = time.perf_counter() - t0
+        crudo = sum(_bytes_en_el_cable(len(m.encode("utf-8") if isinstance(m, str) else m)) for m in marcos)
+        t0 = time.perf_counter()
+        con_contexto = _deflate_por_mensaje(marcos, True)
+        t_deflate = time.perf_counter() - t0
+        resultados[formato] = {
+            "bytes_por_marco": crudo / n,
+            "deflate_bytes_por_marco": con_contexto / n,
+            "deflate_sin_contexto_bytes_por_marco": _deflate_por_mensaje(marcos, False) / n,
+            "codificar_us": t_codificar * 1e6 / n,
+            "decodificar_us": t_decodificar * 1e6 / n,
+            "deflate_us": t_deflate * 1e6 / n,
+        }
+    # difusión: mitad de los clientes en cada formato; una codificación por formato contra una por cliente
+    clientes = [(i, FORMATOS_CHAT[i % 2]) for i in range(suscriptores)]
+    t0 = time.perf_counter()
+    for m in mensajes[:difusiones]:
+        BroadcastServer.preparar_difusion(m, clientes)
+    t_una_vez = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for m in mensajes[:difusiones]:
+        [(c, codificar_chat(m, formato)) for c, formato in clientes]
+    t_por_cliente = time.perf_counter() - t0
+    resultados["difusion_us"] = {"una_vez_por_formato": t_una_vez * 1e6 / difusiones,
+                                 "por_cliente": t_por_cliente * 1e6 / difusiones}
+
+    print(f"{n} marcos de chat (msgpack {'instalado' if MSGPACK_AVAILABLE else 'propio'}):")
+    for formato in (FORMATO_CHAT_JSON, FORMATO_CHAT_BINARIO):
+        r = resultados[formato]
+        print(f"{formato:>6}: {r['bytes_por_marco']:.1f} B/marco, deflate {r['deflate_bytes_por_marco']:.1f} B "
+              f"(sin contexto {r['deflate_sin_contexto_bytes_por_marco']:.1f} B), codificar {r['codificar_us']:.2f} us, "
+              f"decodificar {r['decodificar_us']:.2f} us, deflate {r['deflate_us']:.2f} us")
+    d = resultados["difusion_us"]
+    print(f"difusión a {suscriptores} clientes: {d['una_vez_por_formato']:.1f} us codificando una vez por formato, "
+          f"{d['por_cliente']:.1f} us codificando por cliente")
+    return resultados
+
+
+BENCHMARKS = {
+    "chat": benchmark_chat,
+    "compresion": benchmark_compresion,
+    "fragmentos": benchmark_fragmentos,
+    "ingesta": benchmark_ingesta,
+    "spam": benchmark_spam,
+}
+
+
 # ==========================
 # Inicialización y ejecución
 # ==========================
+def abrir_base(db_file=DB_FILE, **kwargs):
+    """
+    Abre `db_file` como BaseDatosFragmentada si ya se refragmentó (tiene la
+    tabla `fragmentos`), si no como BaseDatos.
+    """
+    if os.path.exists(db_file):
+        conn = sqlite3.connect(db_file)
+        try:
+            fragmentada = conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'fragmentos'").fetchone() is not None
+        finally:
+            conn.close()
+        if fragmentada:
+            return BaseDatosFragmentada(db_file, **kwargs)
+    return BaseDatos(db_file, **kwargs)
+
+
 def crear_usuarios_demo(db: BaseDatos):
     if not db.listar_usuarios():
         db.crear_usuario("Alice", "alice@example.com", "1234")
@@ -1083,16 +6040,149 @@ def crear_usuarios_demo(db: BaseDatos):
         db.crear_usuario("Carlos", "carlos@example.com", "pass")
 
 
+def ejecutar_comando(argv):
+    """Comandos de mantenimiento por línea de comandos (sin interfaz gráfica)."""
+    parser = argparse.ArgumentParser(prog="proyectofinal.py")
+    parser.add_argument("--db", default=DB_FILE)
+    sub = parser.add_subparsers(dest="comando", required=True)
+
+    p_exp = sub.add_parser("exportar", help="Exporta mensajes a JSONL o mbox")
+    p_exp.add_argument("ruta")
+    p_exp.add_argument("--formato", choices=("jsonl", "mbox"), default="jsonl")
+    p_exp.add_argument("--usuario", type=int)
+    p_exp.add_argument("--desde")
+    p_exp.add_argument("--hasta")
+
+    p_imp = sub.add_parser("importar", help="Importa mensajes desde JSONL o mbox (reanudable)")
+    p_imp.add_argument("ruta")
+    p_imp.add_argument("--formato", choices=("jsonl", "mbox"), default="jsonl")
+    p_imp.add_argument("--lote", type=int, default=5000)
+    p_imp.add_argument("--checkpoint")
+
+    p_arch = sub.add_parser("archivar", help="Mueve mensajes viejos a archivos mensuales")
+    p_arch.add_argument("--dias", type=int, default=180)
+    p_arch.add_argument("--lote", type=int, default=2000)
+
+    p_comp = sub.add_parser("comprimir", help="Comprime en lotes los cuerpos grandes ya guardados")
+    p_comp.add_argument("--codec", default="zlib", choices=sorted(CODECS_CUERPO))
+    p_comp.add_argument("--umbral", type=int, default=4096)
+    p_comp.add_argument("--lote", type=int, default=1000)
+
+    p_ref = sub.add_parser("refiltrar", help="Aplica reglas al buzón existente de un usuario")
+    p_ref.add_argument("--usuario", type=int, required=True)
+    p_ref.add_argument("--campo", choices=Regla.CAMPOS, help="Crea esta regla y aplica sólo ella")
+    p_ref.add_argument("--patron")
+    p_ref.add_argument("--regex", action="store_true")
+    p_ref.add_argument("--accion", choices=Regla.ACCIONES)
+    p_ref.add_argument("--destino", help="Carpeta para la acción 'mover'")
+    p_ref.add_argument("--procesos", type=int)
+    p_ref.add_argument("--lote", type=int, default=2000)
+
+    p_spam = sub.add_parser("entrenar-spam", help="Entrena el clasificador de spam con el buzón de un usuario")
+    p_spam.add_argument("--usuario", type=int, required=True)
+    p_spam.add_argument("--modelo", help="Archivo del modelo (por defecto junto a la base)")
+
+    p_resp = sub.add_parser("respaldar", help="Copia de seguridad en caliente de la base y sus archivos")
+    p_resp.add_argument("--carpeta", help="Dónde guardar las copias (por defecto junto a la base)")
+    p_resp.add_argument("--modo", choices=ServicioRespaldo.MODOS, default="paginas")
+    p_resp.add_argument("--paginas", type=int, default=256, help="Páginas copiadas por paso")
+    p_resp.add_argument("--pausa-ms", type=int, default=10)
+    p_resp.add_argument("--conservar", type=int, default=7)
+    p_resp.add_argument("--sin-verificar", action="store_true")
+    p_resp.add_argument("--cada", type=float, help="Repetir cada tantos minutos (hasta Ctrl+C)")
+
+    p_frag = sub.add_parser("refragmentar", help="Reparte los buzones en N archivos por usuario")
+    p_frag.add_argument("fragmentos", type=int)
+    p_frag.add_argument("--lote", type=int, default=500)
+
+    p_bench = sub.add_parser("bench", help="Ejecuta un benchmark")
+    p_bench.add_argument("nombre", choices=sorted(BENCHMARKS))
+
+    args = parser.parse_args(argv)
+    if args.comando == "bench":
+        BENCHMARKS[args.nombre]()
+        return 0
+    if args.comando == "refragmentar":
+        fragmentada = BaseDatosFragmentada(args.db)
+        r = fragmentada.refragmentar(args.fragmentos, tam_lote=args.lote)
+        print(f"{r['fragmentos']} fragmento(s): {r['usuarios']} usuarios y {r['mensajes']} mensajes movidos"
+              + (f", {r['huerfanos']} mensajes sin usuario quedaron en fragmentos retirados" if r["huerfanos"] else ""))
+        fragmentada.cerrar()
+        return 0
+    db = abrir_base(args.db)
+    # el mantenimiento por archivo (archivar, comprimir, respaldar) recorre todos los fragmentos
+    bases = db.fragmentos if isinstance(db, BaseDatosFragmentada) else [db]
+
+    if args.comando == "exportar":
+        t = TransferenciaBuzon(db)
+        exportar = t.exportar_mbox if args.formato == "mbox" else t.exportar_jsonl
+        total = exportar(args.ruta, uid=args.usuario, desde=args.desde, hasta=args.hasta)
+        print(f"{total} mensajes exportados a {args.ruta}")
+    elif args.comando == "importar":
+        t = TransferenciaBuzon(db, tam_lote=args.lote)
+        importar = t.importar_mbox if args.formato == "mbox" else t.importar_jsonl
+        total = importar(args.ruta, ruta_checkpoint=args.checkpoint)
+        print(f"{total} mensajes importados desde {args.ruta}" + (f" ({t.saltados} salteados)" if t.saltados else ""))
+    elif args.comando == "archivar":
+        total = sum(Archivador(base, dias=args.dias, tam_lote=args.lote).archivar() for base in bases)
+        print(f"{total} mensajes archivados")
+    elif args.comando == "comprimir":
+        total = 0
+        for base in bases:
+            base.codec_compresion, base.umbral_compresion = args.codec, args.umbral
+            total += base.comprimir_existentes(tam_lote=args.lote)
+        print(f"{total} mensajes comprimidos")
+    elif args.comando == "refiltrar":
+        reglas = None
+        if args.campo or args.patron or args.accion:
+            if not (args.campo and args.patron and args.accion):
+                parser.error("para crear una regla hacen falta --campo, --patron y --accion")
+            try:
+                regla = Regla(None, args.usuario, args.campo, args.patron, args.accion, args.destino, args.regex)
+            except ValueError as e:
+                parser.error(str(e))
+            db.crear_regla(regla)
+            reglas = [regla]
+        r = Refiltrador(db, procesos=args.procesos, tam_lote=args.lote).aplicar(args.usuario, reglas)
+        print(f"{r['revisados']} mensajes revisados: {r['papelera']} a papelera, "
+              f"{r['prioridad']} prioritarios, {r['mover']} movidos")
+    elif args.comando == "entrenar-spam":
+        sistema = SistemaCorreo(db, ruta_modelo_spam=args.modelo)
+        spam, no_spam = sistema.entrenar_spam(args.usuario)
+        print(f"Modelo entrenado con {spam} spam y {no_spam} no spam: {sistema.ruta_modelo_spam}")
+    elif args.comando == "respaldar":
+        # una serie de copias por fragmento, cada una en su carpeta
+        servicios = [ServicioRespaldo(base, modo=args.modo, paginas_por_paso=args.paginas,
+                                      carpeta=args.carpeta and os.path.join(
+                                          args.carpeta, os.path.splitext(os.path.basename(base.db_file))[0]),
+                                      pausa_ms=args.pausa_ms, conservar=args.conservar, verificar=not args.sin_verificar)
+                     for base in bases]
+        while True:
+            for servicio in servicios:
+                m = servicio.respaldar()
+                print(f"Copia en {m['ruta']}: {m['archivos']} archivo(s), {m['paginas']} páginas, {m['bytes']} bytes, "
+                      f"{m['pasos']} pasos, {m['reinicios']} reinicios, {m['duracion_s']:.2f} s "
+                      f"(+{m['verificacion_s']:.2f} s de verificación)")
+            if not args.cada:
+                break
+            try:
+                time.sleep(args.cada * 60)
+            except KeyboardInterrupt:
+                break
+    return 0
+
+
 def main():
-    db = BaseDatos()
+    if len(sys.argv) > 1:
+        sys.exit(ejecutar_comando(sys.argv[1:]))
+
+    # ya refragmentada, la interfaz trabaja sobre todos los fragmentos
+    db = abrir_base()
     crear_usuarios_demo(db)
     sistema = SistemaCorreo(db)
 
-    # cargar mensajes demo si la tabla está vacía
-    c = db.conn.cursor()
-    c.execute("SELECT COUNT(*) FROM mensajes")
-    total = c.fetchone()[0]
-    if total == 0:
+    # cargar mensajes demo si no hay ninguno
+    if next(db.iterar_mensajes(tam_lote=1), None) is None:
         m1 = Mensaje(None, "Hola Bob", "Hola Bob! ¿Cómo andás?", remitente_id=1, destinatario_id=2, prioridad=5)
         m2 = Mensaje(None, "URGENTE: Reunión", "Esto es urgente, reunión a las 10", remitente_id=3, destinatario_id=2, prioridad=1)
         m3 = Mensaje(None, "Spam oferta", "Compra ya", remitente_id=1, destinatario_id=2, prioridad=9)
@@ -1104,8 +6194,14 @@ def main():
     # rt_server = BroadcastServer(host='0.0.0.0', puerto=8765)
     # rt_server.start_in_background()
 
+    # los envíos desde la interfaz no esperan el commit en el hilo de Tk
+    sistema.iniciar_ingesta()
     app = App(sistema)
-    app.mainloop()
+    try:
+        app.mainloop()
+    finally:
+        sistema.detener_ingesta()
+        sistema.guardar_modelo_spam(solo_pendiente=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import proyectofinal as pf  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path):
+    base = pf.BaseDatos(str(tmp_path / "correo.db"))
+    pf.crear_usuarios_demo(base)
+    yield base
+    base.conn.close()
+
+
+@pytest.fixture
+def sistema(db):
+    # limitador holgado: los tests mandan ráfagas del mismo remitente
+    limitador = pf.LimitadorEnvios(tasa=1e6, capacidad=1e6, max_en_vuelo=1000)
+    return pf.SistemaCorreo(db, ruta_modelo_spam=os.path.splitext(db.db_file)[0] + "_spam.bin", limitador=limitador)
+
+
+def contar(conn, tabla, where="1", params=()):
+    return conn.execute(f"SELECT COUNT(*) FROM {tabla} WHERE {where}", params).fetchone()[0]
@@ -0,0 +1,50 @@
+import os
+
+from conftest import contar, pf
+
+VIEJO_MS = 1500000000000  # 2017: ya vencido en la papelera
+
+
+def test_mismo_archivo_se_guarda_una_vez_y_se_lee_por_bloques(sistema, db, tmp_path):
+    datos = os.urandom(3000)
+    for nombre in ("a.bin", "b.bin"):
+        (tmp_path / nombre).write_bytes(datos)
+    refs = []
+    for nombre in ("a.bin", "b.bin"):
+        m = pf.Mensaje(None, nombre, "c", 1, 2)
+        refs.append(sistema.adjuntar_archivo(m, str(tmp_path / nombre)))
+        sistema.enviar(m)
+    assert refs[0]["sha256"] == refs[1]["sha256"]
+    assert db.conn.execute("SELECT tamaño, referencias FROM adjuntos").fetchall() == [(3000, 2)]
+    assert os.listdir(os.path.dirname(db.adjuntos.ruta(refs[0]["sha256"]))) == [refs[0]["sha256"]]
+
+    mid = db.obtener_mensajes_para_usuario(2)[0].id_mensaje
+    adjunto, = db.obtener_mensaje(mid).adjuntos
+    assert b"".join(db.adjuntos.leer_en_bloques(adjunto["sha256"], tam_bloque=1024)) == datos
+    copia = tmp_path / "copia.bin"
+    db.copiar_adjunto(mid, adjunto["sha256"], str(copia))
+    assert copia.read_bytes() == datos
+
+
+def test_purgar_libera_el_blob_con_la_ultima_referencia(sistema, db, tmp_path):
+    ruta = tmp_path / "informe.txt"
+    ruta.write_bytes(b"datos" * 100)
+    ids = []
+    for asunto in ("a", "b"):
+        m = pf.Mensaje(None, asunto, "c", 1, None)
+        ref = sistema.adjuntar_archivo(m, str(ruta))
+        ids += sistema.enviar(m, [2, 3])[1]
+    blob = db.adjuntos.ruta(ref["sha256"])
+    assert db.conn.execute("SELECT referencias FROM adjuntos").fetchall() == [(4,)]
+
+    # una entrega en la papelera vencida se purga sola y suelta su referencia
+    db.marcar_eliminados([ids[0]])
+    db.conn.execute("UPDATE mensajes SET eliminado_ms = ? WHERE id = ?", (VIEJO_MS, ids[0]))
+    db.conn.commit()
+    db.limpiar_papelera()
+    assert db.conn.execute("SELECT referencias FROM adjuntos").fetchall() == [(3,)]
+    assert os.path.exists(blob)
+
+    db.borrar_mensajes(ids[1:])
+    assert contar(db.conn, "adjuntos") == 0
+    assert not os.path.exists(blob)
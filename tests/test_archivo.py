@@ -0,0 +1,63 @@
+import os
+
+from conftest import pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def _bandeja_archivada(db):
+    # asuntos intercalados entre la tabla caliente y el archivo
+    for i, asunto in enumerate(["b", "d", "f", "h"]):
+        db.guardar_mensaje(pf.Mensaje(None, asunto, "viejo", 1, 2, fecha_envio=VIEJO_MS + i))
+    for asunto in ["a", "c", "e", "g"]:
+        db.guardar_mensaje(pf.Mensaje(None, asunto, "nuevo", 3, 2))
+    assert pf.Archivador(db, dias=30).archivar() == 4
+
+
+def test_orden_por_asunto_junta_tabla_caliente_y_archivos(db):
+    _bandeja_archivada(db)
+    asuntos = lambda **kw: [m.asunto for m in db.obtener_mensajes_para_usuario(2, orden=("asunto", False), **kw)]
+    assert asuntos() == list("abcdefgh")
+    assert asuntos(limite=3, offset=2) == list("cde")
+    descendente = db.obtener_mensajes_para_usuario(2, limite=3, orden=("asunto", True))
+    assert [m.asunto for m in descendente] == list("hgf")
+
+
+def test_orden_por_fecha_sigue_concatenando_particiones(db):
+    _bandeja_archivada(db)
+    fechas = [m.fecha_ms for m in db.obtener_mensajes_para_usuario(2, limite=6, offset=1)]
+    assert fechas == sorted(fechas, reverse=True)
+    assert len(fechas) == 6
+
+
+def test_asunto_de_envios_a_varios_queda_en_cada_fila_y_se_completa_al_migrar(db):
+    ids = db.guardar_mensaje_multiple(pf.Mensaje(None, "para todos", "c", 1, None), [2, 3])
+    assert db.conn.execute("SELECT COUNT(*) FROM mensajes WHERE asunto = 'para todos'").fetchone()[0] == 2
+    # base anterior: el asunto sólo en contenidos y sin el índice
+    db.conn.execute("UPDATE mensajes SET asunto = NULL WHERE id IN (?, ?)", ids)
+    db.conn.execute("DROP INDEX idx_mensajes_destinatario_asunto")
+    db.conn.commit()
+    db.conn.close()
+    db = pf.BaseDatos(db.db_file)
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(3)] == ["para todos"]
+    db.conn.close()
+
+
+def test_archivar_mueve_lo_viejo_a_un_archivo_por_mes_y_se_sigue_leyendo(db):
+    viejo = db.guardar_mensaje(pf.Mensaje(None, "viejo", "cuerpo viejo", 1, 2, fecha_envio=VIEJO_MS))
+    borrado = db.guardar_mensaje(pf.Mensaje(None, "en papelera", "c", 1, 2, fecha_envio=VIEJO_MS))
+    db.marcar_eliminado(borrado)
+    nuevo = db.guardar_mensaje(pf.Mensaje(None, "nuevo", "c", 1, 2))
+
+    assert pf.Archivador(db, dias=30).archivar() == 1
+    (mes, ruta), = db.listar_archivos()
+    assert mes == "2017-07" and os.path.exists(ruta)
+    # en la tabla caliente quedan lo reciente y la papelera
+    assert [r[0] for r in db.conn.execute("SELECT id FROM mensajes ORDER BY id")] == [borrado, nuevo]
+    assert db.obtener_mensaje(viejo).cuerpo == "cuerpo viejo"
+    assert [m.id_mensaje for m in db.obtener_mensajes_para_usuario(2)] == [nuevo, viejo]
+
+    # mandarlo a la papelera lo trae de vuelta a la tabla caliente
+    db.marcar_eliminado(viejo)
+    assert sorted(m.id_mensaje for m in db.obtener_mensajes_papelera(2)) == [viejo, borrado]
+    assert pf.Archivador(db, dias=30).archivar() == 0
@@ -0,0 +1,46 @@
+from conftest import contar, pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def test_operaciones_en_bloque_sobre_mas_ids_que_un_lote_in(db):
+    filas = [(1, 2, f"a{i}", '{"cuerpo": "c", "metadata": {}}', 1700000000000 + i, 5, None, 0, 0, None, None, None)
+             for i in range(pf.LOTE_IN * 2 + 10)]
+    assert db.insertar_mensajes_lote(filas) == len(filas)
+    ids = [r[0] for r in db.conn.execute("SELECT id FROM mensajes ORDER BY id")]
+    commits = []
+    db.conn.set_trace_callback(lambda sql: commits.append(sql) if sql == "COMMIT" else None)
+
+    assert db.marcar_eliminados(ids) == len(ids)
+    assert commits == ["COMMIT"]
+    assert db.contadores(2)["papelera"] == len(ids)
+    assert db.recuperar_mensajes(ids[:10]) == 10
+    assert db.marcar_prioritarios(ids[:3]) == 3
+    assert len(db.obtener_mensajes_prioritarios(2)) == 3
+    assert db.borrar_mensajes(ids[10:]) == len(ids) - 10
+    assert contar(db.conn, "mensajes") == 10
+
+
+def test_bloque_con_ids_archivados_y_en_la_tabla_caliente(db):
+    viejos = [db.guardar_mensaje(pf.Mensaje(None, f"v{i}", "c", 1, 2, fecha_envio=VIEJO_MS + i)) for i in range(3)]
+    nuevo = db.guardar_mensaje(pf.Mensaje(None, "nuevo", "c", 1, 2))
+    assert pf.Archivador(db, dias=30).archivar() == 3
+
+    assert db.mover_a_carpeta(viejos[:2] + [nuevo], "trabajo") == 3
+    assert sorted(m.id_mensaje for m in db.obtener_mensajes_carpeta(2, "trabajo")) == viejos[:2] + [nuevo]
+    # la papelera vive en la tabla caliente: los archivados vuelven y se marcan igual
+    assert db.marcar_eliminados([viejos[0], nuevo]) == 2
+    assert sorted(m.id_mensaje for m in db.obtener_mensajes_papelera(2)) == [viejos[0], nuevo]
+    assert db.borrar_mensajes(viejos) == 3
+    assert db.obtener_mensaje(viejos[2]) is None
+
+
+def test_eliminar_usuario_por_tandas(db):
+    for i in range(7):
+        db.guardar_mensaje(pf.Mensaje(None, f"a{i}", "c", 3, 2 if i % 2 else 1))
+    avance = []
+    borrados = db.eliminar_usuario(3, tam_lote=2, pausa=0, progreso=avance.append)
+    assert borrados == 7
+    assert len(avance) >= 4
+    assert contar(db.conn, "mensajes") == 0
+    assert db.obtener_usuario_por_id(3) is None
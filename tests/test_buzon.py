@@ -0,0 +1,42 @@
+from conftest import contar, pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def test_purgar_libera_cuerpos_y_contenidos_compartidos(sistema, db):
+    cuerpo = "cuerpo largo " * 100
+    ids = []
+    for asunto in ("a", "b"):
+        ids += sistema.enviar(pf.Mensaje(None, asunto, cuerpo, 1, None), [2, 3])[1]
+    assert db.conn.execute("SELECT referencias FROM cuerpos").fetchall() == [(2,)]
+    assert contar(db.conn, "contenidos") == 2
+
+    # una entrega en la papelera vencida se purga sola; el contenido sigue con la otra
+    db.marcar_eliminados([ids[0]])
+    db.conn.execute("UPDATE mensajes SET eliminado_ms = ? WHERE id = ?", (VIEJO_MS, ids[0]))
+    db.conn.commit()
+    db.limpiar_papelera()
+    assert contar(db.conn, "mensajes") == 3
+    assert contar(db.conn, "contenidos") == 2
+
+    db.borrar_mensajes(ids[1:])
+    assert contar(db.conn, "mensajes") == 0
+    assert contar(db.conn, "contenidos") == 0
+    assert contar(db.conn, "cuerpos") == 0
+
+
+def test_envio_a_varios_guarda_el_cuerpo_una_vez_y_una_entrega_por_destinatario(db):
+    cuerpo = "informe trimestral " * 200
+    ids = db.guardar_mensaje_multiple(pf.Mensaje(None, "informe", cuerpo, 1, None, metadata={"k": 1}), [2, 3])
+    assert db.conn.execute("SELECT entregas FROM contenidos").fetchall() == [(2,)]
+    assert db.conn.execute("SELECT COUNT(*) FROM mensajes WHERE cuerpo_json IS NOT NULL").fetchone() == (0,)
+    for uid, mid in zip((2, 3), ids):
+        m, = db.obtener_mensajes_para_usuario(uid)
+        assert (m.id_mensaje, m.asunto, m.cuerpo, m.metadata) == (mid, "informe", cuerpo, {"k": 1})
+
+    # cada entrega tiene su propio estado
+    db.marcar_leido(ids[0])
+    assert [m.leido for m in db.obtener_mensajes_para_usuario(3)] == [False]
+    db.borrar_mensajes([ids[0]])
+    assert db.conn.execute("SELECT entregas FROM contenidos").fetchall() == [(1,)]
+    assert db.obtener_mensaje(ids[1]).cuerpo == cuerpo
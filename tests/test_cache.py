@@ -0,0 +1,45 @@
+from conftest import pf
+
+
+def _lecturas_de_bandeja(consultas):
+    # cada lectura igual pasa por la purga de la papelera vencida, que no es la bandeja
+    return [sql for sql in consultas if "carpeta IS NULL" in sql]
+
+
+def test_primera_pagina_sale_de_la_cache_hasta_que_una_escritura_la_invalida(db):
+    db.guardar_mensaje(pf.Mensaje(None, "uno", "c", 1, 2))
+    db.guardar_mensaje(pf.Mensaje(None, "para Carlos", "c", 1, 3))
+    db.obtener_mensajes_para_usuario(2)
+    db.obtener_mensajes_para_usuario(3)
+    consultas = []
+    db.conn.set_trace_callback(consultas.append)
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(2)] == ["uno"]
+    assert _lecturas_de_bandeja(consultas) == []
+    assert db.cache.estadisticas()["aciertos"] == 1
+
+    # un mensaje nuevo para Bob invalida su bandeja, no la de Carlos
+    db.guardar_mensaje(pf.Mensaje(None, "dos", "c", 3, 2))
+    consultas.clear()
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(2)] == ["dos", "uno"]
+    assert len(_lecturas_de_bandeja(consultas)) == 1
+    consultas.clear()
+    db.obtener_mensajes_para_usuario(3)
+    assert _lecturas_de_bandeja(consultas) == []
+
+
+def test_no_guarda_una_lectura_que_empezo_antes_de_invalidar():
+    cache = pf.CacheBandejas()
+    clave = ("bandeja", 2, None)
+    generacion = cache.generacion("bandeja", 2)
+    cache.invalidar({2})
+    cache.guardar(clave, ["viejo"], generacion)
+    assert cache.obtener(clave) is None
+
+
+def test_desaloja_por_cantidad_de_mensajes():
+    cache = pf.CacheBandejas(max_mensajes=5)
+    for uid in (1, 2, 3):
+        cache.guardar(("bandeja", uid, None), [uid] * 2, cache.generacion("bandeja", uid))
+    assert cache.obtener(("bandeja", 1, None)) is None
+    assert cache.obtener(("bandeja", 3, None)) == [3, 3]
+    assert cache.estadisticas()["desalojos"] == 1
@@ -0,0 +1,46 @@
+import json
+
+import pytest
+
+from conftest import pf
+
+
+@pytest.mark.parametrize("formato", [pf.FORMATO_CHAT_JSON, pf.FORMATO_CHAT_BINARIO])
+def test_codificar_y_decodificar_ida_y_vuelta(formato):
+    ts = pf._ms_a_iso(1700000000123)
+    for datos in ({"type": "msg", "sender": "ana", "text": "hola ñandú " * 10, "ts": ts},
+                  {"type": "presencia", "sender": "ana", "online": True, "ids": [1, -2, 70000], "extra": None},
+                  {"type": "msg", "sender": "bob", "text": "", "ts": "ayer"}):
+        marco = pf.codificar_chat(datos, formato)
+        assert isinstance(marco, bytes if formato == pf.FORMATO_CHAT_BINARIO else str)
+        assert pf.decodificar_chat(marco) == datos
+
+
+def test_marco_binario_es_mas_chico_que_el_json():
+    datos = {"type": "msg", "sender": "ana", "text": "hola", "ts": pf._ms_a_iso(1700000000000)}
+    binario = pf.codificar_chat(datos, pf.FORMATO_CHAT_BINARIO)
+    assert len(binario) < len(pf.codificar_chat(datos).encode("utf-8"))
+    assert binario[:2] == bytes([pf.VERSION_CHAT, 1])
+
+
+def test_marcos_binarios_invalidos_dan_value_error():
+    bueno = pf.codificar_chat({"type": "msg", "text": "hola"}, pf.FORMATO_CHAT_BINARIO)
+    for marco in (b"\x01", bytes([9]) + bueno[1:], bueno[:1] + bytes([99]) + bueno[2:], bueno[:-2],
+                  bueno[:10] + pf.empaquetar_msgpack([1, 2])):
+        with pytest.raises(ValueError):
+            pf.decodificar_chat(marco)
+
+
+def test_negociacion_y_difusion_codifican_una_vez_por_formato():
+    assert pf.elegir_formato_chat(["json", "bin1"]) == pf.FORMATO_CHAT_BINARIO
+    assert pf.elegir_formato_chat(["bin9"]) == pf.FORMATO_CHAT_JSON
+    assert pf.elegir_formato_chat(None) == pf.FORMATO_CHAT_JSON
+
+    datos = {"type": "msg", "sender": "ana", "text": "hola"}
+    original = json.dumps(datos)
+    envios = pf.BroadcastServer.preparar_difusion(
+        datos, [("a", "json"), ("b", "bin1"), ("c", "bin1")], original=original)
+    marcos = dict(envios)
+    assert marcos["a"] is original
+    assert marcos["b"] is marcos["c"]
+    assert pf.decodificar_chat(marcos["b"]) == datos
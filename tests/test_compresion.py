@@ -0,0 +1,31 @@
+import pytest
+
+from conftest import pf
+
+
+@pytest.mark.parametrize("codec", ["zlib", "lzma"])
+def test_cuerpo_grande_se_guarda_comprimido_y_se_lee_igual(tmp_path, codec):
+    db = pf.BaseDatos(str(tmp_path / "correo.db"), codec_compresion=codec, umbral_compresion=1024)
+    pf.crear_usuarios_demo(db)
+    grande, chico = "repetido " * 1000, "corto"
+    ids = [db.guardar_mensaje(pf.Mensaje(None, asunto, cuerpo, 1, 2)) for asunto, cuerpo in (("g", grande), ("c", chico))]
+    formatos = dict(db.conn.execute("SELECT asunto, cuerpo_formato FROM mensajes"))
+    assert formatos == {"g": codec, "c": None}
+    assert [db.obtener_mensaje(mid).cuerpo for mid in ids] == [grande, chico]
+    db.conn.close()
+
+
+def test_comprimir_existentes_migra_los_cuerpos_viejos(tmp_path):
+    db = pf.BaseDatos(str(tmp_path / "correo.db"), codec_compresion=None)
+    pf.crear_usuarios_demo(db)
+    grande = "texto que se repite " * 500
+    for i in range(3):
+        db.guardar_mensaje(pf.Mensaje(None, f"a{i}", grande, 1, 2))
+    assert db.comprimir_existentes() == 0  # sin codec no hace nada
+
+    db.codec_compresion, db.umbral_compresion = "zlib", 1024
+    assert db.comprimir_existentes(tam_lote=2) == 3
+    assert db.comprimir_existentes() == 0
+    assert {m.cuerpo for m in db.obtener_mensajes_para_usuario(2)} == {grande}
+    db.conn.close()
+
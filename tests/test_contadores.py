@@ -0,0 +1,53 @@
+from conftest import pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def _coinciden_con_listados(db, uid):
+    n = db.contadores(uid)
+    bandeja = db.obtener_mensajes_para_usuario(uid)
+    assert n["bandeja"] == len(bandeja)
+    assert n["no_leidos"] == sum(not m.leido for m in bandeja)
+    assert n["papelera"] == len(db.obtener_mensajes_papelera(uid))
+    return n
+
+
+def test_contadores_despues_de_enviar_borrar_y_recuperar(sistema, db):
+    _, uno = sistema.enviar(pf.Mensaje(None, "uno", "c", 1, 2))
+    _, (dos, _tres) = sistema.enviar(pf.Mensaje(None, "varios", "c", 1, None), [2, 3])
+    n = _coinciden_con_listados(db, 2)
+    assert (n["bandeja"], n["no_leidos"], n["papelera"]) == (2, 2, 0)
+
+    db.marcar_leido(uno)
+    assert _coinciden_con_listados(db, 2)["no_leidos"] == 1
+
+    db.marcar_eliminados([dos])
+    n = _coinciden_con_listados(db, 2)
+    assert (n["bandeja"], n["papelera"]) == (1, 1)
+    assert _coinciden_con_listados(db, 3)["bandeja"] == 1
+
+    db.recuperar_mensajes([dos])
+    n = _coinciden_con_listados(db, 2)
+    assert (n["bandeja"], n["no_leidos"], n["papelera"]) == (2, 1, 0)
+
+    db.borrar_mensajes([uno, dos])
+    n = _coinciden_con_listados(db, 2)
+    assert (n["bandeja"], n["no_leidos"], n["papelera"]) == (0, 0, 0)
+
+
+def test_recalcular_da_lo_mismo_que_los_contadores_incrementales(sistema, db):
+    for i in range(4):
+        sistema.enviar(pf.Mensaje(None, f"a{i}", "c", 1, 2, fecha_envio=VIEJO_MS + i))
+    urgente = db.guardar_mensaje(pf.Mensaje(None, "urgente", "c", 3, 2, prioridad=1))
+    db.marcar_prioritario(urgente)
+    assert pf.Archivador(db, dias=30).archivar() == 4
+    viejo = db.obtener_mensajes_para_usuario(2)[-1].id_mensaje
+    db.marcar_leido(viejo)
+    db.marcar_eliminado(viejo)
+    # no_leidos cuenta también lo prioritario: todo lo no leído fuera de la papelera
+    incrementales = {uid: db.contadores(uid) for uid in (1, 2, 3)}
+    assert incrementales[2] == {"bandeja": 3, "no_leidos": 4, "prioritarios": 1, "papelera": 1}
+    assert incrementales[1]["papelera"] == 1  # el enviado borrado también está en la papelera del remitente
+
+    db.recalcular_contadores()
+    assert {uid: db.contadores(uid) for uid in (1, 2, 3)} == incrementales
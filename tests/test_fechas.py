@@ -0,0 +1,48 @@
+import datetime
+
+from conftest import pf
+
+BASE_MS = 1700000000000
+DIA_MS = 86400000
+
+
+def _bandeja_por_dias(db, dias=5):
+    return [db.guardar_mensaje(pf.Mensaje(None, f"d{i}", "c", 1, 2, fecha_envio=BASE_MS + i * DIA_MS)) for i in range(dias)]
+
+
+def test_rango_de_fechas_es_semiabierto_y_acepta_ms_datetime_e_iso(db):
+    ids = _bandeja_por_dias(db)
+    desde = BASE_MS + DIA_MS
+    hasta = BASE_MS + 3 * DIA_MS
+    esperado = [ids[2], ids[1]]
+    for d, h in ((desde, hasta),
+                 (datetime.datetime.fromtimestamp(desde / 1000), datetime.datetime.fromtimestamp(hasta / 1000)),
+                 (pf._ms_a_iso(desde), pf._ms_a_iso(hasta))):
+        assert [m.id_mensaje for m in db.obtener_mensajes_para_usuario(2, desde=d, hasta=h)] == esperado
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(2, desde=BASE_MS + 4 * DIA_MS)] == ["d4"]
+    assert db.contar_busqueda(2, "asunto", "d", desde=desde) == 4
+
+
+def test_rango_de_fechas_usa_el_indice(db):
+    _bandeja_por_dias(db)
+    consultas = []
+    db.conn.set_trace_callback(consultas.append)
+    db.obtener_mensajes_para_usuario(2, desde=BASE_MS, hasta=BASE_MS + DIA_MS)
+    sql = next(s for s in consultas if "fecha_ms >=" in s)
+    plan = " ".join(r[-1] for r in db.conn.execute("EXPLAIN QUERY PLAN " + sql))
+    assert "USING INDEX" in plan and "SCAN mensajes" not in plan
+
+
+def test_base_con_fechas_en_texto_se_migra_a_ms(db):
+    mid = db.guardar_mensaje(pf.Mensaje(None, "viejo", "c", 1, 2))
+    # esquema anterior: fecha_envio en texto ISO (hora local) y sin fecha_ms
+    db.conn.execute("ALTER TABLE mensajes ADD COLUMN fecha_envio TEXT")
+    db.conn.execute("UPDATE mensajes SET fecha_envio = '2023-11-14T22:13:20', fecha_ms = NULL WHERE id = ?", (mid,))
+    db.conn.commit()
+    db.conn.close()
+    db = pf.BaseDatos(db.db_file)
+    columnas = {r[1] for r in db.conn.execute("PRAGMA table_info(mensajes)")}
+    assert "fecha_envio" not in columnas
+    esperado = round(datetime.datetime(2023, 11, 14, 22, 13, 20).timestamp() * 1000)
+    assert db.obtener_mensaje(mid).fecha_ms == esperado
+    db.conn.close()
@@ -0,0 +1,106 @@
+import pytest
+
+from conftest import pf
+
+
+def _bandeja(db, uid):
+    return sorted((m.id_mensaje, m.asunto) for m in db.obtener_mensajes_para_usuario(uid))
+
+
+def test_refragmentar_y_reabrir_conserva_buzones_e_hilos(tmp_path):
+    ruta = str(tmp_path / "correo.db")
+    db = pf.BaseDatos(ruta)
+    pf.crear_usuarios_demo(db)
+    sistema = pf.SistemaCorreo(db, ruta_modelo_spam=str(tmp_path / "spam.bin"),
+                               limitador=pf.LimitadorEnvios(tasa=1e6, capacidad=1e6, max_en_vuelo=1000))
+    (_, ids), _ = sistema._guardar(db, pf.Mensaje(None, "hola", "primero", 1, None), [2, 3], None)
+    sistema._guardar(db, pf.Mensaje(None, "Re: hola", "respuesta", 2, 1, en_respuesta_a=ids[0]), [1], None)
+    antes = {uid: _bandeja(db, uid) for uid in (1, 2, 3)}
+    hilos_antes = db.obtener_hilos(1)
+    hilo_antes = [(m.id_mensaje, m.asunto) for m in db.obtener_hilo(hilos_antes[0]["hilo_id"], 1)]
+    db.conn.close()
+
+    sin_fragmentar = pf.abrir_base(ruta)
+    assert type(sin_fragmentar) is pf.BaseDatos
+    sin_fragmentar.conn.close()
+    pf.BaseDatosFragmentada(ruta).refragmentar(3)
+
+    fragmentada = pf.abrir_base(ruta)
+    assert isinstance(fragmentada, pf.BaseDatosFragmentada)
+    assert len(fragmentada.fragmentos) == 3
+    assert {uid: _bandeja(fragmentada, uid) for uid in (1, 2, 3)} == antes
+
+    hilos = fragmentada.obtener_hilos(1)
+    assert [h["hilo_id"] for h in hilos] == [h["hilo_id"] for h in hilos_antes]
+    assert hilos[0]["participantes"] == 3
+    hilo = fragmentada.obtener_hilo(hilos[0]["hilo_id"], 1)
+    assert [(m.id_mensaje, m.asunto) for m in hilo] == hilo_antes
+
+    borrados = []
+    fragmentada.eliminar_usuario_en_segundo_plano(3, borrados.append).join()
+    assert borrados and borrados[0] >= 1
+    assert fragmentada.obtener_usuario_por_id(3) is None
+    assert _bandeja(fragmentada, 3) == []
+    fragmentada.cerrar()
+
+
+def test_reintento_en_base_fragmentada_busca_en_el_fragmento_del_destinatario(tmp_path):
+    db = pf.BaseDatosFragmentada(str(tmp_path / "correo.db"), fragmentos=3)
+    pf.crear_usuarios_demo(db)
+    sistema = pf.SistemaCorreo(db, ruta_modelo_spam=str(tmp_path / "spam.bin"),
+                               limitador=pf.LimitadorEnvios(tasa=1e6, capacidad=1e6, max_en_vuelo=1000))
+    _, ids = sistema.enviar(pf.Mensaje(None, "hola", "c", 1, None, clave_idempotencia="k"), [2, 3])
+    consultas = []
+    for fragmento in db.fragmentos:
+        fragmento.conn.set_trace_callback(consultas.append)
+    assert sistema.enviar(pf.Mensaje(None, "hola", "c", 1, None, clave_idempotencia="k"), [2, 3]) == ("duplicado", ids)
+    # usuarios 2 y 3: fragmentos 2 y 0; el 1 no se consulta
+    assert sum("claves_idempotencia" in sql for sql in consultas) == 2
+    db.cerrar()
+
+
+def test_refragmentar_un_envio_a_varios_cuenta_un_mensaje_por_hilo(tmp_path):
+    ruta = str(tmp_path / "correo.db")
+    db = pf.BaseDatos(ruta)
+    for i in range(8):
+        db.crear_usuario(f"u{i}", f"u{i}@correo.com", "clave")
+    cuerpo = "compartido " * 200
+    db.guardar_mensaje_multiple(pf.Mensaje(None, "hola", cuerpo, 1, None), list(range(2, 9)))
+    db.conn.close()
+
+    fragmentada = pf.BaseDatosFragmentada(ruta)
+    fragmentada.refragmentar(3, tam_lote=2)
+    for fragmento in fragmentada.fragmentos:
+        c = fragmento.conn
+        assert c.execute("SELECT cantidad FROM hilos").fetchall() == [(1,)]
+        assert c.execute("SELECT cantidad FROM hilo_participantes WHERE usuario_id = 1").fetchall() == [(1,)]
+        # las entregas del fragmento comparten una copia del contenido
+        entregas, = c.execute("SELECT entregas FROM contenidos").fetchone()
+        assert entregas == c.execute("SELECT COUNT(*) FROM mensajes WHERE contenido_id IS NOT NULL").fetchone()[0]
+    assert [m.cuerpo for u in range(2, 9) for m in fragmentada.obtener_mensajes_para_usuario(u)] == [cuerpo] * 7
+    fragmentada.cerrar()
+
+
+def test_operaciones_por_id_van_al_fragmento_del_mensaje(tmp_path):
+    db = pf.BaseDatosFragmentada(str(tmp_path / "correo.db"), fragmentos=3)
+    pf.crear_usuarios_demo(db)
+    # Bob (2) queda en el fragmento 2, no en el directorio
+    mid = db.guardar_mensaje(pf.Mensaje(None, "hola", "c", 1, 2))
+    assert db.fragmento_de_mensaje(mid) is db.fragmentos[2]
+
+    db.marcar_eliminado(mid)
+    assert [m.id_mensaje for m in db.obtener_mensajes_papelera(2)] == [mid]
+    db.recuperar_mensaje(mid)
+    assert [m.id_mensaje for m in db.obtener_mensajes_para_usuario(2)] == [mid]
+    db.marcar_prioritario(mid)
+    db.desmarcar_prioritario(mid)
+    assert db.fragmentos[2].conn.execute("SELECT procesado_prioridad FROM mensajes WHERE id = ?", (mid,)).fetchone() == (0,)
+    assert db.obtener_adjuntos(mid) == []
+    assert db.participantes_hilo(mid) == [1, 2]
+    db.borrar_mensaje_definitivo(mid)
+    assert db.obtener_mensaje(mid) is None
+
+    # lo que no se reparte por fragmento no cae en el directorio
+    with pytest.raises(AttributeError, match="no reparte eliminar_usuario"):
+        db.eliminar_usuario(2)
+    db.cerrar()
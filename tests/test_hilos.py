@@ -0,0 +1,43 @@
+from conftest import pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def test_responder_encadena_el_hilo_y_resume_por_participante(sistema, db):
+    _, (a_bob, a_carlos) = sistema.enviar(pf.Mensaje(None, "asado", "sábado?", 1, None), [2, 3])
+    _, de_bob = sistema.responder(a_bob, 2, "dale")
+    _, de_alice = sistema.responder(de_bob, 1, "listo")
+    mensaje = db.obtener_mensaje(de_alice)
+    assert (mensaje.asunto, mensaje.destinatario_id, mensaje.hilo_id) == ("Re: asado", 2, a_bob)
+    assert db.participantes_hilo(a_bob) == [1, 2, 3]
+
+    hilo_bob, = db.obtener_hilos(2)
+    assert (hilo_bob["hilo_id"], hilo_bob["asunto"], hilo_bob["ultimo_mensaje_id"]) == (a_bob, "asado", de_alice)
+    # el envío a varios cuenta una vez en el total
+    assert (hilo_bob["mensajes"], hilo_bob["mensajes_total"], hilo_bob["participantes"]) == (3, 3, 3)
+    hilo_carlos, = db.obtener_hilos(3)
+    assert (hilo_carlos["mensajes"], hilo_carlos["ultimo_mensaje_id"]) == (1, a_carlos)
+    assert [m.id_mensaje for m in db.obtener_hilo(a_bob, 3)] == [a_carlos]
+
+    otro = db.guardar_mensaje(pf.Mensaje(None, "otro tema", "c", 3, 2))
+    assert [h["hilo_id"] for h in db.obtener_hilos(2)] == [otro, a_bob]
+    assert [h["hilo_id"] for h in db.obtener_hilos(2, limite=1, offset=1)] == [a_bob]
+
+
+def test_resumen_de_hilo_incluye_mensajes_archivados(db):
+    raiz = db.guardar_mensaje(pf.Mensaje(None, "plan", "viejo", 1, 2, fecha_envio=VIEJO_MS))
+    db.guardar_mensaje(pf.Mensaje(None, "Re: plan", "viejo", 2, 1, fecha_envio=VIEJO_MS + 1, en_respuesta_a=raiz))
+    assert pf.Archivador(db, dias=30).archivar() == 2
+    respuesta = db.guardar_mensaje(pf.Mensaje(None, "Re: plan", "nuevo", 1, 2, en_respuesta_a=raiz))
+
+    hilo, = db.obtener_hilos(2)
+    assert hilo["hilo_id"] == raiz
+    assert hilo["asunto"] == "plan"
+    assert (hilo["mensajes"], hilo["mensajes_total"], hilo["participantes"]) == (3, 3, 2)
+    assert hilo["ultimo_mensaje_id"] == respuesta
+    assert [m.id_mensaje for m in db.obtener_hilo(raiz, 2)][0] == raiz
+
+    # borrar para siempre un mensaje archivado descuenta el resumen
+    db.borrar_mensajes([raiz])
+    hilo, = db.obtener_hilos(2)
+    assert hilo["mensajes_total"] == 2
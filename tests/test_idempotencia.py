@@ -0,0 +1,80 @@
+import json
+
+from conftest import contar, pf
+
+
+def test_reintento_sincronico_devuelve_los_ids_del_original(sistema, db):
+    estado, mid = sistema.enviar(pf.Mensaje(None, "hola", "c", 1, 2, clave_idempotencia="k1"))
+    assert estado == "enviado"
+    assert sistema.enviar(pf.Mensaje(None, "hola", "c", 1, 2, clave_idempotencia="k1")) == ("duplicado", mid)
+    estado, ids = sistema.enviar(pf.Mensaje(None, "varios", "c", 1, None, clave_idempotencia="k2"), [2, 3])
+    assert sistema.enviar(pf.Mensaje(None, "varios", "c", 1, None, clave_idempotencia="k2"), [2, 3]) == ("duplicado", ids)
+    assert contar(db.conn, "mensajes") == 3
+
+
+def test_reintento_asincronico_no_pasa_por_el_limitador(sistema, db):
+    sistema.iniciar_ingesta(max_lote=10, max_espera_ms=5)
+    try:
+        _, futuro = sistema.enviar(pf.Mensaje(None, "hola", "c", 1, 2, clave_idempotencia="k"))
+        _, mid = futuro.result(timeout=5)
+        # sin cupo el limitador rechazaría cualquier envío nuevo
+        sistema.limitador.admitir = lambda uid: True
+        assert sistema.enviar(pf.Mensaje(None, "hola", "c", 1, 2, clave_idempotencia="k")) == ("duplicado", mid)
+    finally:
+        sistema.detener_ingesta()
+    assert contar(db.conn, "mensajes") == 1
+
+
+def test_cuerpo_de_una_entrega_va_en_la_fila_salvo_que_ya_este_guardado(db):
+    cuerpo = "x" * 1000
+    db.guardar_mensaje(pf.Mensaje(None, "solo", cuerpo, 1, 2))
+    assert contar(db.conn, "cuerpos") == 0
+    assert contar(db.conn, "contenidos") == 0
+    db.guardar_mensaje_multiple(pf.Mensaje(None, "varios", cuerpo, 1, None), [2, 3])
+    db.guardar_mensaje(pf.Mensaje(None, "otra vez", cuerpo, 1, 3))
+    assert db.conn.execute("SELECT referencias FROM cuerpos").fetchall() == [(2,)]
+    assert {m.cuerpo for m in db.obtener_mensajes_para_usuario(3)} == {cuerpo}
+
+
+def test_reimportar_no_duplica_aunque_venzan_las_claves(db, tmp_path):
+    ruta = str(tmp_path / "buzon.jsonl")
+    with open(ruta, "w", encoding="utf-8") as f:
+        for i in range(3):
+            f.write(json.dumps({"remitente_id": 1, "destinatario_id": 2, "asunto": f"a{i}", "cuerpo": "c",
+                                "fecha_envio": 1700000000000 + i}) + "\n")
+    transferencia = pf.TransferenciaBuzon(db)
+    assert transferencia.importar_jsonl(ruta) == 3
+    db.ttl_idempotencia_ms = -1
+    db.limpiar_claves_idempotencia()
+    assert transferencia.importar_jsonl(ruta) == 0
+    assert contar(db.conn, "mensajes") == 3
+
+
+def test_limpieza_de_claves_no_depende_de_la_papelera(db):
+    db.guardar_mensaje(pf.Mensaje(None, "hola", "c", 1, 2, clave_idempotencia="k"))
+    db.ttl_idempotencia_ms = -1
+    db._proxima_limpieza_claves = 0
+    db.limpiar_papelera()
+    assert contar(db.conn, "claves_idempotencia") == 0
+
+
+def test_respuesta_a_mensaje_archivado_que_falla_no_deja_la_clave_tomada(sistema, db):
+    original = db.guardar_mensaje(pf.Mensaje(None, "viejo", "c", 1, 2, fecha_envio=1500000000000))
+    assert pf.Archivador(db, dias=30).archivar() == 1
+    completar = db._completar_clave
+
+    def falla(*args):
+        raise RuntimeError("corte después de insertar")
+    db._completar_clave = falla
+    try:
+        sistema.enviar(pf.Mensaje(None, "Re: viejo", "c", 2, 1, en_respuesta_a=original, clave_idempotencia="k1"))
+    except RuntimeError:
+        pass
+    db._completar_clave = completar
+    assert contar(db.conn, "claves_idempotencia") == 0
+    assert contar(db.conn, "mensajes") == 0
+
+    estado, mid = sistema.enviar(pf.Mensaje(None, "Re: viejo", "c", 2, 1, en_respuesta_a=original, clave_idempotencia="k1"))
+    assert estado == "enviado" and mid is not None
+    assert db.obtener_mensaje(mid).hilo_id == original
+    assert db.buscar_clave_idempotencia(2, "k1") == mid
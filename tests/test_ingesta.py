@@ -0,0 +1,48 @@
+from conftest import contar, pf
+
+
+def test_agrupar_confirma_una_vez_y_deshace_todo_si_falla(db):
+    commits = []
+    db.conn.set_trace_callback(lambda sql: commits.append(sql) if sql.strip().upper() == "COMMIT" else None)
+    with db.agrupar():
+        for i in range(5):
+            db.conn.execute("SAVEPOINT ingesta")
+            db.guardar_mensaje(pf.Mensaje(None, f"a{i}", "c", 1, 2))
+            db.conn.execute("RELEASE ingesta")
+            assert db.conn.in_transaction
+    db.conn.set_trace_callback(None)
+    assert len(commits) == 1
+    assert contar(db.conn, "mensajes") == 5
+
+    try:
+        with db.agrupar():
+            db.conn.execute("SAVEPOINT ingesta")
+            db.guardar_mensaje(pf.Mensaje(None, "perdido", "c", 1, 2))
+            db.conn.execute("RELEASE ingesta")
+            raise RuntimeError("falla el grupo")
+    except RuntimeError:
+        pass
+    assert contar(db.conn, "mensajes") == 5
+    assert contar(db.conn, "mensajes", "asunto = ?", ("perdido",)) == 0
+
+
+def test_ingesta_un_commit_por_lote(sistema):
+    ingesta = sistema.iniciar_ingesta(max_lote=50, max_espera_ms=500)
+    sentencias = []
+    ingesta.db.conn.set_trace_callback(lambda sql: sentencias.append(sql.strip().upper()))
+    futuros = [sistema.enviar(pf.Mensaje(None, f"m{i}", "hola", 1, 2))[1] for i in range(50)]
+    resultados = [f.result(timeout=10) for f in futuros]
+    sistema.detener_ingesta()
+    assert all(estado == "enviado" for estado, _mid in resultados)
+    assert ingesta.estadisticas()["lotes"] == 1
+    # cada SAVEPOINT anida en la transacción del grupo: si no, su RELEASE confirmaría un mensaje suelto
+    abierta = False
+    for sql in sentencias:
+        if sql.startswith("BEGIN"):
+            abierta = True
+        elif sql in ("COMMIT", "ROLLBACK"):
+            abierta = False
+        elif sql.startswith("SAVEPOINT"):
+            assert abierta
+    assert sum(sql.startswith("BEGIN") for sql in sentencias) == 1
+    assert contar(sistema.db.conn, "mensajes") == 50
@@ -0,0 +1,52 @@
+from conftest import contar, pf
+
+
+class Reloj:
+    def __init__(self):
+        self.ahora = 0.0
+
+    def __call__(self):
+        return self.ahora
+
+    def dormir(self, segundos):
+        self.ahora += segundos
+
+
+def test_las_fichas_se_recargan_con_el_tiempo_por_remitente():
+    reloj = Reloj()
+    limitador = pf.LimitadorEnvios(tasa=2.0, capacidad=3, reloj=reloj, dormir=reloj.dormir)
+    assert [limitador.admitir(1) for _ in range(4)] == [None, None, None, "limitado"]
+    assert limitador.admitir(2) is None  # otro remitente tiene su propio balde
+
+    reloj.ahora += 0.5  # una ficha
+    assert [limitador.admitir(1) for _ in range(2)] == [None, "limitado"]
+    reloj.ahora += 60  # se llena hasta la capacidad, no más
+    assert [limitador.admitir(1) for _ in range(4)] == [None, None, None, "limitado"]
+    assert limitador.estadisticas()["limitados"] == 3
+
+
+def test_modo_esperar_demora_hasta_la_proxima_ficha():
+    reloj, esperas = Reloj(), []
+    # dormir no mueve el reloj: como si los envíos llegaran todos juntos desde varios hilos
+    limitador = pf.LimitadorEnvios(tasa=4.0, capacidad=1, modo="esperar", max_espera=0.3, reloj=reloj, dormir=esperas.append)
+    assert limitador.admitir(1) is None
+    assert limitador.admitir(1) is None
+    assert esperas == [0.25]
+    # la próxima ficha ya quedó reservada por el anterior: habría que esperar 0.5 s
+    assert limitador.admitir(1) == "limitado"
+    assert limitador.estadisticas()["demorados"] == 1
+
+
+def test_enviar_sin_ficha_o_sin_cupo_no_guarda_nada(tmp_path, db):
+    reloj = Reloj()
+    limitador = pf.LimitadorEnvios(tasa=1.0, capacidad=1, max_en_vuelo=1, reloj=reloj)
+    sistema = pf.SistemaCorreo(db, ruta_modelo_spam=str(tmp_path / "spam.bin"), limitador=limitador)
+    assert sistema.enviar(pf.Mensaje(None, "uno", "c", 1, 2))[0] == "enviado"
+    assert sistema.enviar(pf.Mensaje(None, "dos", "c", 1, 2)) == ("limitado", None)
+
+    reloj.ahora += 1
+    with limitador.cupo():
+        assert sistema.enviar(pf.Mensaje(None, "dos", "c", 1, 2)) == ("ocupado", None)
+    # la ficha del envío sin cupo se devolvió
+    assert sistema.enviar(pf.Mensaje(None, "dos", "c", 1, 2))[0] == "enviado"
+    assert contar(db.conn, "mensajes") == 2
@@ -0,0 +1,79 @@
+import threading
+
+import pytest
+
+from conftest import pf
+
+
+def test_refiltrar_en_segundo_plano_usa_otra_conexion_e_invalida_la_cache(sistema, db):
+    for asunto in ("oferta", "reunion"):
+        db.guardar_mensaje(pf.Mensaje(None, asunto, "c", 1, 2))
+    assert len(db.obtener_mensajes_para_usuario(2)) == 2  # queda en la caché compartida
+    db.crear_regla(pf.Regla(None, 2, "asunto", "oferta", "papelera"))
+    resultado = []
+
+    def trabajo():
+        otra = db.conexion_de_trabajo()
+        try:
+            assert otra.conn is not db.conn
+            resultado.append(sistema.refiltrar(2, procesos=0, db=otra))
+        finally:
+            otra.conn.close()
+    hilo = threading.Thread(target=trabajo)
+    hilo.start()
+    hilo.join()
+
+    assert resultado[0]["papelera"] == 1
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(2)] == ["reunion"]
+
+
+def test_regla_compara_subcadena_regex_y_remitente():
+    m = pf.Mensaje(None, "Factura de Marzo", "total $100", 1, 2, metadata={"origen": "web"})
+    assert pf.Regla(None, 2, "asunto", "factura", "prioridad").coincide(m)
+    assert pf.Regla(None, 2, "cuerpo", r"\$\d+", "papelera", es_regex=True).coincide(m)
+    assert pf.Regla(None, 2, "remitente", "alice@", "papelera").coincide(m, "alice@correo.com")
+    assert pf.Regla(None, 2, "remitente", "1", "papelera").coincide(m)
+    assert pf.Regla(None, 2, "metadata", '"origen": "web"', "papelera").coincide(m)
+    assert not pf.Regla(None, 2, "asunto", "abril", "papelera").coincide(m)
+    for args in (("fecha", "x", "papelera"), ("asunto", "x", "borrar"), ("asunto", "x", "mover"),
+                 ("asunto", "(", "papelera", None, True)):
+        with pytest.raises(ValueError):
+            pf.Regla(None, 2, *args)
+
+
+def test_refiltrar_en_el_mismo_proceso_aplica_la_primera_regla_por_orden(sistema, db):
+    ids = {}
+    for i in range(7):
+        asunto = ("oferta", "factura", "otro")[i % 3]
+        ids.setdefault(asunto, []).append(db.guardar_mensaje(pf.Mensaje(None, f"{asunto} {i}", "c", 1, 2)))
+    viejo = db.guardar_mensaje(pf.Mensaje(None, "factura vieja", "c", 1, 2, fecha_envio=1500000000000))
+    assert pf.Archivador(db, dias=30).archivar() == 1
+    db.guardar_mensaje(pf.Mensaje(None, "oferta enviada", "c", 2, 3))
+
+    sistema.agregar_regla(2, "asunto", "factura", "mover", "cuentas", orden=1)
+    sistema.agregar_regla(2, "asunto", "oferta", "papelera", orden=2)
+    sistema.agregar_regla(2, "asunto", "factura|oferta", "prioridad", es_regex=True, orden=3)
+    avance = []
+    r = pf.Refiltrador(db, procesos=0, tam_lote=3).aplicar(2, progreso=avance.append)
+
+    assert r == {"revisados": 8, "papelera": 3, "prioridad": 0, "mover": 3}
+    assert avance == [3, 6, 8]
+    assert sorted(m.id_mensaje for m in db.obtener_mensajes_papelera(2)) == ids["oferta"]
+    assert sorted(m.id_mensaje for m in db.obtener_mensajes_carpeta(2, "cuentas")) == sorted(ids["factura"] + [viejo])
+    assert [m.id_mensaje for m in db.obtener_mensajes_para_usuario(2)] == ids["otro"][::-1]
+    assert [m.asunto for m in db.obtener_mensajes_para_usuario(3)] == ["oferta enviada"]
+
+
+def test_refiltrar_con_procesos_da_lo_mismo_que_en_el_mismo_proceso(tmp_path):
+    resultados = []
+    for procesos in (0, 2):
+        db = pf.BaseDatos(str(tmp_path / f"correo_{procesos}.db"))
+        pf.crear_usuarios_demo(db)
+        for i in range(20):
+            db.guardar_mensaje(pf.Mensaje(None, f"a{i}", "urgente" if i % 4 == 0 else "c", 1 + i % 2 * 2, 2))
+        reglas = [pf.Regla(None, 2, "cuerpo", "urgente", "prioridad"), pf.Regla(None, 2, "remitente", "carlos", "papelera")]
+        r = pf.Refiltrador(db, procesos=procesos, tam_lote=4).aplicar(2, reglas)
+        resultados.append((r, sorted(m.asunto for m in db.obtener_mensajes_para_usuario(2))))
+        db.conn.close()
+    assert resultados[0] == resultados[1]
+    assert resultados[0][0] == {"revisados": 20, "papelera": 10, "prioridad": 5, "mover": 0}
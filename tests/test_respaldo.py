@@ -0,0 +1,70 @@
+import os
+import sqlite3
+import time
+
+import pytest
+
+from conftest import pf
+
+VIEJO_MS = 1500000000000  # 2017: lo mueve el Archivador
+
+
+def _mensajes(ruta):
+    con = sqlite3.connect(ruta)
+    try:
+        return con.execute("SELECT COUNT(*) FROM mensajes").fetchone()[0]
+    finally:
+        con.close()
+
+
+@pytest.mark.parametrize("modo", ["paginas", "vacuum"])
+def test_respaldar_copia_base_y_archivos_y_las_verifica(db, tmp_path, modo):
+    for i in range(3):
+        db.guardar_mensaje(pf.Mensaje(None, f"a{i}", "c", 1, 2, fecha_envio=VIEJO_MS if i == 0 else None))
+    assert pf.Archivador(db, dias=30).archivar() == 1
+    servicio = pf.ServicioRespaldo(db, carpeta=str(tmp_path / "respaldos"), modo=modo, paginas_por_paso=1, pausa_ms=0)
+
+    m = servicio.respaldar()
+    assert (m["archivos"], m["modo"]) == (2, modo)
+    assert m["verificacion_s"] > 0 and m["paginas"] > 0
+    (_mes, archivo), = db.listar_archivos()
+    assert _mensajes(os.path.join(m["ruta"], os.path.basename(db.db_file))) == 2
+    assert _mensajes(os.path.join(m["ruta"], os.path.basename(archivo))) == 1
+    assert [r for _n, r in servicio.listar()] == [m["ruta"]]
+
+
+def test_escrituras_durante_la_copia_la_reinician_y_queda_consistente(db, tmp_path):
+    for i in range(200):
+        db.guardar_mensaje(pf.Mensaje(None, f"a{i}", "x" * 500, 1, 2))
+    escritos = []
+
+    def escribir(_archivo, copiadas, _total):
+        if copiadas and len(escritos) < 3:
+            escritos.append(db.guardar_mensaje(pf.Mensaje(None, "durante", "c", 1, 2)))
+    servicio = pf.ServicioRespaldo(db, carpeta=str(tmp_path / "respaldos"), paginas_por_paso=4, pausa_ms=0, max_reinicios=1)
+    m = servicio.respaldar(progreso=escribir)
+    assert m["reinicios"] >= 1
+    assert _mensajes(os.path.join(m["ruta"], os.path.basename(db.db_file))) == 200 + len(escritos)
+
+
+def test_copia_que_no_verifica_se_borra_y_se_cuenta(db, tmp_path, monkeypatch):
+    servicio = pf.ServicioRespaldo(db, carpeta=str(tmp_path / "respaldos"), verificar=True)
+
+    def falla(copia):
+        raise RuntimeError("integrity_check")
+    monkeypatch.setattr(servicio, "_verificar", falla)
+    with pytest.raises(RuntimeError):
+        servicio.respaldar()
+    assert os.listdir(servicio.carpeta) == []
+    stats = servicio.estadisticas()
+    assert (stats["fallos"], stats["copias"]) == (1, 0)
+    assert "integrity_check" in stats["ultimo_error"]
+
+
+def test_conserva_las_ultimas_copias(db, tmp_path):
+    servicio = pf.ServicioRespaldo(db, carpeta=str(tmp_path / "respaldos"), modo="vacuum", conservar=2)
+    rutas = []
+    for _ in range(3):
+        rutas.append(servicio.respaldar()["ruta"])
+        time.sleep(0.002)  # el nombre de cada copia tiene resolución de milisegundos
+    assert [r for _n, r in servicio.listar()] == rutas[:0:-1]
@@ -0,0 +1,34 @@
+import os
+import time
+
+from conftest import pf
+
+
+def test_aprender_spam_guarda_el_modelo_en_segundo_plano_una_vez_por_tanda(sistema, db):
+    ids = [db.guardar_mensaje(pf.Mensaje(None, f"oferta {i}", "compre ya", 1, 2)) for i in range(3)]
+    guardados = []
+    guardar = sistema.clasificador.guardar
+    sistema.clasificador.guardar = lambda ruta: (guardados.append(ruta), guardar(ruta))
+    sistema.espera_guardado_spam = 0.2
+    for mid in ids:
+        assert sistema.aprender_spam([mid], True) == 1
+    # entrenar no escribe el modelo en el hilo que llama
+    assert guardados == []
+    fin = time.monotonic() + 5
+    while not guardados and time.monotonic() < fin:
+        time.sleep(0.02)
+    time.sleep(0.3)
+    assert guardados == [sistema.ruta_modelo_spam]
+    assert sistema.clasificador.documentos[1] == 3
+    # sin aprendizajes pendientes, cerrar no vuelve a escribir
+    sistema.guardar_modelo_spam(solo_pendiente=True)
+    assert len(guardados) == 1
+
+
+def test_guardado_pendiente_se_escribe_al_cerrar(sistema, db):
+    mid = db.guardar_mensaje(pf.Mensaje(None, "oferta", "compre ya", 1, 2))
+    sistema.espera_guardado_spam = 60
+    sistema.aprender_spam([mid], True)
+    assert not os.path.exists(sistema.ruta_modelo_spam)
+    sistema.guardar_modelo_spam(solo_pendiente=True)
+    assert pf.ClasificadorSpam.cargar(sistema.ruta_modelo_spam).documentos[1] == 1
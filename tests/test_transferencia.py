@@ -0,0 +1,88 @@
+import json
+import os
+
+import pytest
+
+from conftest import pf
+
+
+def _otra_base(tmp_path, nombre="destino.db"):
+    base = pf.BaseDatos(str(tmp_path / nombre))
+    pf.crear_usuarios_demo(base)
+    return base
+
+
+def _campos(db, uid):
+    return sorted((m.asunto, m.cuerpo, m.metadata, m.fecha_ms, m.prioridad, m.leido, m.remitente_id)
+                  for m in db.obtener_mensajes_para_usuario(uid))
+
+
+@pytest.mark.parametrize("formato", ["jsonl", "mbox"])
+def test_exportar_e_importar_conserva_los_mensajes(db, tmp_path, formato):
+    db.guardar_mensaje(pf.Mensaje(None, "año nuevo", "línea 1\nFrom la línea 2", 1, 2, metadata={"etiqueta": "ñ"}, prioridad=2))
+    leido = db.guardar_mensaje(pf.Mensaje(None, "leído", "c", 3, 2))
+    db.marcar_leido(leido)
+    db.guardar_mensaje(pf.Mensaje(None, "enviado", "c", 2, 3))
+    db.guardar_mensaje(pf.Mensaje(None, "de otros", "c", 1, 3))
+    ruta = str(tmp_path / f"buzon.{formato}")
+    origen = pf.TransferenciaBuzon(db)
+    exportar = origen.exportar_mbox if formato == "mbox" else origen.exportar_jsonl
+    # el buzón del usuario: lo recibido y lo enviado
+    assert exportar(ruta, uid=2) == 3
+
+    destino = _otra_base(tmp_path)
+    t = pf.TransferenciaBuzon(destino)
+    importar = t.importar_mbox if formato == "mbox" else t.importar_jsonl
+    assert importar(ruta) == 3
+    assert _campos(destino, 2) == _campos(db, 2)
+    assert [m.asunto for m in destino.obtener_mensajes_para_usuario(3)] == ["enviado"]
+    destino.conn.close()
+
+
+def test_importacion_cortada_sigue_desde_el_checkpoint(db, tmp_path):
+    for i in range(5):
+        db.guardar_mensaje(pf.Mensaje(None, f"asunto {i}", "c", 1, 2))
+    ruta = str(tmp_path / "buzon.jsonl")
+    pf.TransferenciaBuzon(db).exportar_jsonl(ruta)
+
+    destino = _otra_base(tmp_path)
+    t = pf.TransferenciaBuzon(destino, tam_lote=2)
+    insertar = destino.insertar_mensajes_lote
+    lotes = []
+
+    def corte(filas):
+        if lotes:
+            raise KeyboardInterrupt
+        lotes.append(filas)
+        return insertar(filas)
+    destino.insertar_mensajes_lote = corte
+    with pytest.raises(KeyboardInterrupt):
+        t.importar_jsonl(ruta)
+    with open(ruta + ".checkpoint", encoding="utf-8") as f:
+        assert json.load(f)["importados"] == 2
+
+    destino.insertar_mensajes_lote = insertar
+    assert t.importar_jsonl(ruta) == 5
+    assert not os.path.exists(ruta + ".checkpoint")
+    assert sorted(m.asunto for m in destino.obtener_mensajes_para_usuario(2)) == [f"asunto {i}" for i in range(5)]
+    destino.conn.close()
+
+
+def test_mbox_con_un_mensaje_invalido_saltea_ese_y_sigue(db, tmp_path):
+    for i in range(3):
+        db.guardar_mensaje(pf.Mensaje(None, f"asunto {i}", f"cuerpo {i}", 1, 2))
+    ruta = str(tmp_path / "buzon.mbox")
+    assert pf.TransferenciaBuzon(db).exportar_mbox(ruta) == 3
+    with open(ruta, "rb") as f:
+        datos = f.read()
+    datos = datos.replace(b"X-Correo-Prioridad: 5", b"X-Correo-Prioridad: alta", 1)
+    datos = datos.replace(b"Subject: asunto 2", b"Subject: asunto 2\nX-Correo-Metadata: {roto", 1)
+    with open(ruta, "wb") as f:
+        f.write(datos)
+
+    destino = _otra_base(tmp_path)
+    transferencia = pf.TransferenciaBuzon(destino)
+    assert transferencia.importar_mbox(ruta) == 1
+    assert transferencia.saltados == 2
+    assert [m.asunto for m in destino.obtener_mensajes_para_usuario(2)] == ["asunto 1"]
+    destino.conn.close()